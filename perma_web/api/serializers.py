@@ -1,11 +1,11 @@
 from django.conf import settings
-from django.core.exceptions import ValidationError as DjangoValidationError, ObjectDoesNotExist
-from django.core.validators import URLValidator
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
 import requests
 from rest_framework import serializers
 
 from perma.models import LinkUser, Folder, CaptureJob, Capture, Link, Organization, LinkBatch
-from perma.utils import ip_in_allowed_ip_range
+from perma.utils import clean_submitted_url
 
 from .utils import get_mime_type, mime_type_lookup, reverse_api_view
 
@@ -121,14 +121,32 @@ class OrganizationSerializer(BaseSerializer):
 
 ### CAPTUREJOB ###
 
+class CaptureJobListSerializer(serializers.ListSerializer):
+    """
+        Look up queue positions for all the listed jobs in one query, rather than one or two per job.
+    """
+    def to_representation(self, data):
+        capture_jobs = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.queue_positions = CaptureJob.queue_positions(capture_jobs)
+        return super().to_representation(capture_jobs)
+
+
 class CaptureJobSerializer(BaseSerializer):
     guid = serializers.PrimaryKeyRelatedField(source='link', read_only=True)
     title = serializers.SerializerMethodField()
     user_deleted = serializers.SerializerMethodField()
+    queue_position = serializers.SerializerMethodField()
 
     class Meta:
         model = CaptureJob
         fields = ('guid', 'status', 'message', 'submitted_url', 'attempt', 'step_count', 'step_description', 'capture_start_time', 'capture_end_time', 'queue_position', 'title', 'user_deleted')
+        list_serializer_class = CaptureJobListSerializer
+
+    def get_queue_position(self, capture_job):
+        queue_positions = getattr(self, 'queue_positions', None)
+        if queue_positions is not None and capture_job.pk in queue_positions:
+            return queue_positions[capture_job.pk]
+        return capture_job.queue_position()
 
     def get_title(self, capture_job):
         if capture_job.link is None:
@@ -200,11 +218,7 @@ class AuthenticatedLinkSerializer(LinkSerializer):
         return None
 
     def validate_url(self, url):
-        # Clean up the user submitted url
-        url = url.strip()
-        if url and url[:4] != 'http':
-            url = 'http://' + url
-        return url
+        return clean_submitted_url(url)
 
     def validate(self, data):
         user = self.context['request'].user
@@ -234,31 +248,10 @@ class AuthenticatedLinkSerializer(LinkSerializer):
             if not data.get('submitted_url'):
                 errors['url'] = "URL cannot be empty."
             else:
-                try:
-                    validate = URLValidator()
-                    temp_link = Link(submitted_url=data['submitted_url'])
-                    validate(temp_link.ascii_safe_url)
-
-                    # Don't force URL resolution validation if a file is provided
-                    if not uploaded_file:
-                        if not temp_link.ip:
-                            errors['url'] = "Couldn't resolve domain."
-                        elif not ip_in_allowed_ip_range(temp_link.ip):
-                            errors['url'] = "Not a valid IP."
-                        elif not temp_link.headers:
-                            errors['url'] = "Couldn't load URL."
-                        else:
-                            # preemptively reject URLs that report a size over settings.MAX_ARCHIVE_FILE_SIZE
-                            try:
-                                if int(temp_link.headers.get('content-length', 0)) > settings.MAX_ARCHIVE_FILE_SIZE:
-                                    errors['url'] = f"Target page is too large (max size {settings.MAX_ARCHIVE_FILE_SIZE / 1024 / 1024}MB)."
-                            except ValueError:
-                                # content-length header wasn't an integer. Carry on.
-                                pass
-                except DjangoValidationError:
-                    errors['url'] = "Not a valid URL."
-                except requests.TooManyRedirects:
-                    errors['url'] = "URL caused a redirect loop."
+                # Don't force URL resolution validation if a file is provided
+                url_error = Link(submitted_url=data['submitted_url']).submitted_url_error(check_target=not uploaded_file)
+                if url_error:
+                    errors['url'] = url_error
 
         # check uploaded file
         if uploaded_file == '':
@@ -4,9 +4,10 @@ import os
 import dateutil.parser
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.db import connection
 from django.urls import reverse
 from django.http import StreamingHttpResponse
-from django.test.utils import override_settings
+from django.test.utils import override_settings, CaptureQueriesContext
 from io import StringIO
 import json
 import urllib.parse
@@ -14,7 +15,7 @@ import re
 from mock import patch
 
 from .utils import ApiResourceTestCase, ApiResourceTransactionTestCase, TEST_ASSETS_DIR, index_warc_file
-from perma.models import Link, LinkUser, Folder
+from perma.models import Link, LinkUser, Folder, Capture
 
 
 class LinkResourceTestMixin():
@@ -134,6 +135,28 @@ class LinkResourceTestCase(LinkResourceTestMixin, ApiResourceTestCase):
     def test_get_detail_json(self):
         self.successful_get(self.public_link_detail_url, fields=self.logged_out_fields)
 
+    def assertQueryCountIndependentOfLinkCount(self, url, user):
+        def count_queries():
+            self.api_client.force_authenticate(user=user)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertHttpOK(self.api_client.get(url))
+            return len(queries)
+
+        query_count = count_queries()
+        for i in range(3):
+            link = Link(created_by=user, submitted_url=f'https://example.com/{i}', submitted_title='Example')
+            link.save()
+            link.move_to_folder_for_user(user.root_folder, user)
+            Capture(link=link, role='primary', status='success', record_type='response', url=link.submitted_url, content_type='text/html').save()
+            Capture(link=link, role='screenshot', status='success', record_type='resource', url=f'file:///{link.guid}/cap.png', content_type='image/png').save()
+        self.assertEqual(count_queries(), query_count)
+
+    def test_get_logged_in_list_query_count(self):
+        self.assertQueryCountIndependentOfLinkCount(self.logged_in_list_url, self.regular_user)
+
+    def test_export_logged_in_list_query_count(self):
+        self.assertQueryCountIndependentOfLinkCount(reverse('api:archives_export'), self.regular_user)
+
     @patch('api.views.stream_warc', autospec=True)
     def test_public_download(self, stream):
         stream.return_value = StreamingHttpResponse(StringIO("warc placeholder"))
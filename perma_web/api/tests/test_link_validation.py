@@ -63,7 +63,7 @@ class LinkValidationTestCase(LinkValidationMixin, ApiResourceTestCase):
                            user=self.org_user,
                            data={'url': 'https://www.ntanet.org/some-article.pdf\x00'})
 
-    @override_settings(RESOURCE_LOAD_TIMEOUT=0.25) # only wait 1/4 second before giving up
+    @override_settings(LINK_VALIDATION_TIMEOUT=0.25) # only wait 1/4 second before giving up
     def test_should_reject_unresolvable_domain_url(self):
         self.rejected_post(self.list_url,
                            user=self.org_user,
@@ -45,10 +45,17 @@ def raise_general_validation_error(message):
         api_settings.NON_FIELD_ERRORS_KEY: [message]
     })
 
-def raise_invalid_capture_job(capture_job, err):
-    error_dict = err if isinstance(err, Mapping) else {
+def capture_job_error_dict(err):
+    return err if isinstance(err, Mapping) else {
         api_settings.NON_FIELD_ERRORS_KEY: [err]
     }
+
+def capture_job_error_message(err):
+    """ Format err for CaptureJob.message, in the same form as the errors returned by the API. """
+    return json.dumps(capture_job_error_dict(err))
+
+def raise_invalid_capture_job(capture_job, err):
+    error_dict = capture_job_error_dict(err)
     capture_job.message = json.dumps(error_dict)
     capture_job.save(update_fields=['message'])
     raise serializers.ValidationError(error_dict)
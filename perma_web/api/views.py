@@ -14,11 +14,11 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from perma.utils import stream_warc, stream_warc_if_permissible, clear_wr_session
-from perma.tasks import run_next_capture
+from perma.tasks import run_next_capture, create_batch_links
 from perma.models import Folder, CaptureJob, Link, Capture, Organization, LinkBatch
 
 from .utils import TastypiePagination, load_parent, raise_general_validation_error, \
-    raise_invalid_capture_job, dispatch_multiple_requests, reverse_api_view_relative, \
+    raise_invalid_capture_job, capture_job_error_message, reverse_api_view_relative, \
     url_is_invalid_unicode
 from .serializers import FolderSerializer, CaptureJobSerializer, LinkSerializer, AuthenticatedLinkSerializer, \
     LinkUserSerializer, OrganizationSerializer, LinkBatchSerializer, DetailedLinkBatchSerializer
@@ -318,7 +318,7 @@ class PublicLinkDownloadView(BaseView):
             raise Http404
         if link.replacement_link_id:
             return HttpResponseRedirect(reverse_api_view_relative('public_archives_download', kwargs={'guid': link.replacement_link_id}))
-        return stream_warc(link)
+        return stream_warc(link, request)
 
 
 # /archives
@@ -341,6 +341,58 @@ class AuthenticatedLinkListView(BaseView):
                 raise ValidationError({'folder': ["Folder not found."]})
         return None
 
+    @staticmethod
+    def link_creation_error(user, folder):
+        """
+            Helper method to check whether user may create links in folder right now.
+            Returns a message explaining why not, or None.
+            Used by AuthenticatedLinkListView.post and LinkBatchesListView.post.
+        """
+        message_template = "Perma can't create this link. {error} {resolution}"
+
+        # Disallow creation of links in top-level sponsored folder
+        if folder.is_sponsored_root_folder:
+            return message_template.format_map({
+                'error': "You can't make links directly in your Sponsored Links folder.",
+                'resolution': "Select a folder belonging to a sponsor."
+            })
+
+        # Make sure a limited user has links left to create
+        if not folder.organization and not folder.sponsored_by:
+            if not user.link_creation_allowed():
+                return AuthenticatedLinkListView.usage_limit_error(user)
+        else:
+            registrar = folder.sponsored_by if folder.sponsored_by else folder.organization.registrar
+            registrar_contact_string = ', '.join([registrar_user.email for registrar_user in registrar.active_registrar_users()])
+
+            resolution = 'See your Usage Plan page for details.' if user.registrar else \
+                f"For assistance, contact: {registrar_contact_string}."
+
+            if not registrar.link_creation_allowed():
+                return message_template.format_map({'error': f"The {registrar.name} account needs attention.",
+                                                    'resolution': resolution})
+
+            if folder.read_only:
+                return message_template.format_map({'error': f"{registrar.name} set this folder to read-only.",
+                                                    'resolution': resolution})
+        return None
+
+    @staticmethod
+    def usage_limit_error(user):
+        """
+            Helper method to explain to a limited user that they are out of personal links.
+        """
+        error = "You've reached your usage limit."
+        resolution = "Visit your Usage Plan page for information and plan options."
+
+        if user.cached_subscription_status == 'Hold':  # generally for users with CC issues
+            error = 'Your account needs attention —'
+            resolution = 'see your Usage Plan page for details.'
+        elif user.nonpaying:
+            resolution = 'Get in touch if you need more.'
+
+        return f"Perma can't create this link. {error} {resolution}"
+
     @staticmethod
     def load_links(request):
         """
@@ -398,48 +450,9 @@ class AuthenticatedLinkListView(BaseView):
         except ValidationError as e:
             raise_invalid_capture_job(capture_job, e.detail)
 
-        message_template = "Perma can't create this link. {error} {resolution}"
-
-        # Disallow creation of links in top-level sponsored folder
-        if folder.is_sponsored_root_folder:
-            message = message_template.format_map({
-                'error': "You can't make links directly in your Sponsored Links folder.",
-                'resolution': "Select a folder belonging to a sponsor."
-            })
-            raise_invalid_capture_job(capture_job, message)
-
-        # Make sure a limited user has links left to create
-        if not folder.organization and not folder.sponsored_by:
-            if not request.user.link_creation_allowed():
-
-                error = "You've reached your usage limit."
-                resolution = "Visit your Usage Plan page for information and plan options."
-
-                if request.user.cached_subscription_status == 'Hold':  # generally for users with CC issues
-                    error = 'Your account needs attention —'
-                    resolution = 'see your Usage Plan page for details.'
-                elif request.user.nonpaying:
-                    resolution = 'Get in touch if you need more.'
-
-                message = message_template.format_map({'error': error, 'resolution': resolution})
-                raise_invalid_capture_job(capture_job, message)
-        else:
-            registrar = folder.sponsored_by if folder.sponsored_by else folder.organization.registrar
-            registrar_contact_string = ', '.join([user.email for user in registrar.active_registrar_users()])
-
-            resolution = 'See your Usage Plan page for details.' if request.user.registrar else \
-                f"For assistance, contact: {registrar_contact_string}."
-
-            if not registrar.link_creation_allowed():
-                message = message_template.format_map({'error': f"The {registrar.name} account needs attention.",
-                                                       'resolution': resolution})
-                raise_invalid_capture_job(capture_job, message)
-
-            if folder.read_only:
-                message = message_template.format_map({'error': f"{registrar.name} set this folder to read-only.",
-                                                       'resolution': resolution})
-                raise_invalid_capture_job(capture_job, message)
-
+        error = self.link_creation_error(request.user, folder)
+        if error:
+            raise_invalid_capture_job(capture_job, error)
 
         serializer = self.serializer_class(data=data, context={'request': request})
         if serializer.is_valid():
@@ -642,7 +655,7 @@ class AuthenticatedLinkDownloadView(BaseView):
         link = self.get_object_for_user_by_pk(request.user, guid)
         if link.replacement_link_id:
             return HttpResponseRedirect(reverse_api_view_relative('archives_download', kwargs={'guid': link.replacement_link_id}))
-        return stream_warc_if_permissible(link, request.user)
+        return stream_warc_if_permissible(link, request.user, request)
 
 
 # /folders/:parent_id/archives/:guid
@@ -695,46 +708,61 @@ class LinkBatchesListView(BaseView):
         return self.simple_list(request, serializer_class=DetailedLinkBatchSerializer)
 
     def post(self, request, format=None):
-        """ Create link batch. """
+        """
+            Create link batch.
+
+            Capture jobs are created for all the submitted URLs at once, with status 'validating'.
+            The URLs are then checked, and Perma Links created for the valid ones, in the background:
+            see perma.tasks.create_batch_links.
+        """
         # mark batch with user
         if not request.user.is_authenticated:
             raise PermissionDenied()
         request.data['created_by'] = request.user.pk
 
+        human = request.data.get('human', False)
+        if not isinstance(human, bool):
+            raise ValidationError({'human': f'Value must be of type bool, not {type(human).__name__}.'})
+
         # save batch
         serializer = self.serializer_class(data=request.data, context={'request': self.request})
         if not serializer.is_valid():
             raise ValidationError(serializer.errors)
-        serializer.save(created_by=request.user)
+        link_batch = serializer.save(created_by=request.user)
+
+        # check, once for the whole batch, whether links can be created in the target folder
+        try:
+            folder = Folder.objects.accessible_to(request.user).get(pk=link_batch.target_folder_id)
+            error = AuthenticatedLinkListView.link_creation_error(request.user, folder)
+        except Folder.DoesNotExist:
+            error = {'folder': ["Folder not found."]}
+
+        capture_jobs = []
+        for url in request.data.get('urls', []):
+            capture_job = CaptureJob(
+                link_batch=link_batch,
+                human=human,
+                submitted_url=url,
+                created_by=request.user,
+                status='validating',
+                order=0,  # jobs are placed in the queue once validated
+            )
+            if error:
+                capture_job.status = 'invalid'
+                capture_job.message = capture_job_error_message(error)
+            elif url_is_invalid_unicode(url):
+                capture_job.status = 'invalid'
+                capture_job.message = capture_job_error_message({'url': ["Unicode error while processing URL."]})
+            capture_jobs.append(capture_job)
+        CaptureJob.objects.bulk_create(capture_jobs)
+
+        if any(capture_job.status == 'validating' for capture_job in capture_jobs):
+            create_batch_links.delay(link_batch.pk, capture_job_error_message(AuthenticatedLinkListView.usage_limit_error(request.user)))
 
-        # Attempt creation of Perma Links
-        path = reverse_api_view_relative('archives')
-        batch_id = serializer.data['id']
-        call_list = [
-            {
-                'path': path,
-                'verb': 'POST',
-                'data': {
-                    'url': url,
-                    'folder': request.data['target_folder'],
-                    'human': request.data.get('human', False)
-                }
-            } for url in request.data.get('urls', [])
-        ]
-        dispatch_multiple_requests(request, call_list, {"batch": batch_id})
-        # TODO: how can we communicate these errors to the user?
-        # if dispatch_multiple_requests returns to "responses"
-        # internal_server_errors = [
-        #     response['data']['data']['url'] for response in responses if response['status_code'] == 500
-        # ]
         # Get an up-to-date version of this LinkBatch's data,
         # formatted by the LinkBatch serializer
-        call_for_fresh_serializer_data = [{
-            'path': reverse_api_view_relative('link_batch', kwargs={"pk": batch_id}),
-            'verb': 'GET'
-        }]
-        response = dispatch_multiple_requests(request, call_for_fresh_serializer_data)
-        data = response[0]['data'].copy()
+        link_batch = LinkBatchesDetailView.queryset.get(pk=link_batch.pk)
+        data = DetailedLinkBatchSerializer(link_batch, context={'request': request}).data
         links_remaining = request.user.get_links_remaining()
         data['links_remaining'] = 'Infinity' if links_remaining[0] == float('inf') else links_remaining[0]
         data['links_remaining_period'] = links_remaining[1]
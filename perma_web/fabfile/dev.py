@@ -1069,3 +1069,136 @@ def populate_folder_cached_path(batch_size="500"):
             logger.info(f"Stopped with ~ {remaining_to_update} remaining folders to update")
     else:
         logger.info("No more folders left to update!")
+
+
+@task
+def benchmark_captures(url='https://example.com', count="10", created_by_id="1", timeout="600"):
+    """
+        Queue `count` captures of `url`, wait for the running capture workers to finish them,
+        and report how long each capture job took. Run before and after changes to the capture
+        pipeline to compare per-capture overhead and throughput.
+    """
+    import statistics
+    import time
+    from perma.models import Capture, CaptureJob, Link, LinkUser
+    from perma.tasks import run_next_capture
+
+    user = LinkUser.objects.get(pk=created_by_id)
+    capture_jobs = []
+    for i in range(int(count)):
+        link = Link(created_by=user, submitted_url=url)
+        link.save()
+        Capture(link=link, role='primary', status='pending', record_type='response', url=link.submitted_url).save()
+        Capture(link=link, role='screenshot', status='pending', record_type='resource', url=f"file:///{link.guid}/cap.png", content_type='image/png').save()
+        capture_job = CaptureJob(created_by=user, link=link, human=True, status='pending')
+        capture_job.save()
+        capture_jobs.append(capture_job)
+    run_next_capture.delay()
+
+    # wait for the workers
+    job_ids = [capture_job.pk for capture_job in capture_jobs]
+    end_time = time.time() + int(timeout)
+    while CaptureJob.objects.filter(pk__in=job_ids, status__in=['pending', 'in_progress']).exists():
+        if time.time() > end_time:
+            print(f"Timed out after {timeout} seconds.")
+            break
+        time.sleep(1)
+
+    capture_jobs = CaptureJob.objects.filter(pk__in=job_ids, capture_end_time__isnull=False).order_by('capture_start_time')
+    durations = [(capture_job.capture_end_time - capture_job.capture_start_time).total_seconds() for capture_job in capture_jobs]
+    for capture_job, duration in zip(capture_jobs, durations):
+        print(f"{capture_job.link_id}\t{capture_job.status}\t{duration:.2f}s")
+    if durations:
+        elapsed = (capture_jobs.last().capture_end_time - capture_jobs.first().capture_start_time).total_seconds()
+        print(f"{len(durations)} captures: mean {statistics.mean(durations):.2f}s, median {statistics.median(durations):.2f}s, max {max(durations):.2f}s")
+        print(f"Throughput: {len(durations) / elapsed * 60:.1f} captures/minute")
+
+
+@task
+def benchmark_capture_queue(depths="1000,10000,50000", users="20", samples="50"):
+    """
+        Time the placement of new robot capture jobs in the fair queue (CaptureJob.save) at
+        several queue depths. Pending jobs are created round-robin across `users` users,
+        and everything is rolled back afterward.
+    """
+    import statistics
+    import time
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from perma.models import CaptureJob, LinkUser
+
+    class Rollback(Exception):
+        pass
+
+    queue_users = list(LinkUser.objects.order_by('pk')[:int(users)])
+    for depth in depths.split(','):
+        depth = int(depth)
+        try:
+            with transaction.atomic():
+                CaptureJob.objects.bulk_create(
+                    CaptureJob(created_by=queue_users[i % len(queue_users)], human=False, status='pending', order=i + 1)
+                    for i in range(depth)
+                )
+                timings = []
+                query_counts = []
+                for i in range(int(samples)):
+                    capture_job = CaptureJob(created_by=queue_users[i % len(queue_users)], human=False, status='pending')
+                    with CaptureQueriesContext(connection) as queries:
+                        start_time = time.time()
+                        capture_job.save()
+                        timings.append(time.time() - start_time)
+                    query_counts.append(len(queries))
+                print(f"queue depth {depth}: mean {statistics.mean(timings) * 1000:.2f}ms, max {max(timings) * 1000:.2f}ms, {max(query_counts)} queries per insert")
+                raise Rollback
+        except Rollback:
+            pass
+
+
+@task
+def benchmark_capture_job_claims(workers="32", jobs="3200", created_by_id="1"):
+    """
+        Queue `jobs` robot capture jobs, then have `workers` threads claim them all at once
+        with CaptureJob.get_next_job, and report claim latency. The jobs are deleted afterward.
+        Run this against an idle queue, with the capture workers stopped.
+    """
+    import statistics
+    import time
+    from multiprocessing.pool import ThreadPool
+    from django.db import connection
+    from perma.models import CaptureJob, LinkUser
+
+    if CaptureJob.objects.filter(status='pending').exists():
+        print("There are pending capture jobs; run this against an idle queue.")
+        return
+
+    user = LinkUser.objects.get(pk=created_by_id)
+    job_ids = [capture_job.pk for capture_job in CaptureJob.objects.bulk_create(
+        CaptureJob(created_by=user, human=False, status='pending', order=i + 1)
+        for i in range(int(jobs))
+    )]
+
+    def claim_jobs(i):
+        timings = []
+        claimed = []
+        try:
+            while True:
+                start_time = time.time()
+                capture_job = CaptureJob.get_next_job(reserve=True)
+                timings.append(time.time() - start_time)
+                if not capture_job:
+                    return timings, claimed
+                claimed.append(capture_job.pk)
+        finally:
+            connection.close()
+
+    try:
+        start_time = time.time()
+        results = ThreadPool(int(workers)).map(claim_jobs, range(int(workers)))
+        elapsed = time.time() - start_time
+    finally:
+        CaptureJob.objects.filter(pk__in=job_ids).delete()
+
+    timings = sorted(t for worker_timings, claimed in results for t in worker_timings)
+    claimed = [pk for worker_timings, worker_claimed in results for pk in worker_claimed]
+    print(f"{len(claimed)} jobs claimed by {workers} workers in {elapsed:.2f}s ({len(claimed) / elapsed:.0f} claims/second); {len(claimed) - len(set(claimed))} claimed twice")
+    print(f"claim latency: mean {statistics.mean(timings) * 1000:.2f}ms, median {statistics.median(timings) * 1000:.2f}ms, p99 {timings[int(len(timings) * .99)] * 1000:.2f}ms, max {timings[-1] * 1000:.2f}ms")
@@ -1,5 +1,20 @@
+import hashlib
+import json
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
 from django.core.cache import cache as django_cache
+from django.utils import timezone
+
+from perma.models import Link
+
+
+MANIFEST_CACHE_KEY = 'lockss-manifest'
 
 
 class Mirror(models.Model):
@@ -44,3 +59,55 @@ class Mirror(models.Model):
 
     def _invalidate_cached_mirrors(self):
         django_cache.delete('mirrors')
+        django_cache.delete(MANIFEST_CACHE_KEY)
+
+
+def get_manifest():
+    """
+        Get the data our LOCKSS config files are rendered from: the enabled mirrors, and an
+        Archival Unit for each month since we started, with its link count and total WARC bytes.
+        Keep result in cache, until the month rolls over, a mirror changes, or
+        LOCKSS_MANIFEST_CACHE_TIMEOUT passes and the counts are refreshed.
+
+        'version' changes whenever the rest of the manifest does, and 'generated' is when it was built.
+    """
+    current_month = timezone.now().strftime('%Y-%m')
+    cached_manifest = django_cache.get(MANIFEST_CACHE_KEY)
+    if cached_manifest is not None and cached_manifest['month'] == current_month:
+        return cached_manifest
+
+    mirrors = [{'ip': ip, 'peer_port': peer_port} for ip, peer_port in Mirror.objects.filter(enabled=True).values_list('ip', 'peer_port')]
+
+    # build list of all year/month combos since we started, in the form [{'year': 2014, 'month': "01", ...}, ...]
+    archival_units = []
+    first_archive_date = Link.objects.order_by('creation_timestamp').values_list('creation_timestamp', flat=True).first()
+    if first_archive_date:
+        au_rows = Link.objects.visible_to_lockss().annotate(
+            au=TruncMonth('creation_timestamp')
+        ).values('au').annotate(
+            link_count=Count('pk'),
+            total_bytes=Sum('warc_size'),
+        ).order_by()
+        totals = {(row['au'].year, row['au'].month): row for row in au_rows}
+        start_month = date(year=first_archive_date.year, month=first_archive_date.month, day=1)
+        today = timezone.now().date()
+        while start_month <= today:
+            au_totals = totals.get((start_month.year, start_month.month), {})
+            archival_units.append({
+                'year': start_month.year,
+                'month': f'{start_month.month:02}',
+                'link_count': au_totals.get('link_count', 0),
+                'total_bytes': au_totals.get('total_bytes') or 0,
+            })
+            start_month += relativedelta(months=1)
+
+    manifest = {
+        'month': current_month,
+        'mirrors': mirrors,
+        'archival_units': archival_units,
+    }
+    manifest['version'] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    # an unchanged manifest keeps its date, so mirrors still get 304s for If-Modified-Since
+    manifest['generated'] = cached_manifest['generated'] if cached_manifest and cached_manifest['version'] == manifest['version'] else timezone.now()
+    django_cache.set(MANIFEST_CACHE_KEY, manifest, settings.LOCKSS_MANIFEST_CACHE_TIMEOUT)
+    return manifest
@@ -1,4 +1,14 @@
+from datetime import datetime, timezone
+import hashlib
+import tempfile
+from mock import patch
+
+from django.template.loader import render_to_string
 from django.test import Client
+
+from lockss.models import Mirror
+from perma.models import Link
+from perma.storage_backends import FileSystemMediaStorage
 from perma.tests.utils import PermaTestCase
 
 class LockssTestCase(PermaTestCase):
@@ -24,6 +34,77 @@ class LockssTestCase(PermaTestCase):
         response = self.clients[1][0].get('/lockss/titledb.xml')
         self.assertEqual(response.status_code, self.clients[1][1])
 
+    @patch('lockss.views.SEARCH_PAGE_SIZE', 2)
+    def test_search_pages(self):
+        links = Link.objects.filter(creation_timestamp__year=2014, creation_timestamp__month=7)
+        links.update(cached_can_play_back=True)
+        # several links sharing a creation_timestamp, so pages must break ties by guid
+        links.filter(pk__in=links.order_by('guid').values_list('pk', flat=True)[:3]).update(creation_timestamp=datetime(2014, 7, 15, tzinfo=timezone.utc))
+        # archive_timestamp can be pushed back by admins; such links stay in their creation month's AU
+        links.filter(pk=links.order_by('guid')[0].pk).update(archive_timestamp=datetime(2015, 1, 1, tzinfo=timezone.utc))
+        expected = [link.warc_storage_file().split('warcs/')[1] for link in Link.objects.visible_to_lockss().filter(pk__in=links).order_by('creation_timestamp', 'guid')]
+        self.assertGreater(len(expected), 3)
+        client = self.clients[0][0]
+
+        # by offset, as the deployed plugin requests them
+        found = []
+        while True:
+            response = client.get('/lockss/search/?offset={}&creation_month=7&creation_year=2014&updates_since='.format(len(found)))
+            self.assertEqual(response.status_code, 200)
+            page = str(response.content, 'utf-8').split()
+            if not page:
+                break
+            found += page
+        self.assertEqual(found, expected)
+
+        # by following the cursor in each page's Link header
+        found = []
+        url = '/lockss/search/?creation_month=7&creation_year=2014'
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            found += str(response.content, 'utf-8').split()
+            url = response.get('Link', '').partition('>')[0].lstrip('<')
+        self.assertEqual(found, expected)
+
+    def test_config_conditional_get(self):
+        client = self.clients[0][0]
+        for url in ['/lockss/titledb.xml', '/lockss/daemon_settings.txt']:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            response = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            response = client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_config_rendered_once(self):
+        client = self.clients[0][0]
+        for url in ['/lockss/titledb.xml', '/lockss/daemon_settings.txt']:
+            with patch('lockss.views.render_to_string', wraps=render_to_string) as render:
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+                # unchanged manifest: neither a 304 nor a full response renders it again
+                self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+                self.assertEqual(client.get(url).content, response.content)
+            self.assertLessEqual(render.call_count, 1)
+
+    def test_titledb_counts(self):
+        links = Link.objects.filter(creation_timestamp__year=2014, creation_timestamp__month=7)
+        links.update(cached_can_play_back=True, warc_size=10)
+        count = Link.objects.visible_to_lockss().filter(pk__in=links).count()
+        response = self.clients[0][0].get('/lockss/titledb.xml')
+        au = str(response.content, 'utf-8').split('Perma.cc Captures For 2014-07')[1].split('</property>\n\n')[0]
+        self.assertIn('<property name="attributes.linkCount" value="{}" />'.format(count), au)
+        self.assertIn('<property name="attributes.totalBytes" value="{}" />'.format(count * 10), au)
+
+    def test_daemon_settings_follow_mirrors(self):
+        client = self.clients[0][0]
+        response = client.get('/lockss/daemon_settings.txt')
+        Mirror(name='New Mirror', ip='203.0.113.5', hostname='new.example.com', content_url='https://new.example.com:8080/').save()
+        new_response = client.get('/lockss/daemon_settings.txt', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(new_response.status_code, 200)
+        self.assertIn('TCP:[203.0.113.5]:9729', str(new_response.content, 'utf-8'))
+
     def test_permission(self):
         for (client, status_code) in self.clients:
             response = client.get('/lockss/permission/')
@@ -33,3 +114,38 @@ class LockssTestCase(PermaTestCase):
         for (client, status_code) in self.clients:
             response = client.get('/lockss/fetch/3S/LN/JH/3SLN-JHX9.warc.gz')
             self.assertEqual(response.status_code, status_code)
+
+    def test_fetch_conditional_and_range(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = FileSystemMediaStorage(location=media_root.name)
+        patcher = patch('lockss.views.default_storage', storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        warc = b'warc contents' * 100
+        link = Link.objects.get(pk='3SLN-JHX9')
+        with storage.open_for_streaming(link.warc_storage_file(), send_signal=False) as f:
+            f.write(warc)
+        client = self.clients[0][0]
+        url = '/lockss/fetch/3S/LN/JH/3SLN-JHX9.warc.gz'
+
+        # without a stored digest, the ETag is weak, so ranges can't be made conditional on it
+        response = client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), warc)
+        self.assertEqual(int(response['Content-Length']), len(warc))
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=response['ETag']).status_code, 200)
+
+        link.warc_size = len(warc)
+        link.warc_digest = hashlib.sha256(warc).hexdigest()
+        link.save()
+        response = client.get(url)
+        etag = response['ETag']
+        self.assertEqual(etag, '"{}"'.format(link.warc_digest))
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(len(warc)))
+        self.assertEqual(b''.join(response.streaming_content), warc[10:20])
@@ -1,18 +1,24 @@
 from urllib.parse import urljoin
-from wsgiref.util import FileWrapper
-from datetime import datetime, date
+from datetime import datetime, timezone as dt_timezone
 from dateutil.relativedelta import relativedelta
+import hashlib
+import json
 import logging
 
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
-from django.http import HttpResponse, HttpResponseBadRequest, Http404, StreamingHttpResponse, HttpResponseForbidden
-from django.shortcuts import get_object_or_404, render
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseForbidden
+from django.db.models import Q
+from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 from perma.models import Link
-from perma.utils import get_client_ip
-from .models import Mirror
+from perma.utils import byte_range_response, get_client_ip
+from .models import Mirror, get_manifest
 
 logger = logging.getLogger(__name__)
 
@@ -38,14 +44,35 @@ def allow_by_ip(view_func):
 
 ### VIEWS ###
 
+SEARCH_PAGE_SIZE = 1000
+SEARCH_CURSOR_CACHE_KEY = 'lockss-search-cursor:{}:{}:{}:{}'
+
+def format_search_cursor(creation_timestamp, guid):
+    return f"{creation_timestamp.isoformat()},{guid}"
+
+def parse_search_cursor(cursor):
+    creation_timestamp, guid = cursor.rsplit(',', 1)
+    return datetime.fromisoformat(creation_timestamp), guid
+
+
 @allow_by_ip
 def search(request):
-    updates = Link.objects.visible_to_lockss().order_by('archive_timestamp')
+    """
+        List the WARCs in an Archival Unit, SEARCH_PAGE_SIZE at a time, in (creation_timestamp, guid) order:
+        the order of the link_lockss_search index, so each page is read straight from the index.
+
+        Pages are fetched by keyset: pass the `after` cursor from the previous page's Link header.
+        The deployed LOCKSS plugin pages with `offset` instead; we remember where each page ended,
+        so that sequential offset requests are answered by keyset too, and only fall back to
+        OFFSET if the cursor has expired from the cache.
+    """
+    updates = Link.objects.visible_to_lockss()
 
     # apply from_date
-    if 'updates_since' in request.GET:
+    updates_since = request.GET.get('updates_since', '')
+    if updates_since:
         try:
-            from_date = datetime.utcfromtimestamp(int(request.GET['updates_since']))
+            from_date = datetime.utcfromtimestamp(int(updates_since)).replace(tzinfo=dt_timezone.utc)
         except ValueError:
             return HttpResponseBadRequest("updates_since must be an integer and a valid timestamp.")
         updates = updates.filter(archive_timestamp__gte=from_date)
@@ -54,23 +81,55 @@ def search(request):
     try:
         month = int(request.GET['creation_month'])
         year = int(request.GET['creation_year'])
+        month_start = datetime(year, month, 1, tzinfo=dt_timezone.utc)
     except (KeyError, ValueError):
         return HttpResponseBadRequest("creation_month and creation_year must be integers.")
-    updates = updates.filter(creation_timestamp__year=year, creation_timestamp__month=month)
+    month_end = month_start + relativedelta(months=1)
+    updates = updates.filter(
+        creation_timestamp__gte=month_start,
+        creation_timestamp__lt=month_end,
+    ).order_by('creation_timestamp', 'guid')
 
-    # apply offset
+    # find where this page starts
     try:
         offset = int(request.GET.get('offset', 0))
     except ValueError:
         return HttpResponseBadRequest("offset must be an integer.")
-    updates = updates[offset:offset+1000]
+    cursor_cache_key = SEARCH_CURSOR_CACHE_KEY.format(year, month, updates_since, '{}')
+    if 'after' in request.GET:
+        try:
+            after = parse_search_cursor(request.GET['after'])
+        except ValueError:
+            return HttpResponseBadRequest("after must be a cursor from a previous page of results.")
+    elif offset:
+        after = cache.get(cursor_cache_key.format(offset))
+    else:
+        after = None
+    if after:
+        after_timestamp, after_guid = after
+        updates = updates.filter(
+            # redundant with the Q()s, but lets the index scan start at the cursor
+            creation_timestamp__gte=after_timestamp,
+        ).filter(
+            Q(creation_timestamp__gt=after_timestamp) |
+            Q(creation_timestamp=after_timestamp, guid__gt=after_guid)
+        )[:SEARCH_PAGE_SIZE]
+    else:
+        updates = updates[offset:offset+SEARCH_PAGE_SIZE]
 
     # export file names
-    files_to_index = []
-    for update in updates:
-        files_to_index.append(update.warc_storage_file().split(settings.WARC_STORAGE_DIR+'/')[1])
+    page = list(updates.values_list('creation_timestamp', 'guid'))
+    response = HttpResponse("\n".join(Link.warc_path_for_guid(guid) for _, guid in page), content_type="text/plain")
 
-    return HttpResponse("\n".join(files_to_index), content_type="text/plain")
+    if len(page) == SEARCH_PAGE_SIZE:
+        next_cursor = page[-1]
+        if 'after' not in request.GET:
+            cache.set(cursor_cache_key.format(offset + SEARCH_PAGE_SIZE), next_cursor, settings.LOCKSS_SEARCH_CURSOR_CACHE_TIMEOUT)
+        params = request.GET.copy()
+        params.pop('offset', None)
+        params['after'] = format_search_cursor(*next_cursor)
+        response['Link'] = f'<{request.path}?{params.urlencode()}>; rel="next"'
+    return response
 
 
 @allow_by_ip
@@ -80,12 +139,18 @@ def fetch_warc(request, path, guid):
     if path.rstrip('/') != link.guid_as_path() or link.archive_timestamp is None or link.archive_timestamp > timezone.now():
         raise Http404
 
-    # deliver warc file
-    with default_storage.open(link.warc_storage_file()) as file:
-        response = StreamingHttpResponse(FileWrapper(file, 1024 * 8),
-                                         content_type="application/gzip")
-        response['Content-Disposition'] = f"attachment; filename={link.guid}.warc.gz"
-        return response
+    # deliver warc file, or the requested part of it, unless the mirror's copy is already current
+    warc_path = link.warc_storage_file()
+    size = link.warc_size or default_storage.size(warc_path)
+    # without a stored digest, we can't promise byte-for-byte identity
+    etag = f'"{link.warc_digest}"' if link.warc_digest else f'W/"{link.guid}-{size}"'
+    return byte_range_response(
+        request,
+        size,
+        etag,
+        lambda first, last: default_storage.iter_file_range(warc_path, first, last - first + 1),
+        f"{link.guid}.warc.gz",
+    )
 
 
 @allow_by_ip
@@ -93,19 +158,41 @@ def permission(request):
     return HttpResponse("LOCKSS system has permission to collect, preserve, and serve this open access Archival Unit")
 
 
+CONFIG_CACHE_KEY = 'lockss-config:{}'
+
+def config_response(request, manifest, template_name, context, content_type=None):
+    """
+        Render a LOCKSS config file from the manifest's mirrors and Archival Units, plus the
+        per-request `context`, with the ETag and Last-Modified headers that let polling mirrors
+        get a 304 when nothing has changed.
+
+        The ETag comes from the manifest's version, so 304s are sent without rendering anything,
+        and rendered files are cached until the manifest changes.
+    """
+    version = hashlib.md5(f"{template_name}:{manifest['version']}:{json.dumps(context, sort_keys=True)}".encode()).hexdigest()
+    etag = quote_etag(version)
+    last_modified = int(manifest['generated'].timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        cache_key = CONFIG_CACHE_KEY.format(version)
+        content = cache.get(cache_key)
+        if content is None:
+            content = render_to_string(template_name, {
+                'archival_units': manifest['archival_units'],
+                'mirrors': manifest['mirrors'],
+                **context,
+            })
+            cache.set(cache_key, content, settings.LOCKSS_MANIFEST_CACHE_TIMEOUT)
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
 @allow_by_ip
 def titledb(request):
-    # build list of all year/month combos since we started, in the form [[2014, "01"],[2014, "02"],...]
-    first_archive_date = Link.objects.order_by('creation_timestamp')[0].creation_timestamp
-    start_month = date(year=first_archive_date.year, month=first_archive_date.month, day=1)
-    today = date.today()
-    archival_units = []
-    while start_month <= today:
-        archival_units.append([start_month.year, f'{start_month.month:02}'])
-        start_month += relativedelta(months=1)
-
-    return render(request, 'lockss/titledb.xml', {
-        'archival_units': archival_units,
+    manifest = get_manifest()
+    return config_response(request, manifest, 'lockss/titledb.xml', {
         'django_url_prefix': django_url_prefix(request),
     })
 
@@ -114,13 +201,13 @@ def titledb(request):
 def daemon_settings(request):
     """ Generate settings files for our PLN nodes. """
 
+    manifest = get_manifest()
     url_prefix = django_url_prefix(request)
     static_url_prefix = urljoin(url_prefix, settings.STATIC_URL)
 
-    return render(request, 'lockss/daemon_settings.txt', {
+    return config_response(request, manifest, 'lockss/daemon_settings.txt', {
         'django_url_prefix': url_prefix,
         'static_url_prefix': static_url_prefix,
-        'mirrors': list(Mirror.objects.filter(enabled=True)),
         'content_ips': settings.LOCKSS_CONTENT_IPS,
         'quorum': settings.LOCKSS_QUORUM,
         'crawl_interval': settings.LOCKSS_CRAWL_INTERVAL,
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0003_auto_20220120_1522'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='capturejob',
+            index=models.Index(condition=models.Q(status='pending'), fields=['human', 'order'], name='capture_job_pending_queue'),
+        ),
+        migrations.AddIndex(
+            model_name='capturejob',
+            index=models.Index(condition=models.Q(status='pending'), fields=['created_by', 'human', 'order'], name='capture_job_pending_by_user'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0004_capture_job_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='capturejob',
+            name='status',
+            field=models.CharField(choices=[('validating', 'validating'), ('pending', 'pending'), ('in_progress', 'in_progress'), ('completed', 'completed'), ('deleted', 'deleted'), ('failed', 'failed'), ('invalid', 'invalid')], db_index=True, default='invalid', max_length=15),
+        ),
+    ]
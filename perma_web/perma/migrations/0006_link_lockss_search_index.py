@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0005_capture_job_validating_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='link',
+            index=models.Index(condition=models.Q(cached_can_play_back=True), fields=['creation_timestamp', 'guid'], name='link_lockss_search'),
+        ),
+    ]
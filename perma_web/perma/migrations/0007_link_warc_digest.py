@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0006_link_lockss_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicallink',
+            name='warc_digest',
+            field=models.CharField(blank=True, help_text='SHA-256 of the stored warc, used as its ETag when mirrors fetch it.', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='warc_digest',
+            field=models.CharField(blank=True, help_text='SHA-256 of the stored warc, used as its ETag when mirrors fetch it.', max_length=64, null=True),
+        ),
+    ]
@@ -8,11 +8,9 @@ import os
 import logging
 import random
 import re
-import socket
 from urllib.parse import urlparse
 import simple_history
 import requests
-import itertools
 import time
 import hmac
 import uuid
@@ -25,9 +23,12 @@ from simple_history.models import HistoricalRecords
 import django.contrib.auth.models
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser
 from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.core.exceptions import ValidationError
 from django.core.files.storage import default_storage
-from django.db import models, transaction
-from django.db.models import Q, Max, Count
+from django.core.validators import URLValidator
+from django.db import connection, models, transaction
+from django.db.models import Q, Max, Count, Exists, OuterRef
 from django.db.models.functions import Now
 from django.db.models.query import QuerySet
 from django.utils import timezone
@@ -45,7 +46,8 @@ from .utils import (Sec1TLSAdapter, tz_datetime,
     pp_date_from_post,
     first_day_of_next_month, today_next_year, preserve_perma_warc,
     write_resource_record_from_asset, get_wr_session_cookie,
-    clear_wr_session, query_wr_api, user_agent_for_domain)
+    clear_wr_session, query_wr_api, user_agent_for_domain, ip_in_allowed_ip_range,
+    link_validation_adapters, resolve_host, host_unreachable_reason, mark_host_unreachable, warc_index_paths)
 
 
 logger = logging.getLogger(__name__)
@@ -54,6 +56,17 @@ logger = logging.getLogger(__name__)
 ACTIVE_SUBSCRIPTION_STATUSES = ['Current', 'Cancellation Requested']
 PROBLEM_SUBSCRIPTION_STATUSES = ['Hold']
 
+# WR session used by Link.warm_wr_collection, shared by all workers
+WR_WARMING_SESSION_CACHE_KEY = 'wr-warming-session-cookie'
+
+# the parts of the single_permalink view that are the same for every user; see Link.get_permalink_context
+PERMALINK_CONTEXT_CACHE_KEY = 'permalink-context:{guid}:{version}'
+PERMALINK_CONTEXT_VERSION_CACHE_KEY = 'permalink-context-version:{guid}'
+
+# the links visible to Memento for each SURT; see Link.get_mementos
+MEMENTOS_CACHE_KEY = 'mementos:{surt_hash}:{version}'
+MEMENTOS_VERSION_CACHE_KEY = 'mementos-version:{surt_hash}'
+
 FIELDS_REQUIRED_FROM_PERMA_PAYMENTS = {
     'get_subscription': [
         'customer_pk',
@@ -117,6 +130,26 @@ def subscription_is_active(subscription):
 def subscription_has_problem(subscription):
     return subscription and subscription['status'] in PROBLEM_SUBSCRIPTION_STATUSES
 
+def get_cache_version(version_key, timeout):
+    """
+        Get the current version of a group of cache entries, starting one if there is none.
+        Returns None if the cache is unavailable.
+
+        Read the version before the database, so that a save made while an entry is being
+        built leaves that entry under a stale version.
+    """
+    version = django_cache.get(version_key)
+    if version is None:
+        django_cache.add(version_key, uuid.uuid4().hex, timeout)
+        version = django_cache.get(version_key)
+    return version
+
+def new_cache_version(version_key, timeout):
+    """
+        Start a new version of a group of cache entries, leaving the old entries to expire.
+    """
+    django_cache.set(version_key, uuid.uuid4().hex, timeout)
+
 
 # classes
 
@@ -1368,6 +1401,7 @@ class Link(DeletableModel):
     bonus_link = models.BooleanField(null=True, blank=True)
 
     warc_size = models.IntegerField(blank=True, null=True)
+    warc_digest = models.CharField(max_length=64, blank=True, null=True, help_text="SHA-256 of the stored warc, used as its ETag when mirrors fetch it.")
     cached_can_play_back = models.BooleanField(
         null=True,
         default=None,
@@ -1400,6 +1434,8 @@ class Link(DeletableModel):
             models.Index(fields=['user_deleted', 'is_private', 'is_unlisted', 'cached_can_play_back', 'internet_archive_upload_status']),
             models.Index(fields=['creation_timestamp']),
             models.Index(fields=['submitted_url_surt']),
+            # lockss.views.search: filter by creation month, keyset paginate by (creation_timestamp, guid)
+            models.Index(fields=['creation_timestamp', 'guid'], name='link_lockss_search', condition=Q(cached_can_play_back=True)),
         ]
 
     DISCOVERABLE_FILTER = Q(is_unlisted=False, is_private=False)
@@ -1410,6 +1446,9 @@ class Link(DeletableModel):
         return self.archive_timestamp < timezone.now() and not self.user_deleted
 
     def has_successful_capture(self):
+        # use the captures loaded by prefetch_related('captures'), if any
+        if 'captures' in getattr(self, '_prefetched_objects_cache', {}):
+            return any(capture.role in ('primary', 'screenshot') and capture.status == 'success' for capture in self.captures.all())
         return self.captures.filter(Capture.CAN_PLAY_BACK_FILTER).exists()
 
     def is_visible_to_memento(self):
@@ -1431,41 +1470,56 @@ class Link(DeletableModel):
     def url_details(self):
         return urlparse(self.ascii_safe_url)
 
+    @cached_property
+    def host(self):
+        return self.url_details.netloc.split(':')[0]
+
     @cached_property
     def ip(self):
-        try:
-            return socket.gethostbyname(self.url_details.netloc.split(':')[0])
-        except socket.gaierror:
-            return False
+        return resolve_host(self.host)
 
     @cached_property
     def headers(self):
+        if host_unreachable_reason(self.host):
+            return False
+        s = requests.Session()
         try:
-            with requests.Session() as s:
-                # Break noisily if requests mediates anything but http and https
-                assert list(s.adapters.keys()) == ['https://', 'http://']
+            # Break noisily if requests mediates anything but http and https
+            assert list(s.adapters.keys()) == ['https://', 'http://']
 
+            if settings.PROXY_CAPTURES and any(domain in self.url_details.netloc for domain in settings.DOMAINS_TO_PROXY):
                 # Lower our standards for the required TLS security level
                 s.mount('https://', Sec1TLSAdapter())
-
-                if settings.PROXY_CAPTURES and any(domain in self.url_details.netloc for domain in settings.DOMAINS_TO_PROXY):
-                    password = self.guid if self.guid else secrets.token_urlsafe()
-                    s.proxies = {
-                        'http': f'socks5://user:{password}@{settings.PROXY_ADDRESS}', 'https': f'socks5://user:{password}@{settings.PROXY_ADDRESS}'}
-                request = requests.Request(
-                    'GET',
-                    self.ascii_safe_url,
-                    headers={'User-Agent': user_agent_for_domain(self.url_details.netloc), **settings.CAPTURE_HEADERS}
-                )
-                response = s.send(
-                    request.prepare(),
-                    timeout=settings.RESOURCE_LOAD_TIMEOUT,
-                    stream=True  # we're only looking at the headers
-                )
-                response.close()
-                return response.headers
-        except (requests.ConnectionError, requests.Timeout, requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL):
-            # ConectionError and Timeout are self-explanatory.
+                password = self.guid if self.guid else secrets.token_urlsafe()
+                s.proxies = {
+                    'http': f'socks5://user:{password}@{settings.PROXY_ADDRESS}', 'https': f'socks5://user:{password}@{settings.PROXY_ADDRESS}'}
+            else:
+                # Reuse connections from a pool shared by all checks in this process.
+                # (Not closing this session when we're done leaves the shared pool open.)
+                for prefix, adapter in link_validation_adapters().items():
+                    s.mount(prefix, adapter)
+            request = requests.Request(
+                'GET',
+                self.ascii_safe_url,
+                headers={'User-Agent': user_agent_for_domain(self.url_details.netloc), **settings.CAPTURE_HEADERS}
+            )
+            response = s.send(
+                request.prepare(),
+                timeout=settings.LINK_VALIDATION_TIMEOUT,
+                stream=True  # we're only looking at the headers
+            )
+            response.close()
+            return response.headers
+        except requests.ConnectionError as e:
+            # Couldn't connect at all (including ConnectTimeout):
+            # let other links to this host fail fast, rather than waiting out the same timeout
+            if not s.proxies and urlparse(e.request.url if e.request else self.ascii_safe_url).hostname == self.host:
+                mark_host_unreachable(self.host, 'connection')
+            return False
+        except requests.Timeout:
+            # The host accepted the connection, but this page was slow to respond: that's no reason to reject other links
+            return False
+        except (requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL):
             # InvalidSchema is raised if the retrieved URL uses a protocol not handled by
             # requests' adapters (https://github.com/psf/requests/blob/master/requests/sessions.py#L419).
             # While we can validate the target URL in advance, it may redirect to any arbitrary schema,
@@ -1475,41 +1529,27 @@ class Link(DeletableModel):
             # We return False, to indicate in all cases that we did not successfully retrieve
             # any headers, rather than propagating the exception.
             return False
+        finally:
+            if s.proxies:
+                s.close()
 
     def get_default_title(self):
         return self.url_details.netloc
 
-    def save(self, *args, **kwargs):
+    def set_defaults(self, new_guid=None):
+        """
+            Fill in the fields save() derives from the others. If `new_guid` is given, this is a new link:
+            it gets that GUID, and its archive timestamp.
+            Also used for links created in bulk, which skip save().
+        """
         # Set a default title if one is missing
         if not self.submitted_title:
             self.submitted_title = self.get_default_title()
 
-        initial_folder = kwargs.pop('initial_folder', None)
-
-        if not self.pk:
+        if new_guid:
+            self.guid = new_guid
             if not self.archive_timestamp:
                 self.archive_timestamp = self.creation_timestamp + settings.ARCHIVE_DELAY
-            if not kwargs.pop("pregenerated_guid", False):
-                # not self.pk => not created yet
-                # only try 100 attempts at finding an unused GUID
-                # (100 attempts should never be necessary, since we'll expand the keyspace long before
-                # there are frequent collisions)
-                r = random.SystemRandom()
-                for i in range(100):
-                    # Generate an 8-character random string like "1A2B3C4D"
-                    guid = ''.join(r.choice(self.GUID_CHARACTER_SET) for _ in range(8))
-
-                    # apply standard formatting (hyphens)
-                    guid = Link.get_canonical_guid(guid)
-
-                    # Avoid GUIDs starting with four letters (in case we need those later)
-                    match = re.search(r'^[A-Z]{4}', guid)
-
-                    if not match and not Link.objects.filter(guid=guid).exists():
-                        break
-                else:
-                    raise Exception("No valid GUID found in 100 attempts.")
-                self.guid = guid
 
         if not self.submitted_url_surt:
             self.submitted_url_surt = surt.surt(self.submitted_url)
@@ -1517,6 +1557,15 @@ class Link(DeletableModel):
         if self.is_private and not self.private_reason:
             self.private_reason = 'user'
 
+    def save(self, *args, **kwargs):
+        initial_folder = kwargs.pop('initial_folder', None)
+
+        new_guid = None
+        if not self.pk:
+            # not self.pk => not created yet
+            new_guid = self.guid if kwargs.pop("pregenerated_guid", False) else Link.generate_guids()[0]
+        self.set_defaults(new_guid)
+
         super(Link, self).save(*args, **kwargs)
 
         if not self.folders.count():
@@ -1529,6 +1578,63 @@ class Link(DeletableModel):
     def __str__(self):
         return self.guid
 
+    @classmethod
+    def generate_guids(cls, count=1):
+        """
+            Return a list of `count` new, unused GUIDs, checking candidates against the database together.
+        """
+        r = random.SystemRandom()
+        guids = set()
+        # only try 100 rounds of finding unused GUIDs
+        # (100 attempts should never be necessary, since we'll expand the keyspace long before
+        # there are frequent collisions)
+        for i in range(100):
+            candidates = set()
+            while len(guids) + len(candidates) < count:
+                # Generate an 8-character random string like "1A2B3C4D"
+                guid = ''.join(r.choice(cls.GUID_CHARACTER_SET) for _ in range(8))
+
+                # apply standard formatting (hyphens)
+                guid = cls.get_canonical_guid(guid)
+
+                # Avoid GUIDs starting with four letters (in case we need those later)
+                match = re.search(r'^[A-Z]{4}', guid)
+
+                if not match and guid not in guids:
+                    candidates.add(guid)
+            guids |= candidates - set(cls.objects.filter(guid__in=candidates).values_list('guid', flat=True))
+            if len(guids) == count:
+                return list(guids)
+        raise Exception("No valid GUID found in 100 attempts.")
+
+    def submitted_url_error(self, check_target=True):
+        """
+            Check that submitted_url is a URL we can capture, returning a message describing the problem if not.
+            If check_target is True, the URL's domain is looked up and its headers loaded, which can be slow.
+        """
+        try:
+            validate = URLValidator()
+            validate(self.ascii_safe_url)
+            if check_target:
+                if not self.ip:
+                    return "Couldn't resolve domain."
+                if not ip_in_allowed_ip_range(self.ip):
+                    return "Not a valid IP."
+                if not self.headers:
+                    return "Couldn't load URL."
+                # preemptively reject URLs that report a size over settings.MAX_ARCHIVE_FILE_SIZE
+                try:
+                    if int(self.headers.get('content-length', 0)) > settings.MAX_ARCHIVE_FILE_SIZE:
+                        return f"Target page is too large (max size {settings.MAX_ARCHIVE_FILE_SIZE / 1024 / 1024}MB)."
+                except ValueError:
+                    # content-length header wasn't an integer. Carry on.
+                    pass
+        except ValidationError:
+            return "Not a valid URL."
+        except requests.TooManyRedirects:
+            return "URL caused a redirect loop."
+        return None
+
     @classmethod
     def get_canonical_guid(self, guid):
         """
@@ -1562,25 +1668,51 @@ class Link(DeletableModel):
         # add it back to the given folder
         if folder:
             self.folders.add(folder)
-            if not folder.organization:
-                self.organization = None
-            else:
-                self.organization = folder.organization
-            if self.bonus_link and (folder.organization or folder.sponsored_by):
-                self.bonus_link = False
+            if self.assign_to_folder(folder):
                 user.bonus_links = user.bonus_links + 1
 
             self.save(update_fields=['organization', 'bonus_link'])
             user.save(update_fields=['bonus_links'])
 
-    def guid_as_path(self):
+    def assign_to_folder(self, folder):
+        """
+            Set the organization this link belongs to, and whether it's a bonus link, from its folder.
+            A bonus link put somewhere it doesn't count against its creator's quota stops being one:
+            return True if so, so the creator can get the bonus link back. Doesn't save the link.
+        """
+        self.organization = folder.organization
+        if self.bonus_link and (folder.organization or folder.sponsored_by):
+            self.bonus_link = False
+            return True
+        return False
+
+    @staticmethod
+    def path_for_guid(guid):
         # For a GUID like ABCD-1234, return a path like AB/CD/12.
-        stripped_guid = re.sub('[^0-9A-Za-z]+', '', self.guid)
+        stripped_guid = re.sub('[^0-9A-Za-z]+', '', guid)
         guid_parts = [stripped_guid[i:i + 2] for i in range(0, len(stripped_guid), 2)]
         return '/'.join(guid_parts[:-1])
 
+    @classmethod
+    def warc_path_for_guid(cls, guid):
+        # The WARC's path relative to WARC_STORAGE_DIR, computed without loading the Link.
+        return f'{cls.path_for_guid(guid)}/{guid}.warc.gz'
+
+    def guid_as_path(self):
+        return self.path_for_guid(self.guid)
+
     def warc_storage_file(self):
-        return os.path.join(settings.WARC_STORAGE_DIR, self.guid_as_path(), f'{self.guid}.warc.gz')
+        return os.path.join(settings.WARC_STORAGE_DIR, self.warc_path_for_guid(self.guid))
+
+    def cdxj_storage_file(self):
+        return warc_index_paths(self.warc_storage_file())[0]
+
+    def pages_storage_file(self):
+        return warc_index_paths(self.warc_storage_file())[1]
+
+    def warc_pages(self):
+        """ The pages to list in the index saved beside this link's warc; see preserve_perma_warc. """
+        return [{'url': self.submitted_url, 'title': self.submitted_title, 'timestamp': self.creation_timestamp}]
 
     # def get_thumbnail(self, image_data=None):
     #     if self.thumbnail_status == 'failed' or self.thumbnail_status == 'generating':
@@ -1657,17 +1789,38 @@ class Link(DeletableModel):
         except CaptureJob.DoesNotExist:
             pass
 
+    @cached_property
+    def captures_by_role(self):
+        """
+            This link's first capture of each role, all loaded at once. Uses the captures
+            loaded by prefetch_related('captures'), if any, instead of querying again.
+            Saving a Capture of this link clears it; see clear_cached_captures.
+        """
+        captures = {}
+        for capture in sorted(self.captures.all(), key=lambda capture: capture.pk):
+            captures.setdefault(capture.role, capture)
+        return captures
+
     @cached_property
     def screenshot_capture(self):
-        return self.captures.filter(role='screenshot').first()
+        return self.captures_by_role.get('screenshot')
 
     @cached_property
     def primary_capture(self):
-        return self.captures.filter(role='primary').first()
+        return self.captures_by_role.get('primary')
 
     @cached_property
     def favicon_capture(self):
-        return self.captures.filter(role='favicon').first()
+        return self.captures_by_role.get('favicon')
+
+    def clear_cached_captures(self):
+        """
+            Forget the captures loaded by captures_by_role and prefetch_related('captures'),
+            so that captures created or changed since are seen.
+        """
+        for attr in ('captures_by_role', 'primary_capture', 'screenshot_capture', 'favicon_capture'):
+            self.__dict__.pop(attr, None)
+        getattr(self, '_prefetched_objects_cache', {}).pop('captures', None)
 
     def write_uploaded_file(self, uploaded_file, cache_break=False):
         """
@@ -1692,12 +1845,14 @@ class Link(DeletableModel):
                           user_upload='True',
                           content_type=mime_type,
                           url=warc_url)
-        warc_size = []  # pass a mutable container to the context manager, so that it can populate it with the size of the finished warc
-        with preserve_perma_warc(self.guid, self.creation_timestamp, self.warc_storage_file(), warc_size) as warc:
+        warc_size = []  # pass mutable containers to the context manager, so that it can populate them with the size and digest of the finished warc
+        warc_digest = []
+        with preserve_perma_warc(self.guid, self.creation_timestamp, self.warc_storage_file(), warc_size, self.warc_pages(), warc_digest) as warc:
             uploaded_file.file.seek(0)
             write_resource_record_from_asset(uploaded_file.file.read(), warc_url, mime_type, warc)
         self.warc_size = warc_size[0]
-        self.save(update_fields=['warc_size'])
+        self.warc_digest = warc_digest[0]
+        self.save(update_fields=['warc_size', 'warc_digest'])
         capture.save()
 
     def safe_delete_warc(self):
@@ -1748,6 +1903,72 @@ class Link(DeletableModel):
         # Trust our records (the metadata) more than has_warc
         return successful_metadata
 
+    @classmethod
+    def get_permalink_context(cls, guid):
+        """
+            Get the parts of the single_permalink view's context that are the same for every user:
+            the link, with its organization, capture job, and captures loaded, and whether
+            it can be played back or shown to Memento clients.
+            Keep result in cache, until the link, its captures, or its capture job are next saved.
+
+            The link's organization and registrar are loaded fresh each time: moving a folder
+            changes its links' organization without saving them, and organizations and
+            registrars are edited without touching their links.
+
+            Raises Link.DoesNotExist if there is no link with this guid.
+        """
+        version = get_cache_version(PERMALINK_CONTEXT_VERSION_CACHE_KEY.format(guid=guid), settings.PERMALINK_CONTEXT_CACHE_TIMEOUT)
+        cache_key = PERMALINK_CONTEXT_CACHE_KEY.format(guid=guid, version=version)
+
+        context = django_cache.get(cache_key) if version else None
+        if context is None:
+            link = cls.objects.all_with_deleted().select_related('capture_job').prefetch_related('captures').get(guid=guid)
+            # load the captures, so they are cached along with the link
+            link.captures_by_role  # noqa
+            context = {
+                'link': link,
+                'can_play_back': link.can_play_back(),
+                'is_visible_to_memento': link.is_visible_to_memento(),
+            }
+            if version:
+                django_cache.set(cache_key, context, settings.PERMALINK_CONTEXT_CACHE_TIMEOUT)
+        link = context['link']
+        link.organization = Organization.objects.all_with_deleted().select_related('registrar').filter(links=link).first()
+        return context
+
+    @staticmethod
+    def invalidate_permalink_context(guid):
+        new_cache_version(PERMALINK_CONTEXT_VERSION_CACHE_KEY.format(guid=guid), settings.PERMALINK_CONTEXT_CACHE_TIMEOUT)
+
+    # changes to these fields can add a link to, or remove it from, the mementos of its SURT
+    MEMENTO_VISIBILITY_FIELDS = ('submitted_url_surt', 'is_private', 'is_unlisted', 'cached_can_play_back', 'user_deleted')
+
+    @classmethod
+    def get_mementos(cls, submitted_url_surt):
+        """
+            Get (creation_timestamp, guid) for each link with this SURT that is visible to Memento, in order.
+            Keep result in cache, until the next time one of those links is shown or hidden.
+        """
+        surt_hash = hashlib.sha256(submitted_url_surt.encode()).hexdigest()
+        version = get_cache_version(MEMENTOS_VERSION_CACHE_KEY.format(surt_hash=surt_hash), settings.MEMENTOS_CACHE_TIMEOUT)
+        cache_key = MEMENTOS_CACHE_KEY.format(surt_hash=surt_hash, version=version)
+
+        mementos = django_cache.get(cache_key) if version else None
+        if mementos is None:
+            mementos = list(cls.objects.visible_to_memento()
+                            .filter(submitted_url_surt=submitted_url_surt)
+                            .order_by('creation_timestamp', 'guid')
+                            .values_list('creation_timestamp', 'guid'))
+            if version:
+                django_cache.set(cache_key, mementos, settings.MEMENTOS_CACHE_TIMEOUT)
+        return mementos
+
+    @staticmethod
+    def invalidate_mementos(submitted_url_surt):
+        if submitted_url_surt:
+            surt_hash = hashlib.sha256(submitted_url_surt.encode()).hexdigest()
+            new_cache_version(MEMENTOS_VERSION_CACHE_KEY.format(surt_hash=surt_hash), settings.MEMENTOS_CACHE_TIMEOUT)
+
     ###
     ### Methods for playback via Webrecorder
     ###
@@ -1773,18 +1994,10 @@ class Link(DeletableModel):
 
         If the collection already exists, this method is a no-op.
         """
-        json = {
-            'title': self.wr_collection_slug,
-            'external': True
-        }
-
         if self.is_private:
             session_key = 'wr_private_session_cookie'
         else:
             session_key = 'wr_public_session_cookie'
-            json['username'] = settings.WR_PERMA_USER
-            json['password'] = settings.WR_PERMA_PASSWORD
-            json['public'] = True
 
         # If a visitor has a usable WR session already, reuse it.
         # If they don't, WR will start a fresh session and will return
@@ -1793,13 +2006,7 @@ class Link(DeletableModel):
         wr_session_cookie = get_wr_session_cookie(request, session_key)
 
         logger.debug(f"{self.guid}: Getting session")
-        response, data = query_wr_api(
-            method='post',
-            path='/auth/ensure_login',
-            cookie=wr_session_cookie,
-            json=json,
-            valid_if=lambda code, data: code == 200 and all(key in data for key in {'username', 'coll_empty'})
-        )
+        response, data = self.ensure_wr_login(wr_session_cookie)
 
         new_session_cookie = response.cookies.get('__wr_sesh')
         if new_session_cookie:
@@ -1823,6 +2030,53 @@ class Link(DeletableModel):
 
         return data['username']
 
+    def ensure_wr_login(self, wr_session_cookie):
+        """
+        Log in to Webrecorder, for playback of this link: as Perma's public user for
+        public links, or else as a temporary user. Returns the response and its data,
+        which includes the WR username and whether this link's collection is empty.
+        """
+        json = {
+            'title': self.wr_collection_slug,
+            'external': True
+        }
+        if not self.is_private:
+            json['username'] = settings.WR_PERMA_USER
+            json['password'] = settings.WR_PERMA_PASSWORD
+            json['public'] = True
+
+        return query_wr_api(
+            method='post',
+            path='/auth/ensure_login',
+            cookie=wr_session_cookie,
+            json=json,
+            valid_if=lambda code, data: code == 200 and all(key in data for key in {'username', 'coll_empty'})
+        )
+
+    def warm_wr_collection(self):
+        """
+        Upload a public Perma Link's warc to its Webrecorder collection ahead of playback,
+        unless it's already there, so that the next visitor doesn't wait for the upload.
+        Returns True if the warc was uploaded.
+
+        Private Perma Links are played back from per-visitor collections, and can't be warmed.
+        """
+        if self.is_private:
+            return False
+
+        wr_session_cookie = django_cache.get(WR_WARMING_SESSION_CACHE_KEY)
+        response, data = self.ensure_wr_login(wr_session_cookie)
+        new_session_cookie = response.cookies.get('__wr_sesh')
+        if new_session_cookie:
+            wr_session_cookie = new_session_cookie
+            django_cache.set(WR_WARMING_SESSION_CACHE_KEY, wr_session_cookie, settings.WR_COOKIE_PERMITTED_AGE)
+
+        if not data['coll_empty']:
+            return False
+        logger.debug(f"{self.guid}: Warming WR collection for {data['username']}")
+        self.upload_to_wr(data['username'], wr_session_cookie)
+        return True
+
     def upload_to_wr(self, wr_username, wr_session_cookie):
         warc_path = self.warc_storage_file()
         upload_data = None
@@ -1839,22 +2093,27 @@ class Link(DeletableModel):
                 valid_if=lambda code, data: code == 200 and data.get('upload_id')
             )
 
-        # wait for WR to finish uploading the WARC
+        # wait for WR to finish uploading the WARC:
+        # WR holds each status request open until the upload is done, or `wait` seconds pass
         while True:
             logger.debug(f"{self.guid}: Waiting for WR to be ready.")
-            if time.time() - start_time > settings.WR_REPLAY_UPLOAD_TIMEOUT:
+            time_left = settings.WR_REPLAY_UPLOAD_TIMEOUT - (time.time() - start_time)
+            if time_left <= 0:
                 raise WebrecorderException("Upload timed out; check Webrecorder logs.")
 
+            request_start_time = time.time()
             _, upload_data = query_wr_api(
                 method='get',
-                path=f'/upload/{upload_data.get("upload_id")}?user={wr_username}',
+                path=f'/upload/{upload_data.get("upload_id")}?user={wr_username}&wait={min(time_left, settings.WR_UPLOAD_STATUS_WAIT):.1f}',
                 cookie=wr_session_cookie,
                 valid_if=lambda code, data: code == 200)
 
             if upload_data.get('done'):
                 break
 
-            time.sleep(0.5)
+            # if WR answered right away without waiting, don't hammer it
+            if time.time() - request_start_time < 0.5:
+                time.sleep(0.5)
 
     def delete_from_wr(self, request):
         """
@@ -1910,6 +2169,12 @@ class Capture(models.Model):
     def __str__(self):
         return f"{self.role} {self.status}"
 
+    def save(self, *args, **kwargs):
+        super(Capture, self).save(*args, **kwargs)
+        # keep the link this capture was created or loaded from current
+        if Capture.link.is_cached(self):
+            self.link.clear_cached_captures()
+
     def mime_type(self):
         """
             Return normalized mime type from content_type.
@@ -1945,7 +2210,7 @@ class CaptureJob(models.Model):
     link = models.OneToOneField(Link, related_name='capture_job', null=True, blank=True, on_delete=models.CASCADE)
     status = models.CharField(max_length=15,
                               default='invalid',
-                              choices=(('pending','pending'),('in_progress','in_progress'),('completed','completed'),('deleted','deleted'),('failed','failed'),('invalid', 'invalid')),
+                              choices=(('validating','validating'),('pending','pending'),('in_progress','in_progress'),('completed','completed'),('deleted','deleted'),('failed','failed'),('invalid', 'invalid')),
                               db_index=True)
     message = models.TextField(null=True, blank=True) #if we move to postgres, can be a json field
     human = models.BooleanField(default=False)
@@ -1967,47 +2232,89 @@ class CaptureJob(models.Model):
     TEST_PAUSE_TIME = 0
     TEST_ALLOW_RACE = False
 
+    class Meta:
+        indexes = [
+            # fair placement of new jobs in the queue; see save()
+            models.Index(fields=['human', 'order'], name='capture_job_pending_queue', condition=Q(status='pending')),
+            models.Index(fields=['created_by', 'human', 'order'], name='capture_job_pending_by_user', condition=Q(status='pending')),
+        ]
+
     def __str__(self):
         return f"CaptureJob {self.pk}: {self.link_id}"
 
     def save(self, *args, **kwargs):
 
         # If this job does not have an order yet (just created),
-        # examine all pending jobs to place this one in a fair position in the queue.
+        # examine the pending jobs to place this one in a fair position in the queue.
         # "Fair" means round robin: this job will be processed after every other job submitted by this user,
         # and then after every other user waiting in line has had at least one job done.
         if not self.order:
 
-            # get all pending jobs, in reverse priority order
-            pending_jobs = CaptureJob.objects.filter(status='pending', human=self.human).order_by('-order').select_related('link')
+            pending_jobs = CaptureJob.objects.filter(status='pending', human=self.human)
             # narrow down to just the jobs that come *after* the most recent job submitted by this user
-            pending_jobs = list(itertools.takewhile(lambda x: x.created_by_id != self.created_by_id, pending_jobs))
-            # flip the list of jobs back around to the order they'll be processed in
-            pending_jobs = list(reversed(pending_jobs))
+            last_own_order = pending_jobs.filter(created_by_id=self.created_by_id).aggregate(Max('order'))['order__max']
+            if last_own_order is not None:
+                pending_jobs = pending_jobs.filter(order__gt=last_own_order)
 
-            # Go through pending jobs until we find two jobs submitted by the same user.
+            # Find the first of those jobs that is another user's second job.
             # It's not fair for another user to run two jobs after all of ours are done,
             # so this new job should come right before that user's second job.
-            next_jobs = {}
-            last_job = None
-            for pending_job in pending_jobs:
-                pending_job_created_by_id = pending_job.link.created_by_id
-                if pending_job_created_by_id in next_jobs:
-                    # pending_job is the other user's second job, so this one goes in between that and last_job
-                    self.order = last_job.order + (pending_job.order - last_job.order)/2
-                    break
-                next_jobs[pending_job_created_by_id] = pending_job
-                last_job = pending_job
+            # Walking the (human, order) index, this stops after about one job per user waiting in line,
+            # however deep the queue is.
+            second_job_order = pending_jobs.annotate(
+                is_second_job=Exists(pending_jobs.filter(created_by_id=OuterRef('created_by_id'), order__lt=OuterRef('order')))
+            ).filter(is_second_job=True).order_by('order').values_list('order', flat=True).first()
+            if second_job_order is not None:
+                # the new job goes between that job and the one before it
+                last_order = pending_jobs.filter(order__lt=second_job_order).aggregate(Max('order'))['order__max']
+                self.order = last_order + (second_job_order - last_order)/2
 
             # If order isn't set yet, that means we should go last. Find the highest current order and add 1.
             if not self.order:
-                if pending_jobs:
-                    self.order = pending_jobs[-1].order + 1
+                last_order = pending_jobs.aggregate(Max('order'))['order__max']
+                if last_order is not None:
+                    self.order = last_order + 1
                 else:
                     self.order = (CaptureJob.objects.filter(human=self.human).aggregate(Max('order'))['order__max'] or 0) + 1
 
         super(CaptureJob, self).save(*args, **kwargs)
 
+    @classmethod
+    def assign_queue_orders(cls, capture_jobs):
+        """
+            Set the `order` of several new jobs, all submitted together by one user to one queue,
+            to the fair places in the queue that saving them one at a time would give them; see save().
+            Doesn't save the jobs, so they can be saved together with one bulk update.
+        """
+        if not capture_jobs:
+            return
+        human = capture_jobs[0].human
+        pending_jobs = CaptureJob.objects.filter(status='pending', human=human)
+        last_own_order = pending_jobs.filter(created_by_id=capture_jobs[0].created_by_id).aggregate(Max('order'))['order__max']
+        if last_own_order is not None:
+            pending_jobs = pending_jobs.filter(order__gt=last_own_order)
+        waiting = list(pending_jobs.order_by('order').values_list('order', 'created_by_id'))
+        if waiting:
+            last_order = waiting[-1][0]
+        else:
+            last_order = CaptureJob.objects.filter(human=human).aggregate(Max('order'))['order__max'] or 0
+
+        # each new job goes right before the first job, after the previous new one, that is another user's second
+        start = 0
+        for capture_job in capture_jobs:
+            users_seen = set()
+            for i in range(start, len(waiting)):
+                if waiting[i][1] in users_seen:
+                    capture_job.order = waiting[i - 1][0] + (waiting[i][0] - waiting[i - 1][0])/2
+                    start = i
+                    break
+                users_seen.add(waiting[i][1])
+            else:
+                # or else last
+                last_order += 1
+                capture_job.order = last_order
+                start = len(waiting)
+
     @classmethod
     def get_next_job(cls, reserve=False):
         """
@@ -2015,36 +2322,33 @@ class CaptureJob(models.Model):
 
             If `reserve=True`, mark the returned job with `status=in_progress` and remove from queue so the
             same job can't be returned twice. Caller must make sure the job is actually processed once returned.
+            Jobs already being claimed by other workers are skipped rather than waited on, so concurrent
+            workers each get a different job without retrying.
         """
+        next_jobs = cls.objects.filter(status='pending').order_by('-human', 'order', 'pk')
+        if not reserve:
+            return next_jobs.first()
+
+        with transaction.atomic():
+            if not cls.TEST_ALLOW_RACE:
+                next_jobs = next_jobs.select_for_update(skip_locked=True)
+            next_job = next_jobs.first()
+            if not next_job:
+                return None
+
+            if cls.TEST_PAUSE_TIME:
+                time.sleep(cls.TEST_PAUSE_TIME)
+
+            # update the returned job to be in_progress instead of pending, so it won't be returned again
+            # set time using database time, so timeout comparisons will be consistent across worker servers
+            cls.objects.filter(pk=next_job.pk).update(
+                status='in_progress',
+                capture_start_time=Now()
+            )
 
-        # cleanup: mark any captures as deleted where link has been deleted before capture
-        CaptureJob.objects.filter(link__user_deleted=True, status='pending').update(status='deleted')
-
-        while True:
-            next_job = cls.objects.filter(status='pending').order_by('-human', 'order', 'pk').first()
-
-            if reserve and next_job:
-                if cls.TEST_PAUSE_TIME:
-                    time.sleep(cls.TEST_PAUSE_TIME)
-
-                # update the returned job to be in_progress instead of pending, so it won't be returned again
-                # set time using database time, so timeout comparisons will be consistent across worker servers
-                update_count = CaptureJob.objects.filter(
-                    status='pending',
-                    pk=next_job.pk
-                ).update(
-                    status='in_progress',
-                    capture_start_time=Now()
-                )
-
-                # if no rows were updated, another worker claimed this job already -- try again
-                if not update_count and not cls.TEST_ALLOW_RACE:
-                    continue
-
-                # load up-to-date time from database
-                next_job.refresh_from_db()
-
-            return next_job
+        # load up-to-date time from database
+        next_job.refresh_from_db()
+        return next_job
 
     def queue_position(self):
         """
@@ -2062,6 +2366,33 @@ class CaptureJob(models.Model):
 
         return queue_position
 
+    @classmethod
+    def queue_positions(cls, capture_jobs):
+        """
+            Return a dict of {pk: queue position} for capture_jobs, matching queue_position(),
+            but calculated for all of them at once, in a single query.
+        """
+        queue_positions = {capture_job.pk: 0 for capture_job in capture_jobs}
+        pending_ids = [capture_job.pk for capture_job in capture_jobs if capture_job.status == 'pending']
+        if not pending_ids:
+            return queue_positions
+
+        # Rank every pending job within its queue; counting over "order" includes ties, like order__lte does.
+        # Robot jobs also wait for every pending human job.
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, position FROM (
+                    SELECT id, COUNT(*) OVER (PARTITION BY human ORDER BY "order") +
+                        CASE WHEN human THEN 0 ELSE (SELECT COUNT(*) FROM {table} WHERE status = 'pending' AND human) END AS position
+                    FROM {table}
+                    WHERE status = 'pending'
+                ) ranked
+                WHERE id = ANY(%s)
+            """, [pending_ids])
+            queue_positions.update(cursor.fetchall())
+        return queue_positions
+
     def inc_progress(self, inc, description):
         self.step_count = int(self.step_count) + inc
         self.step_description = description
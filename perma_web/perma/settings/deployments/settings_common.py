@@ -66,6 +66,8 @@ STATICFILES_STORAGE = 'perma.storage_backends.StaticStorage'
 
 # media storage -- default_storage config
 DEFAULT_FILE_STORAGE = 'perma.storage_backends.FileSystemMediaStorage'
+STREAMING_UPLOAD_CHUNK_SIZE = 1024 * 1024 * 5  # bytes per block or part when streaming files to Azure or S3; S3 parts must be at least 5MB
+STREAMING_DOWNLOAD_CHUNK_SIZE = 1024 * 256  # bytes per read when streaming files from storage, e.g. warc downloads
 
 TEMPLATES = [
     {
@@ -315,6 +317,9 @@ CACHE_MAX_AGES = {
     'timegate'     : 0,
     'timemap'      : 60 * 30,         # 30mins
 }
+PERMALINK_CONTEXT_CACHE_TIMEOUT = 60 * 60  # how long to keep the user-independent parts of a Perma Link's page in cache
+MEMENTOS_CACHE_TIMEOUT = 60 * 60 * 24  # how long to keep the list of Perma Links for a URL, for timegates and timemaps, in cache
+MEMENTO_TIMEMAP_PAGE_SIZE = 1000  # most mementos to list in one page of a timemap
 
 # Remote cache
 CACHE_BYPASS_COOKIE_NAME = 'cloudflare-bypass-cache'
@@ -451,6 +456,9 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SOFT_TIME_LIMIT=300
 # If a task is running longer than seven minutes, kill it
 CELERY_TASK_TIME_LIMIT = 420
+# Maintenance tasks that touch many links queue one task per FAN_OUT_BATCH_SIZE links; see perma.tasks.fan_out
+FAN_OUT_BATCH_SIZE = 1000
+FAN_OUT_STALL_TIMEOUT = 60 * 60  # seconds a fan-out's queued batches may go unprocessed before a new run is allowed to start anyway
 # Estimate of active celery workers
 # https://github.com/harvard-lil/perma/issues/2438
 # this value will be reset in settings.utils.post_processing
@@ -460,12 +468,23 @@ CELERY_TASK_ROUTES = {
     'perma.tasks.upload_to_internet_archive': {'queue': 'ia'},
     'perma.tasks.delete_from_internet_archive': {'queue': 'ia'},
     'perma.tasks.delete_all_from_internet_archive': {'queue': 'ia'},
+    'perma.tasks.delete_batch_from_internet_archive': {'queue': 'ia'},
     'perma.tasks.upload_all_to_internet_archive': {'queue': 'ia'},
+    'perma.tasks.upload_batch_to_internet_archive': {'queue': 'ia'},
     'perma.tasks.sync_subscriptions_from_perma_payments': {'queue': 'background'},
     'perma.tasks.cache_playback_status_for_new_links': {'queue': 'background'},
     'perma.tasks.cache_playback_status': {'queue': 'background'},
+    'perma.tasks.cache_playback_status_batch': {'queue': 'background'},
     'perma.tasks.populate_warc_size_fields': {'queue': 'background'},
     'perma.tasks.populate_warc_size': {'queue': 'background'},
+    'perma.tasks.populate_warc_size_batch': {'queue': 'background'},
+    'perma.tasks.populate_warc_digest_fields': {'queue': 'background'},
+    'perma.tasks.populate_warc_digest': {'queue': 'background'},
+    'perma.tasks.populate_warc_digest_batch': {'queue': 'background'},
+    'perma.tasks.clean_up_deleted_capture_jobs': {'queue': 'background'},
+    'perma.tasks.create_batch_links': {'queue': 'background'},
+    'perma.tasks.warm_wr_collection': {'queue': 'background'},
+    'perma.tasks.warm_popular_wr_collections': {'queue': 'background'},
 }
 
 API_SUBDOMAIN = 'api'
@@ -475,6 +494,12 @@ UPLOAD_TO_INTERNET_ARCHIVE = False
 INTERNET_ARCHIVE_MAX_UPLOAD_SIZE = 1024 * 1024 * 100
 INTERNET_ARCHIVE_COLLECTION = 'perma_cc'
 INTERNET_ARCHIVE_IDENTIFIER_PREFIX = 'perma_cc_'
+INTERNET_ARCHIVE_UPLOAD_BATCH_SIZE = 100  # links per upload_batch_to_internet_archive task, checked for existence in IA with one search
+INTERNET_ARCHIVE_UPLOAD_CONCURRENCY = 4  # uploads to run at once, per batch
+INTERNET_ARCHIVE_UPLOAD_BATCH_SECONDS = 60 * 4  # stop starting uploads in a batch after this long, and requeue the rest
+INTERNET_ARCHIVE_UPLOAD_ATTEMPTS = 3  # tries per link, when IA-S3 responds with 503 SlowDown
+INTERNET_ARCHIVE_UPLOAD_BACKOFF = 30  # seconds to pause uploads when IA-S3 is overloaded; doubles while it stays overloaded
+INTERNET_ARCHIVE_UPLOAD_MAX_BACKOFF = 60 * 10
 # Find these at https://archive.org/account/s3.php :
 INTERNET_ARCHIVE_ACCESS_KEY = ''
 INTERNET_ARCHIVE_SECRET_KEY = ''
@@ -504,6 +529,21 @@ PLAYBACK_HOST = HOST
 # http://remote-webrecorder-host:8089
 WR_API = 'http://nginx/api/v1'
 
+# Seconds WR may hold a request for an upload's status open, waiting for it to finish.
+# (Up to 30; see ImportStatusChecker.wait_for_upload in services/docker/webrecorder/importer.py)
+WR_UPLOAD_STATUS_WAIT = 5
+
+# Seconds to wait on Webrecorder API calls (perma.utils.query_wr_api):
+# to connect, and then for a response, keyed by method and the first part of the path.
+# Calls not listed in WR_API_TIMEOUTS use WR_API_TIMEOUT.
+WR_API_CONNECT_TIMEOUT = 3
+WR_API_TIMEOUT = 10
+WR_API_TIMEOUTS = {
+    'GET /upload': WR_UPLOAD_STATUS_WAIT + 5,  # waiting on an upload's progress
+    'PUT /upload': 30,  # sending a whole WARC
+}
+WR_API_POOL_SIZE = 10  # keep-alive connections to keep open to WR_API, per process
+
 # WR Credentials for the public user that stores all public collections.
 # Change init_wr.sh if you change these.
 WR_PERMA_USER = 'public'
@@ -526,6 +566,13 @@ WR_COOKIE_PERMITTED_AGE = 60
 # Seconds to wait before retrying a failed WR playback.
 WR_PLAYBACK_RETRY_AFTER = 1
 
+# Upload new public links to WR as soon as they're captured, and keep the
+# collections of the most played-back public links loaded (perma.tasks.warm_popular_wr_collections).
+# Popularity is only tracked when the cache backend is Redis.
+WARM_WR_COLLECTIONS = True
+WR_WARMING_WINDOW = 60 * 60  # seconds of playbacks counted when picking popular links
+WR_WARM_POPULAR_COUNT = 100  # number of popular links to keep loaded
+
 # We're finding that warcs aren't always available for download from S3
 # instantly, immediately after upload. How long do we want to wait for S3
 # to catch up, during first playback, before raising an error?
@@ -634,18 +681,32 @@ WARC_STORAGE_DIR = 'warcs'  # relative to MEDIA_ROOT
 
 from datetime import timedelta
 ARCHIVE_DELAY = timedelta(hours=24)
+LINK_VALIDATION_THREADS = 10  # URLs to check at once when creating a link batch
+CAPTURE_JOB_VALIDATION_TIMEOUT = 60 * 10  # seconds after which batch jobs still waiting on validation are marked failed
+LINK_VALIDATION_TIMEOUT = 10  # seconds to wait for a link's target to respond before rejecting it
+LINK_VALIDATION_POOL_HOSTS = 50  # hosts to keep connections open to, for checking link targets
+LINK_VALIDATION_POOL_SIZE = 10  # connections to keep open to each host, for checking link targets
+UNREACHABLE_HOST_CACHE_TIMEOUT = 60 * 5  # seconds to remember that a host couldn't be reached, so links to it fail fast
 
 USE_LOCKSS_REPLAY = False  # whether to replay captures from LOCKSS, if servers are available
 LOCKSS_CONTENT_IPS = ""  # IPs of Perma servers allowed to play back LOCKSS content -- e.g. "10.1.146.0/24;140.247.209.64"
 LOCKSS_CRAWL_INTERVAL = "12h"
 LOCKSS_QUORUM = 3
 LOCKSS_DEBUG_IPS = False
+LOCKSS_MANIFEST_CACHE_TIMEOUT = 60 * 60 * 24  # seconds between refreshes of the per-AU counts in titledb.xml; month rollovers and mirror changes refresh it immediately
+LOCKSS_SEARCH_CURSOR_CACHE_TIMEOUT = 60 * 60  # seconds to remember where each page of a LOCKSS search ended, so offset-paging mirrors get keyset queries
 
 ENABLE_AV_CAPTURE = False
 RESOURCE_LOAD_TIMEOUT = 45 # seconds to wait for at least one resource to load before giving up on capture
 SHUTDOWN_GRACE_PERIOD = 10 # seconds to allow slow threads to finish before we complete the capture job
-MAX_PROXY_THREADS = 100
+MAX_PROXY_THREADS = 100 # shared by all of a worker process's concurrent captures
 MAX_PROXY_QUEUE_SIZE = 500 # this is the default in https://github.com/internetarchive/warcprox/blob/ee6bc151e1758a50f8af2b8f2d9746aa56ec95fb/warcprox/main.py#L192
+CAPTURE_CONCURRENCY = 1 # captures each capture worker process runs at once, memory and CPU permitting
+CAPTURE_POOL_SECONDS = 60 # seconds each run_next_capture task keeps starting captures as others finish, before leaving the rest to the next task
+CAPTURE_MEMORY_PER_CAPTURE = 500 # MB of available memory needed for each concurrent capture
+CAPTURE_MAX_LOAD_PER_CPU = 1.5 # above this 1-minute load average per CPU, workers run one capture at a time
+CAPTURE_ENVIRONMENT_POOL_SIZE = 1 # warm browsers kept between jobs, per concurrent capture; 0 starts a fresh browser and warcprox for every capture
+CAPTURE_ENVIRONMENT_MAX_USES = 25 # captures to run with a browser before replacing it
 
 WEBPACK_LOADER = {
     'DEFAULT': {
@@ -36,6 +36,12 @@ CELERY_TASK_ALWAYS_EAGER = True
 CELERY_TASK_EAGER_PROPAGATES = True
 CELERY_BROKER_URL = 'memory://localhost/'
 
+# don't leave browsers and proxies running between tests
+CAPTURE_ENVIRONMENT_POOL_SIZE = 0
+
+# don't upload to Webrecorder behind the tests' backs
+WARM_WR_COLLECTIONS = False
+
 # faster collectstatic
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
@@ -49,10 +49,18 @@ def post_process_settings(settings):
             'task': 'perma.tasks.run_next_capture',
             'schedule': crontab(minute='*'),
         },
+        'clean-up-deleted-capture-jobs': {
+            'task': 'perma.tasks.clean_up_deleted_capture_jobs',
+            'schedule': crontab(minute='*/5'),
+        },
         'sync_subscriptions_from_perma_payments': {
             'task': 'perma.tasks.sync_subscriptions_from_perma_payments',
             'schedule': crontab(hour='23', minute='0')
         },
+        'warm-popular-wr-collections': {
+            'task': 'perma.tasks.warm_popular_wr_collections',
+            'schedule': crontab(minute='*/5'),
+        },
         'verify_webrecorder_api_available': {
             'task': 'perma.tasks.verify_webrecorder_api_available',
             'schedule': crontab(minute='*')
@@ -61,13 +69,14 @@ def post_process_settings(settings):
     settings['CELERY_BEAT_SCHEDULE'] = dict(((job, celerybeat_job_options[job]) for job in settings.get('CELERY_BEAT_JOB_NAMES', [])),
                                            **settings.get('CELERY_BEAT_SCHEDULE', {}))
 
-    # Count celery capture workers, by convention named w1, w2, etc.
+    # Count celery capture workers, by convention named w1, w2, etc.,
+    # each of which runs up to CAPTURE_CONCURRENCY captures at once.
     # At the moment, this is slow, so we do it once on application
     # start-up rather than at each load of the /manage/create page.
     # The call to inspector.active() takes almost two seconds.
     try:
         inspector = celery.current_app.control.inspect()
         active = inspector.active()
-        settings['WORKER_COUNT'] = len([key for key in active.keys() if key.split('@')[0][0] == 'w']) if active else 0
+        settings['WORKER_COUNT'] = len([key for key in active.keys() if key.split('@')[0][0] == 'w']) * settings.get('CAPTURE_CONCURRENCY', 1) if active else 0
     except TimeoutError:
         pass
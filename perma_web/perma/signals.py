@@ -1,7 +1,7 @@
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 
-from .models import Link
+from .models import Link, Capture, CaptureJob
 
 
 @receiver(pre_save, sender=Link)
@@ -51,3 +51,33 @@ def update_link_count(sender, instance, **kwargs):
             instance.organization.save()
             instance.organization.registrar.link_count += 1
             instance.organization.registrar.save()
+
+
+@receiver(post_save, sender=Link)
+@receiver(post_delete, sender=Link)
+def invalidate_link_permalink_context(sender, instance, **kwargs):
+    Link.invalidate_permalink_context(instance.guid)
+
+
+@receiver(post_save, sender=Link)
+def invalidate_link_mementos(sender, instance, created, **kwargs):
+    changed = instance.tracker.changed()
+    if created or any(field in changed for field in Link.MEMENTO_VISIBILITY_FIELDS):
+        Link.invalidate_mementos(instance.submitted_url_surt)
+        # and the link's old SURT, if it has changed
+        if changed.get('submitted_url_surt'):
+            Link.invalidate_mementos(changed['submitted_url_surt'])
+
+
+@receiver(post_delete, sender=Link)
+def invalidate_deleted_link_mementos(sender, instance, **kwargs):
+    Link.invalidate_mementos(instance.submitted_url_surt)
+
+
+@receiver(post_save, sender=Capture)
+@receiver(post_delete, sender=Capture)
+@receiver(post_save, sender=CaptureJob)
+@receiver(post_delete, sender=CaptureJob)
+def invalidate_capture_permalink_context(sender, instance, **kwargs):
+    if instance.link_id:
+        Link.invalidate_permalink_context(instance.link_id)
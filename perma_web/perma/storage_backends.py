@@ -1,6 +1,10 @@
 # alternate storage backends
+import base64
+from contextlib import contextmanager
 import io as StringIO
+import mimetypes
 import os
+import tempfile
 
 from django.core.files.storage import FileSystemStorage as DjangoFileSystemStorage
 from django.core.files import File
@@ -9,6 +13,8 @@ import django.dispatch
 
 from storages.backends.s3boto3 import S3Boto3Storage
 from storages.backends.azure_storage import AzureStorage
+from storages.utils import clean_name
+from azure.storage.blob import BlobBlock, ContentSettings
 from whitenoise.storage import CompressedStaticFilesStorage
 
 # used only for suppressing INFO logging in S3Boto3Storage
@@ -49,6 +55,43 @@ class BaseMediaStorage:
             file_saved.send(sender=self.__class__, instance=self, path=new_file_path, overwrite=overwrite)
         return new_file_path.split('/')[-1]
 
+    @contextmanager
+    def open_for_streaming(self, file_path, send_signal=True):
+        """
+            Yield a write-only file object whose contents go straight to file_path,
+            overwriting any existing file, so that large files needn't be assembled
+            on local disk before being stored.
+
+            The file is only saved if the block exits without an exception.
+        """
+        with self._stream_file(file_path) as out:
+            yield out
+        if send_signal:
+            file_saved.send(sender=self.__class__, instance=self, path=file_path, overwrite=True)
+
+    @contextmanager
+    def _stream_file(self, file_path):
+        # fallback for backends that can't write in place: buffer the file locally
+        with tempfile.TemporaryFile() as out:
+            yield out
+            out.seek(0)
+            self.store_file(out, file_path, overwrite=True, send_signal=False)
+
+    def iter_file_range(self, file_path, start=0, length=None):
+        """
+            Yield the contents of file_path, from byte `start`, for `length` bytes
+            (or to the end), in chunks of STREAMING_DOWNLOAD_CHUNK_SIZE bytes.
+        """
+        with self.open(file_path, 'rb') as f:
+            f.seek(start)
+            while length is None or length > 0:
+                chunk = f.read(settings.STREAMING_DOWNLOAD_CHUNK_SIZE if length is None else min(length, settings.STREAMING_DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                yield chunk
+
     def store_data_to_file(self, data, file_path, overwrite=False, send_signal=True):
         file_object = StringIO.StringIO()
         file_object.write(data)
@@ -80,7 +123,23 @@ class BaseMediaStorage:
 
 
 class FileSystemMediaStorage(BaseMediaStorage, DjangoFileSystemStorage):
-    pass
+
+    @contextmanager
+    def _stream_file(self, file_path):
+        # write alongside the destination, and move into place once complete
+        full_path = self.path(file_path)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        out = tempfile.NamedTemporaryFile(dir=directory, prefix='.streaming-', delete=False)
+        try:
+            with out:
+                yield out
+            os.replace(out.name, full_path)
+        except BaseException:
+            os.remove(out.name)
+            raise
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
 
 
 class S3MediaStorage(BaseMediaStorage, S3Boto3Storage):
@@ -89,5 +148,137 @@ class S3MediaStorage(BaseMediaStorage, S3Boto3Storage):
     logging.getLogger('boto3').setLevel(logging.WARNING)
     logging.getLogger('botocore').setLevel(logging.WARNING)
 
+    @contextmanager
+    def _stream_file(self, file_path):
+        # the same object parameters S3Boto3Storage.save would use
+        name = self._normalize_name(clean_name(file_path))
+        content_type, encoding = mimetypes.guess_type(name)
+        params = {'ContentType': content_type or self.default_content_type}
+        if encoding:
+            params['ContentEncoding'] = encoding
+        params.update(self.get_object_parameters(name))
+        if 'ACL' not in params and self.default_acl:
+            params['ACL'] = self.default_acl
+        out = S3MultipartWriter(self.bucket.Object(name), params)
+        try:
+            yield out
+        except BaseException:
+            out.abort()
+            raise
+        out.commit()
+
+    def iter_file_range(self, file_path, start=0, length=None):
+        # ask for just the bytes we need: S3Boto3StorageFile would download the whole object first
+        if length == 0:
+            return
+        obj = self.bucket.Object(self._normalize_name(clean_name(file_path)))
+        body = obj.get(Range=f"bytes={start}-{'' if length is None else start + length - 1}")['Body']
+        try:
+            yield from body.iter_chunks(settings.STREAMING_DOWNLOAD_CHUNK_SIZE)
+        finally:
+            body.close()
+
+
+class S3MultipartWriter:
+    """
+        A write-only file object that uploads to an S3 object as it goes, as a multipart upload
+        with a part every STREAMING_UPLOAD_CHUNK_SIZE bytes. Nothing is visible at the destination
+        until commit() is called; abort() discards any parts already uploaded.
+    """
+    mode = 'wb'
+
+    def __init__(self, s3_object, params):
+        self.s3_object = s3_object
+        self.params = params
+        self.buffer = StringIO.BytesIO()
+        self.multipart_upload = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= settings.STREAMING_UPLOAD_CHUNK_SIZE:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        if self.multipart_upload is None:
+            self.multipart_upload = self.s3_object.initiate_multipart_upload(**self.params)
+        part_number = len(self.parts) + 1
+        response = self.multipart_upload.Part(part_number).upload(Body=self.buffer.getvalue())
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = StringIO.BytesIO()
+
+    def commit(self):
+        if self.multipart_upload is None:
+            # never filled a part: upload the file in one request
+            self.s3_object.put(Body=self.buffer.getvalue(), **self.params)
+            return
+        if self.buffer.tell():
+            self.upload_part()
+        self.multipart_upload.complete(MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.multipart_upload is not None:
+            self.multipart_upload.abort()
+
+
+class AzureBlockBlobWriter:
+    """
+        A write-only file object that uploads to an Azure block blob as it goes,
+        staging a block every STREAMING_UPLOAD_CHUNK_SIZE bytes. Nothing is visible
+        at the destination until commit() is called.
+    """
+    mode = 'wb'
+
+    def __init__(self, blob_client, timeout):
+        self.blob_client = blob_client
+        self.timeout = timeout
+        self.buffer = StringIO.BytesIO()
+        self.block_ids = []
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= settings.STREAMING_UPLOAD_CHUNK_SIZE:
+            self.stage_block()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def stage_block(self):
+        data = self.buffer.getvalue()
+        if data:
+            # block ids must all be the same length
+            block_id = base64.b64encode(f"{len(self.block_ids):010d}".encode()).decode()
+            self.blob_client.stage_block(block_id, data, timeout=self.timeout)
+            self.block_ids.append(block_id)
+            self.buffer = StringIO.BytesIO()
+
+    def commit(self, content_settings):
+        self.stage_block()
+        self.blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in self.block_ids],
+            content_settings=content_settings,
+            timeout=self.timeout)
+
+
 class AzureMediaStorage(BaseMediaStorage, AzureStorage):
     location = settings.MEDIA_ROOT
+
+    @contextmanager
+    def _stream_file(self, file_path):
+        # uncommitted blocks are discarded by Azure, so there's nothing to clean up on failure
+        name = self._get_valid_path(file_path)
+        out = AzureBlockBlobWriter(self.client.get_blob_client(name), self.timeout)
+        yield out
+        out.commit(ContentSettings(**self._get_content_settings_parameters(name)))
+
+    def iter_file_range(self, file_path, start=0, length=None):
+        # ask for just the bytes we need: AzureStorageFile would download the whole blob first
+        if length == 0:
+            return
+        blob_client = self.client.get_blob_client(self._get_valid_path(file_path))
+        yield from blob_client.download_blob(offset=start, length=length, timeout=self.timeout).chunks()
@@ -1,28 +1,33 @@
 import tempfile
 import traceback
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pyquery import PyQuery
 
 from http.client import CannotSendRequest
 from urllib.error import URLError
 
+import hashlib
 import os
 import os.path
+import json
+import queue
+import shutil
 import threading
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 import urllib.parse
 import re
 import urllib.robotparser
+from urllib3 import PoolManager
 from urllib3.util import is_connection_dropped
-import errno
-import tempdir
 import socket
 from socket import error as socket_error
+from simple_history.utils import bulk_create_with_history, bulk_update_with_history
 from celery import shared_task
 from celery.exceptions import SoftTimeLimitExceeded
-from celery.signals import task_failure
+from celery.signals import task_failure, worker_process_shutdown, worker_shutdown
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException, NoSuchElementException, NoSuchFrameException, TimeoutException
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
@@ -31,6 +36,7 @@ from pyvirtualdisplay import Display
 import warcprox
 from warcprox.controller import WarcproxController
 from warcprox.warcproxy import WarcProxyHandler
+from warcprox.writerthread import WarcWriterProcessor
 from warcprox.mitmproxy import ProxyingRecordingHTTPResponse
 from warcprox.mitmproxy import http_client
 from warcprox.mitmproxy import MitmProxyHandler, socks, ssl
@@ -41,6 +47,10 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 import internetarchive
 
+from django import db
+from django.db import transaction
+from django.db.models import F
+from django.core.cache import cache as django_cache
 from django.core.files.storage import default_storage
 from django.core.mail import mail_admins
 from django.template.defaultfilters import truncatechars
@@ -49,13 +59,13 @@ from django.utils import timezone
 from django.urls import reverse
 from django.http import HttpRequest
 
-from perma.models import WeekStats, MinuteStats, Registrar, LinkUser, Link, Organization, Capture, CaptureJob, UncaughtError
+from perma.models import WeekStats, MinuteStats, Registrar, LinkUser, Link, Organization, Capture, CaptureJob, LinkBatch, UncaughtError
 from perma.email import send_self_email
-from perma.exceptions import PermaPaymentsCommunicationException
-from perma.utils import (url_in_allowed_ip_range,
-    copy_file_data, preserve_perma_warc, write_warc_records_recorded_from_web,
+from perma.exceptions import PermaPaymentsCommunicationException, WebrecorderException
+from perma.utils import (url_in_allowed_ip_range, clean_submitted_url,
+    preserve_perma_warc, StorageFileReader, write_warc_records_recorded_from_web,
     write_resource_record_from_asset, protocol, remove_control_characters,
-    user_agent_for_domain, Sec1TLSAdapter)
+    user_agent_for_domain, Sec1TLSAdapter, resolve_hosts, popular_wr_playbacks)
 from perma import site_scripts
 
 import logging
@@ -69,6 +79,7 @@ ONLOAD_EVENT_TIMEOUT = 30 # seconds to wait before giving up on the onLoad event
 ELEMENT_DISCOVERY_TIMEOUT = 2 # seconds before the browser gives up running a DOM request (should be instant, assuming page is loaded)
 AFTER_LOAD_TIMEOUT = 25 # seconds to allow page to keep loading additional resources after onLoad event fires
 SHUTDOWN_GRACE_PERIOD = settings.SHUTDOWN_GRACE_PERIOD # seconds to allow slow threads to finish before we complete the capture job
+CAPTURE_TIME_LIMIT = settings.CELERY_TASK_SOFT_TIME_LIMIT # seconds a capture may run before it is stopped, as a capture task would be by its soft time limit
 VALID_FAVICON_MIME_TYPES = {'image/png', 'image/gif', 'image/jpg', 'image/jpeg', 'image/x-icon', 'image/vnd.microsoft.icon', 'image/ico'}
 BROWSER_SIZE = [1024, 800]
 
@@ -211,6 +222,287 @@ _real_proxy_request = WarcProxyHandler._proxy_request
 # monkey-patch the function freshly on each call of run_next_capture
 _orig_connect_to_remote_server = MitmProxyHandler._connect_to_remote_server
 
+class CaptureTracker:
+    """
+        State shared between a capture and the warcprox request handlers recording it:
+        which URLs have been requested and recorded, how much has been downloaded,
+        and whether recording should stop.
+    """
+    def __init__(self, link, proxy, thread_list, requested_urls):
+        self.link = link
+        self.proxy = proxy  # whether to connect via settings.PROXY_ADDRESS
+        self.thread_list = thread_list
+        self.requested_urls = requested_urls
+        self.proxied_responses = {
+            "any": False,
+            "size": 0,
+            "limit_reached": False,
+            "updates": 0,  # incremented whenever a response arrives or the size limit is hit
+        }
+        self.proxied_pairs = []
+        # keep connections to remote servers separate from other captures', so proxied captures stay proxied
+        self.remote_connection_pool = PoolManager(num_pools=max(settings.MAX_PROXY_THREADS // 6, 100))
+        self.lock = threading.Lock()
+        # notified along with proxied_responses["updates"], so the capture can wait for progress instead of polling
+        self.activity = threading.Condition(self.lock)
+        self.stop = False
+
+    def notify_activity(self):
+        # call while holding self.lock
+        self.proxied_responses["updates"] += 1
+        self.activity.notify_all()
+
+    def wait_for_activity(self, last_update, timeout):
+        # return as soon as anything has happened since `last_update`, or after `timeout` seconds
+        with self.activity:
+            self.activity.wait_for(lambda: self.proxied_responses["updates"] != last_update, timeout)
+
+    def check_size_limit(self):
+        if self.proxied_responses["limit_reached"]:
+            return
+        if capture_current_size(self.thread_list, self.proxied_responses["size"]) > settings.MAX_ARCHIVE_FILE_SIZE:
+            with self.lock:
+                self.proxied_responses["limit_reached"] = True
+                self.notify_activity()
+            print("Size limit reached.")
+
+
+# Patch Warcprox's inner proxy function to be interruptible,
+# to prevent thread leak and permit the partial capture of streamed content.
+# See https://github.com/harvard-lil/perma/issues/2019
+def stoppable_proxy_request(self, extra_response_headers={}):
+    '''
+    Sends the request to the remote server, then uses a ProxyingRecorder to
+    read the response and send it to the proxy client, while recording the
+    bytes in transit. Returns a tuple (request, response) where request is
+    the raw request bytes, and response is a ProxyingRecorder.
+    :param extra_response_headers: generated on warcprox._proxy_request.
+    It may contain extra HTTP headers such as ``Warcprox-Meta`` which
+    are written in the WARC record for this request.
+    '''
+    # Build request
+    req_str = f'{self.command} {self.path} {self.request_version}\r\n'
+
+    # Swallow headers that don't make sense to forward on, i.e. most
+    # hop-by-hop headers. http://tools.ietf.org/html/rfc2616#section-13.5.
+    # self.headers is an email.message.Message, which is case-insensitive
+    # and doesn't throw KeyError in __delitem__
+    for key in (
+            'Connection', 'Proxy-Connection', 'Keep-Alive',
+            'Proxy-Authenticate', 'Proxy-Authorization', 'Upgrade'):
+        del self.headers[key]
+
+    self.headers['Via'] = warcprox.mitmproxy.via_header_value(
+            self.headers.get('Via'),
+            self.request_version.replace('HTTP/', ''))
+
+    # Add headers to the request
+    # XXX in at least python3.3 str(self.headers) uses \n not \r\n :(
+    req_str += '\r\n'.join(f'{k}: {v}' for (k,v) in self.headers.items())
+
+    req = req_str.encode('latin1') + b'\r\n\r\n'
+
+    # Append message body if present to the request
+    if 'Content-Length' in self.headers:
+        req += self.rfile.read(int(self.headers['Content-Length']))
+
+    prox_rec_res = None
+    start = time.time()
+    try:
+        self.logger.debug(f'sending to remote server req={req}')
+
+        # Send it down the pipe!
+        self._remote_server_conn.sock.sendall(req)
+
+        prox_rec_res = ProxyingRecordingHTTPResponse(
+                self._remote_server_conn.sock, proxy_client=self.connection,
+                digest_algorithm=self.server.digest_algorithm,
+                url=self.url, method=self.command,
+                tmp_file_max_memory_size=self._tmp_file_max_memory_size)
+        prox_rec_res.begin(extra_response_headers=extra_response_headers)
+
+        buf = None
+        while buf != b'':
+            try:
+                buf = prox_rec_res.read(65536)
+            except http_client.IncompleteRead as e:
+                self.logger.warn(f'{e} from {self.url}')
+                buf = e.partial
+
+            if buf:
+                self.capture_tracker.proxied_responses["size"] += len(buf)
+                self.capture_tracker.check_size_limit()
+
+            if (self._max_resource_size and
+                    prox_rec_res.recorder.len > self._max_resource_size):
+                prox_rec_res.truncated = b'length'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(f'truncating response because max resource size {self._max_resource_size} bytes exceeded for URL {self.url}')
+                break
+            elif ('content-length' not in self.headers and
+                   time.time() - start > 3 * 60 * 60):
+                prox_rec_res.truncated = b'time'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(f'reached hard timeout of 3 hours fetching url without content-length: {self.url}')
+                break
+
+            # begin Perma changes #
+            if self.capture_tracker.stop:
+                prox_rec_res.truncated = b'length'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(f'truncating response because stop signal received while recording {self.url}')
+                break
+            # end Perma changes #
+
+        self.log_request(prox_rec_res.status, prox_rec_res.recorder.len)
+        # Let's close off the remote end. If remote connection is fine,
+        # put it back in the pool to reuse it later.
+        if not is_connection_dropped(self._remote_server_conn):
+            self._conn_pool._put_conn(self._remote_server_conn)
+
+    except Exception as e:
+        # A common error is to connect to the remote server successfully
+        # but raise a `RemoteDisconnected` exception when trying to begin
+        # downloading. Its caused by prox_rec_res.begin(...) which calls
+        # http_client._read_status(). The connection fails there.
+        # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L275
+        # Another case is when the connection is fine but the response
+        # status is problematic, raising `BadStatusLine`.
+        # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L296
+        # In both cases, the host is bad and we must add it to
+        # `bad_hostnames_ports` cache.
+        if isinstance(e, (http_client.RemoteDisconnected,
+                          http_client.BadStatusLine)):
+            host_port = self._hostname_port_cache_key()
+            with self.server.bad_hostnames_ports_lock:
+                self.server.bad_hostnames_ports[host_port] = 502
+            self.logger.info(f'bad_hostnames_ports cache size: {len(self.server.bad_hostnames_ports)}')
+
+        # Close the connection only if its still open. If its already
+        # closed, an `OSError` "([Errno 107] Transport endpoint is not
+        # connected)" would be raised.
+        if not is_connection_dropped(self._remote_server_conn):
+            self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+            self._remote_server_conn.sock.close()
+        raise
+    finally:
+        if prox_rec_res:
+            prox_rec_res.close()
+
+    return req, prox_rec_res
+
+warcprox.mitmproxy.MitmProxyHandler._inner_proxy_request = stoppable_proxy_request
+
+
+def _proxy_request(self):
+    capture_tracker = self.capture_tracker
+
+    # make sure we don't capture anything in a banned IP range
+    if not url_in_allowed_ip_range(self.url):
+        return
+
+    # skip request if downloaded size exceeds MAX_ARCHIVE_FILE_SIZE.
+    if capture_tracker.proxied_responses["limit_reached"]:
+        return
+
+    with capture_tracker.lock:
+        proxied_pair = [self.url, None]
+        capture_tracker.requested_urls.add(proxied_pair[0])
+        capture_tracker.proxied_pairs.append(proxied_pair)
+    # record this capture's traffic in its own WARC
+    del self.headers['Warcprox-Meta']
+    self.headers['Warcprox-Meta'] = json.dumps({'warc-prefix': capture_tracker.link.guid})
+    try:
+        response = _real_proxy_request(self)
+    except Exception as e:
+        # If warcprox can't handle a request/response for some reason,
+        # remove the proxied pair so that it doesn't keep trying and
+        # the capture process can proceed
+        with capture_tracker.lock:
+            capture_tracker.proxied_pairs.remove(proxied_pair)
+            capture_tracker.notify_activity()
+        print(f"WarcProx exception: {e.__class__.__name__} proxying {proxied_pair[0]}")
+        return  # swallow exception
+    with capture_tracker.lock:
+        if response:
+            capture_tracker.proxied_responses["any"] = True
+            proxied_pair[1] = response
+            # so the writer thread can tell the capture when the response's records are written
+            response.capture_tracker = capture_tracker
+        else:
+            # in some cases (502? others?) warcprox is not returning a response
+            capture_tracker.proxied_pairs.remove(proxied_pair)
+        capture_tracker.notify_activity()
+
+WarcProxyHandler._proxy_request = _proxy_request
+
+# patch warcprox's writer to wake the capture waiting for its records; see CaptureEnvironment.finish_recording
+_orig_process_url = WarcWriterProcessor._process_url
+def _process_url(self, recorded_url):
+    _orig_process_url(self, recorded_url)
+    # if _proxy_request hasn't attached the tracker yet, it notifies the capture itself once it does
+    capture_tracker = getattr(recorded_url, 'capture_tracker', None)
+    if capture_tracker:
+        with capture_tracker.lock:
+            capture_tracker.notify_activity()
+WarcWriterProcessor._process_url = _process_url
+
+# patch warcprox's connection function to go through the tor proxy whenever the capture calls for it
+def _connect_to_remote_server(self):
+    # find the capture this request belongs to, by the port it arrived on; see RecordingProxy
+    self.capture_tracker = self.server.capture_trackers.get(self.connection.getsockname()[1])
+    if not self.capture_tracker:
+        raise warcprox.BadRequest("request rejected by warcprox: no capture in progress")
+
+    self._conn_pool = self.capture_tracker.remote_connection_pool.connection_from_host(
+        host=self.hostname, port=int(self.port), scheme='http',
+        pool_kwargs={'maxsize': 12, 'timeout': self._socket_timeout})
+
+    remote_ip = None
+
+    self._remote_server_conn = self._conn_pool._get_conn()
+    if is_connection_dropped(self._remote_server_conn):
+        if self.capture_tracker.proxy:  # Perma removed `and self.hostname.endswith('.onion')`
+            tor_host, _, tor_port = settings.PROXY_ADDRESS.partition(':')
+            tor_port = int(tor_port) if tor_port else None
+            self.logger.info(f"using tor socks proxy at {tor_host}:{tor_port or 1080} to connect to {self.hostname}")
+            self._remote_server_conn.sock = socks.socksocket()
+            self._remote_server_conn.sock.set_proxy(
+                    socks.SOCKS5, addr=tor_host,
+                    port=tor_port, rdns=True,
+                    username="user", password=self.capture_tracker.link.guid)  # Perma added username and password, to force new IPs
+            self._remote_server_conn.sock.settimeout(self._socket_timeout)
+            self._remote_server_conn.sock.connect((self.hostname, int(self.port)))
+        else:
+            self._remote_server_conn.connect()
+            remote_ip = self._remote_server_conn.sock.getpeername()[0]
+
+        # Wrap socket if SSL is required
+        if self.is_connect:
+            try:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                self._remote_server_conn.sock = context.wrap_socket(
+                        self._remote_server_conn.sock,
+                        server_hostname=self.hostname)
+            except AttributeError:
+                try:
+                    self._remote_server_conn.sock = ssl.wrap_socket(
+                            self._remote_server_conn.sock)
+                except ssl.SSLError:
+                    self.logger.warning(f"failed to establish ssl connection to {self.hostname}; python ssl library does not support SNI,consider upgrading to python 2.7.9+ or 3.4+")
+                raise
+            except ssl.SSLError as e:
+                self.logger.error(f'error connecting to {self.hostname} ({remote_ip}) port {self.port}: {e}')
+                raise
+    return self._remote_server_conn.sock
+MitmProxyHandler._connect_to_remote_server = _connect_to_remote_server
+
+
 # BROWSER HELPERS
 
 def start_virtual_display():
@@ -218,16 +510,16 @@ def start_virtual_display():
     display.start()
     return display
 
-def get_browser(user_agent, proxy_address, cert_path):
-    """ Set up a Selenium browser with given user agent, proxy and SSL cert. """
+def get_browser(user_agent, proxy_address, cert_path, download_dir):
+    """
+        Set up a Selenium browser with given user agent, proxy and SSL cert.
+        Firefox expects a virtual display to be running already; see start_virtual_display().
+    """
 
-    display = None
     print(f"Using browser: {settings.CAPTURE_BROWSER}")
 
     # Firefox
     if settings.CAPTURE_BROWSER == 'Firefox':
-        display = start_virtual_display()
-
         desired_capabilities = dict(DesiredCapabilities.FIREFOX)
         proxy = Proxy({
             'proxyType': ProxyType.MANUAL,
@@ -247,8 +539,6 @@ def get_browser(user_agent, proxy_address, cert_path):
     elif settings.CAPTURE_BROWSER == 'Chrome':
         # http://blog.likewise.org/2015/01/setting-up-chromedriver-and-the-selenium-webdriver-python-bindings-on-ubuntu-14-dot-04/
         # and from 2017-04-17: https://intoli.com/blog/running-selenium-with-headless-chrome/
-        download_dir = os.path.abspath('./downloads')
-        os.mkdir(download_dir)
         chrome_options = webdriver.ChromeOptions()
         chrome_options.add_argument(f'user-agent={user_agent}')
         chrome_options.add_argument(f'proxy-server={proxy_address}')
@@ -265,13 +555,16 @@ def get_browser(user_agent, proxy_address, cert_path):
         desired_capabilities["acceptSslCerts"] = True
         browser = webdriver.Chrome(desired_capabilities=desired_capabilities)
 
+        # expose chromedriver's DevTools passthrough, so we can reset browser state between captures
+        browser.command_executor._commands['sendDevToolsCommand'] = ('POST', '/session/$sessionId/chromium/send_command')
+
     else:
         assert False, "Invalid value for CAPTURE_BROWSER."
 
     browser.implicitly_wait(ELEMENT_DISCOVERY_TIMEOUT)
     browser.set_page_load_timeout(ROBOTS_TXT_TIMEOUT)
 
-    return browser, display
+    return browser
 
 def browser_still_running(browser):
     return browser.service.process.poll() is None
@@ -466,29 +759,6 @@ def capture_current_size(thread_list, recorded):
     """
     return recorded + sum(getattr(thread, 'pending_data', 0) for thread in thread_list)
 
-class CaptureCurrentSizeThread(threading.Thread):
-    """
-        Listen for self.stop to be set, allowing the thread to be halted by other threads.
-    """
-    def __init__(self, thread_list, proxied_responses, *args, **kwargs):
-        self.stop = threading.Event()
-        self.thread_list = thread_list
-        self.proxied_responses = proxied_responses
-        # include 'pending data' for a consistent API with other threads on the thread_list
-        self.pending_data = 0
-        super(CaptureCurrentSizeThread, self).__init__(*args, **kwargs)
-
-    def run(self):
-        while True:
-            if self.stop.is_set():
-                return
-            if capture_current_size(self.thread_list, self.proxied_responses["size"]) > settings.MAX_ARCHIVE_FILE_SIZE:
-                self.proxied_responses["limit_reached"] = True
-                print("Size limit reached.")
-                return
-            time.sleep(.2)
-
-
 def make_absolute_urls(base_url, urls):
     """collect resource urls, converted to absolute urls relative to current browser frame"""
     return [urllib.parse.urljoin(base_url, url) for url in urls if url]
@@ -773,41 +1043,371 @@ def get_page_size(browser):
 def page_pixels_in_allowed_range(page_size):
     return page_size and page_size['width'] * page_size['height'] < settings.MAX_IMAGE_SIZE
 
+### CAPTURE ENVIRONMENTS ###
+
+def start_warcprox(directory):
+    """
+        Start a warcprox instance on an open port, recording to `directory`.
+        Each capture's records are written to their own WARC, named for the
+        "warc-prefix" we send in the Warcprox-Meta header: see _proxy_request.
+    """
+    options = warcprox.Options(
+        address="127.0.0.1",
+        port=0,  # let the OS pick an open port
+        max_threads=settings.MAX_PROXY_THREADS,
+        queue_size=settings.MAX_PROXY_QUEUE_SIZE,
+        gzip=True,
+        stats_db_file="",
+        dedup_db_file="",
+        directory=directory,
+        warc_filename="{prefix}",
+        cacert=os.path.join(settings.SERVICES_DIR, 'warcprox', 'perma-warcprox-ca.pem'),
+    )
+    warcprox_controller = WarcproxController(options)
+    warcprox_controller.proxy.capture_trackers = {}  # {listening port: CaptureTracker}; see _connect_to_remote_server
+
+    # start warcprox in the background
+    warcprox_thread = threading.Thread(target=warcprox_controller.run_until_shutdown, name="warcprox", args=())
+    warcprox_thread.start()
+    print("WarcProx opened.")
+    return warcprox_controller, warcprox_thread
+
+
+class RecordingProxy:
+    """
+        A warcprox instance shared by all the captures in this worker process, so that proxy threads
+        and memory stay flat however many captures run at once.
+
+        Each CaptureEnvironment gets its own listening port on the proxy, and requests are attributed
+        to the capture that environment is running by the port they arrive on.
+    """
+    def __init__(self):
+        self.working_dir = tempfile.mkdtemp(prefix='perma-warcprox-')
+        self.warc_dir = os.path.join(self.working_dir, 'warcs')
+        self.listeners = {}  # {port: socket}
+        self.stop = threading.Event()
+        self.warcprox_controller, self.warcprox_thread = start_warcprox(self.warc_dir)
+        self.ca_file = self.warcprox_controller.proxy.ca.ca_file
+        # released as each request finishes in warcprox's thread pool; see accept_requests
+        self.request_slots = threading.BoundedSemaphore(self.warcprox_controller.proxy.max_threads)
+
+    def is_running(self):
+        return not self.stop.is_set() and self.warcprox_thread.is_alive()
+
+    def open_port(self):
+        """ Start listening on a new port, and return it. """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        listener.settimeout(.5)  # check in regularly, in case we're shutting down
+        port = listener.getsockname()[1]
+        self.listeners[port] = listener
+        threading.Thread(target=self.accept_requests, args=(listener,), name=f"warcprox-port-{port}", daemon=True).start()
+        return port
+
+    def accept_requests(self, listener):
+        while not self.stop.is_set():
+            # wait for a free thread in warcprox's pool before accepting, capping open connections
+            # as warcprox does for its own port (see PooledMixIn.get_request)
+            if not self.request_slots.acquire(timeout=.5):
+                continue
+            try:
+                request, client_address = listener.accept()
+            except socket.timeout:
+                self.request_slots.release()
+                continue
+            except OSError:
+                self.request_slots.release()
+                return  # listener closed
+            try:
+                self.warcprox_controller.proxy.pool.submit(self.process_request, request, client_address)
+            except RuntimeError:
+                # the pool has been shut down
+                self.request_slots.release()
+                request.close()
+                return
+
+    def process_request(self, request, client_address):
+        try:
+            self.warcprox_controller.proxy.process_request_thread(request, client_address)
+        finally:
+            self.request_slots.release()
+
+    def close_port(self, port):
+        self.warcprox_controller.proxy.capture_trackers.pop(port, None)
+        listener = self.listeners.pop(port, None)
+        if listener:
+            listener.close()
+
+    def start_recording(self, port, capture_tracker):
+        self.warcprox_controller.proxy.capture_trackers[port] = capture_tracker
+
+    def stop_recording(self, port):
+        self.warcprox_controller.proxy.capture_trackers.pop(port, None)
+
+    def warc_path(self, link):
+        return os.path.join(self.warc_dir, f"{link.guid}.warc.gz")
+
+    def close_warc(self, link):
+        """ Close the WARC being written for `link`, once warcprox's writer thread gets to it. """
+        writer_processor = self.warcprox_controller.warc_writer_processor
+        writer_processor.close_for_prefix(link.guid)
+        repeat_until_truthy(lambda: link.guid not in writer_processor.writer_pool.warc_writers, timeout=SHUTDOWN_GRACE_PERIOD)
+
+    def shutdown(self):
+        print("Shutting down warcprox.")
+        self.stop.set()
+        for port in list(self.listeners):
+            self.close_port(port)
+        self.warcprox_controller.stop.set() # send signals to shut down warc threads
+        self.warcprox_controller.proxy.pool.shutdown(wait=False) # non-blocking
+        self.warcprox_thread.join()  # wait until warcprox thread is done
+        self.warcprox_controller.warc_writer_processor.writer_pool.close_writers()  # blocking
+        shutil.rmtree(self.working_dir, ignore_errors=True)
+
+# the RecordingProxy currently shared by this process's captures
+recording_proxy = None
+recording_proxy_lock = threading.Lock()
+
+def open_recording_port():
+    """ Return the shared RecordingProxy, starting it if need be, and a new port on it. """
+    global recording_proxy
+    with recording_proxy_lock:
+        if not recording_proxy or not recording_proxy.is_running():
+            if recording_proxy:
+                recording_proxy.shutdown()
+            recording_proxy = RecordingProxy()
+        return recording_proxy, recording_proxy.open_port()
+
+def close_recording_port(proxy, port):
+    """
+        Stop listening on `port`. If nothing else is using the proxy, and we aren't keeping
+        capture environments warm, shut it down too.
+    """
+    global recording_proxy
+    with recording_proxy_lock:
+        proxy.close_port(port)
+        if proxy.listeners:
+            return
+        if proxy is recording_proxy:
+            if settings.CAPTURE_ENVIRONMENT_POOL_SIZE:
+                return
+            recording_proxy = None
+        proxy.shutdown()
+
+def shut_down_recording_proxy():
+    global recording_proxy
+    with recording_proxy_lock:
+        proxy, recording_proxy = recording_proxy, None
+    if proxy:
+        proxy.shutdown()
+
+
+class CaptureEnvironment:
+    """
+        A browser, a port on the shared RecordingProxy and (for Firefox) a virtual display, which can
+        be reused for several captures in a row, so captures don't each pay for process startup.
+
+        Call begin_capture() before each capture, to reset any state left over from the last one,
+        start_recording() to attribute the traffic on this environment's port to the capture,
+        and finish_recording() once the capture's requests are done, to close its WARC.
+    """
+    def __init__(self, user_agent):
+        self.user_agent = user_agent
+        self.uses = 0
+        self.crashed = False
+        self.visited_origins = set()
+        self.browser = self.display = self.recording_proxy = self.port = None
+        self.working_dir = tempfile.mkdtemp(prefix='perma-capture-')
+        self.download_dir = os.path.join(self.working_dir, 'downloads')
+        os.mkdir(self.download_dir)
+        try:
+            self.recording_proxy, self.port = open_recording_port()
+            self.proxy_address = f"127.0.0.1:{self.port}"
+            if settings.CAPTURE_BROWSER == 'Firefox':
+                self.display = start_virtual_display()
+            self.start_browser()
+        except:  # noqa
+            self.shutdown()
+            raise
+
+    def start_browser(self):
+        self.browser = get_browser(self.user_agent, self.proxy_address, self.recording_proxy.ca_file, self.download_dir)
+        self.browser.set_window_size(*BROWSER_SIZE)
+
+    def matches(self, user_agent):
+        return self.user_agent == user_agent
+
+    def is_healthy(self):
+        return (
+            not self.crashed and
+            self.uses < settings.CAPTURE_ENVIRONMENT_MAX_USES and
+            self.recording_proxy.is_running() and
+            browser_still_running(self.browser)
+        )
+
+    def reset_browser(self):
+        """
+            Clear cookies, cache and storage left by the last capture. Only Chrome lets us do this
+            without a restart; Firefox gets a fresh browser (and so a fresh profile) instead.
+        """
+        if settings.CAPTURE_BROWSER != 'Chrome':
+            self.browser.quit()
+            self.start_browser()
+            return
+
+        browser = self.browser
+        # close any windows the last page opened
+        for handle in browser.window_handles[1:]:
+            browser.switch_to.window(handle)
+            browser.close()
+        browser.switch_to.window(browser.window_handles[0])
+        browser.get('about:blank')
+        for cmd, params in [
+            ('Network.clearBrowserCookies', {}),
+            ('Network.clearBrowserCache', {}),
+            *(('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'}) for origin in self.visited_origins),
+        ]:
+            browser.execute('sendDevToolsCommand', {'cmd': cmd, 'params': params})
+        browser.set_window_size(*BROWSER_SIZE)
+
+    def begin_capture(self):
+        """ Clear browser state left over from earlier captures. """
+        if self.uses:
+            self.reset_browser()
+        self.visited_origins = set()
+        self.uses += 1
+
+    def start_recording(self, capture_tracker):
+        """ Attribute everything recorded from this environment's port, from now on, to the capture tracked by `capture_tracker`. """
+        self.recording_proxy.start_recording(self.port, capture_tracker)
+
+    def finish_recording(self, capture_tracker):
+        """
+            Stop the browser's activity, wait for warcprox to write everything recorded for the capture,
+            and close the capture's WARC, so that it can be read by save_warc().
+        """
+        link = capture_tracker.link
+        proxied_pairs = capture_tracker.proxied_pairs
+        if browser_still_running(self.browser):
+            # navigate away, so the page stops making requests through the proxy
+            with warn_on_exception("Exception while unloading page:"):
+                self.browser.get('about:blank')
+        else:
+            link.tags.add('browser-crashed')
+            self.crashed = True
+
+        self.visited_origins = {
+            f"{url_parts.scheme}://{url_parts.netloc}"
+            for url_parts in (urllib.parse.urlsplit(url) for url, response in list(proxied_pairs))
+        }
+
+        # wait for requests still in flight, and for the writer thread to catch up;
+        # _proxy_request and _process_url notify the tracker as each one finishes
+        with capture_tracker.activity:
+            capture_tracker.activity.wait_for(
+                lambda: all(response and response.warc_records is not None for url, response in proxied_pairs),
+                SHUTDOWN_GRACE_PERIOD
+            )
+
+        # stop recording, and close the capture's WARC
+        self.recording_proxy.stop_recording(self.port)
+        capture_tracker.remote_connection_pool.clear()
+        self.recording_proxy.close_warc(link)
+
+    def warc_path(self, link):
+        return self.recording_proxy.warc_path(link)
+
+    def clean_up(self, link):
+        """ Delete files left behind by the capture of `link`. """
+        with warn_on_exception("Exception while deleting capture files:"):
+            if os.path.exists(self.warc_path(link)):
+                os.remove(self.warc_path(link))
+            shutil.rmtree(self.download_dir)
+            os.mkdir(self.download_dir)
+
+    def shutdown(self):
+        print("Shutting down browser.")
+        if self.browser:
+            with warn_on_exception("Exception while quitting browser:"):
+                self.browser.quit()
+        if self.display:
+            self.display.stop()  # shut down virtual display
+        if self.recording_proxy:
+            close_recording_port(self.recording_proxy, self.port)
+        shutil.rmtree(self.working_dir, ignore_errors=True)
+
+
+class CaptureEnvironmentPool:
+    """
+        Warm CaptureEnvironments, kept by each worker process between capture jobs.
+        Environments are handed out only for captures with a matching user agent,
+        and are replaced after a crash or after settings.CAPTURE_ENVIRONMENT_MAX_USES captures.
+    """
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, user_agent):
+        """ Return an environment ready to record a capture, warm if possible. """
+        while True:
+            with self.lock:
+                environment = next((e for e in self.idle if e.matches(user_agent)), None)
+                if not environment:
+                    break
+                self.idle.remove(environment)
+            if environment.is_healthy():
+                try:
+                    environment.begin_capture()
+                    return environment
+                except (WebDriverException, URLError, socket_error) as e:
+                    print(f"Couldn't reset capture environment: {e}")
+            environment.shutdown()
+        environment = CaptureEnvironment(user_agent)
+        environment.begin_capture()
+        return environment
+
+    def release(self, environment, link):
+        """ Return an environment to the pool after capturing `link`, or shut it down if it shouldn't be reused. """
+        environment.clean_up(link)
+        retired = []
+        with self.lock:
+            if environment.is_healthy():
+                self.idle.append(environment)
+            else:
+                retired.append(environment)
+            # prefer the most recently used environments, which are likeliest to match the next capture
+            while len(self.idle) > settings.CAPTURE_ENVIRONMENT_POOL_SIZE * settings.CAPTURE_CONCURRENCY:
+                retired.append(self.idle.pop(0))
+        for environment in retired:
+            environment.shutdown()
+
+    def shutdown(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for environment in idle:
+            environment.shutdown()
+
+capture_environments = CaptureEnvironmentPool()
+
+@worker_process_shutdown.connect()
+@worker_shutdown.connect()
+def shut_down_capture_environments(**kwargs):
+    capture_environments.shutdown()
+    shut_down_recording_proxy()
+
+
 ### CAPTURE COMPLETION
 
-def teardown(link, thread_list, browser, display, warcprox_controller, warcprox_thread):
-    print("Shutting down browser and proxies.")
+def teardown(link, thread_list, capture_environment, capture_tracker):
+    print("Stopping capture threads.")
     for thread in thread_list:
         # wait until threads are done
         if hasattr(thread, 'stop'):
             thread.stop.set()
         thread.join()
-    if browser:
-        if not browser_still_running(browser):
-            link.tags.add('browser-crashed')
-        browser.quit()
-    if display:
-        display.stop()  # shut down virtual display
-    if warcprox_controller:
-        warcprox_controller.stop.set() # send signals to shut down warc threads
-        warcprox_controller.proxy.pool.shutdown(wait=False) # non-blocking
-    if warcprox_thread:
-        warcprox_thread.join()  # wait until warcprox thread is done
-
-    # wait for stray MitmProxyHandler threads
-    shutdown_time = time.time()
-    while True:
-        if time.time() - shutdown_time > SHUTDOWN_GRACE_PERIOD:
-            break
-        threads = threading.enumerate()
-        print(f"{len(threads)} active threads.")
-        if not any('MitmProxyHandler' in thread.name for thread in threads):
-            break
-        print("Waiting for MitmProxyHandler")
-        time.sleep(1)
-
-    if warcprox_controller:
-        warcprox_controller.warc_writer_processor.writer_pool.close_writers()  # blocking
+    if capture_environment:
+        capture_environment.finish_recording(capture_tracker)
 
 
 def process_metadata(metadata, link):
@@ -828,16 +1428,13 @@ def process_metadata(metadata, link):
     safe_save_fields(link, submitted_title=metadata['title'])
 
 
-def save_warc(warcprox_controller, capture_job, link, content_type, screenshot, successful_favicon_urls):
+def save_warc(capture_environment, capture_job, link, content_type, screenshot, successful_favicon_urls):
     # save a single warc, comprising all recorded recorded content and the screenshot
-    recorded_warc_path = os.path.join(
-        os.getcwd(),
-        warcprox_controller.options.directory,
-        f"{warcprox_controller.options.warc_filename}.warc.gz"
-    )
-    warc_size = []  # pass a mutable container to the context manager, so that it can populate it with the size of the finished warc
+    recorded_warc_path = capture_environment.warc_path(link)
+    warc_size = []  # pass mutable containers to the context manager, so that it can populate them with the size and digest of the finished warc
+    warc_digest = []
     with open(recorded_warc_path, 'rb') as recorded_warc_records, \
-         preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), warc_size) as perma_warc:
+         preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), warc_size, link.warc_pages(), warc_digest) as perma_warc:
         # screenshot first, per Perma custom
         if screenshot:
             write_resource_record_from_asset(screenshot, link.screenshot_capture.url, link.screenshot_capture.content_type, perma_warc)
@@ -847,7 +1444,8 @@ def save_warc(warcprox_controller, capture_job, link, content_type, screenshot,
     # update the db to indicate we succeeded
     safe_save_fields(
         link,
-        warc_size=warc_size[0]
+        warc_size=warc_size[0],
+        warc_digest=warc_digest[0],
     )
     safe_save_fields(
         link.primary_capture,
@@ -862,6 +1460,10 @@ def save_warc(warcprox_controller, capture_job, link, content_type, screenshot,
     save_favicons(link, successful_favicon_urls)
     capture_job.mark_completed()
 
+    # get the warc into Webrecorder now, so that the first visitor doesn't have to wait for it
+    if settings.WARM_WR_COLLECTIONS and not link.is_private:
+        warm_wr_collection.delay(link.guid)
+
 
 def save_favicons(link, successful_favicon_urls):
     if successful_favicon_urls:
@@ -888,6 +1490,28 @@ def clean_up_failed_captures():
         capture_job.link.captures.filter(status='pending').update(status='failed')
         capture_job.link.tags.add('hard-timeout-failure')
 
+@shared_task()
+def clean_up_deleted_capture_jobs():
+    """
+        Run periodically by celerybeat: take jobs for links deleted before they were captured out of the queue.
+        (Workers also skip such jobs if they reach them first; see run_capture_job.)
+
+        Also fail batch jobs still waiting on validation after CAPTURE_JOB_VALIDATION_TIMEOUT,
+        whose create_batch_links task must have been lost, so that their batches can finish.
+    """
+    deleted = CaptureJob.objects.filter(link__user_deleted=True, status='pending').update(status='deleted')
+    if deleted:
+        logger.info(f"Marked {deleted} capture jobs for deleted links as deleted.")
+
+    stalled = CaptureJob.objects.filter(
+        status='validating',
+        link_batch__started_on__lt=timezone.now() - timedelta(seconds=settings.CAPTURE_JOB_VALIDATION_TIMEOUT),
+    )
+    for capture_job in stalled:
+        capture_job.mark_failed("Failed during validation.")
+    if stalled:
+        logger.info(f"Marked {len(stalled)} capture jobs stalled in validation as failed.")
+
 ### CONTEXT MANAGERS
 
 @contextmanager
@@ -912,38 +1536,146 @@ def browser_running(browser, onfailure=None):
 
 ### TASKS ##
 
-@shared_task
-@tempdir.run_in_tempdir()
+def available_memory():
+    """ Memory available for new processes, in MB, or None if we can't tell. """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def concurrent_capture_capacity(running=0):
+    """
+        How many captures this worker process should run at once, up to settings.CAPTURE_CONCURRENCY:
+        back off when the machine is short of memory or CPU. Pass the number of captures
+        already `running`, whose memory is no longer counted as available.
+    """
+    capacity = settings.CAPTURE_CONCURRENCY
+    if capacity > 1:
+        load_per_cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if load_per_cpu > settings.CAPTURE_MAX_LOAD_PER_CPU:
+            print(f"Load average per CPU is {load_per_cpu:.2f}: running one capture at a time.")
+            capacity = 1
+        memory = available_memory()
+        if memory is not None:
+            capacity = min(capacity, running + int(memory // settings.CAPTURE_MEMORY_PER_CAPTURE))
+    return max(capacity, 1)
+
+class CaptureDeadline:
+    """
+        A time limit for a single capture. Celery's soft time limit only reaches a task's main thread,
+        so each capture thread gets its own: check() raises SoftTimeLimitExceeded once the time is up,
+        and if the capture is still stuck on its browser SHUTDOWN_GRACE_PERIOD later, the browser is quit,
+        so that the call it's waiting on returns.
+    """
+    def __init__(self, seconds):
+        self.expires_at = time.time() + seconds
+        self.browser = None
+        self.lock = threading.Lock()
+        self.timer = threading.Timer(seconds + SHUTDOWN_GRACE_PERIOD, self.quit_browser)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def remaining(self):
+        return max(self.expires_at - time.time(), 0)
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise SoftTimeLimitExceeded()
+
+    def watch(self, browser):
+        with self.lock:
+            self.browser = browser
+
+    def quit_browser(self):
+        with self.lock:
+            browser, self.browser = self.browser, None
+        if browser:
+            print("Capture timed out waiting for the browser: quitting it.")
+            with warn_on_exception("Exception while quitting browser:"):
+                browser.quit()
+
+    def cancel(self):
+        """ Call once the capture is over, before tearing it down. """
+        self.timer.cancel()
+        with self.lock:
+            self.browser = None
+
+def run_capture_job_in_thread(capture_job, finished):
+    try:
+        run_capture_job(capture_job)
+    finally:
+        db.connection.close()  # each thread gets its own database connection
+        finished.put(threading.current_thread())
+
+
+@shared_task(
+    soft_time_limit=settings.CAPTURE_POOL_SECONDS + settings.CELERY_TASK_SOFT_TIME_LIMIT + SHUTDOWN_GRACE_PERIOD,
+    time_limit=settings.CAPTURE_POOL_SECONDS + settings.CELERY_TASK_TIME_LIMIT
+)
 def run_next_capture():
     """
-        Grab and run the next CaptureJob. This will keep calling itself until there are no jobs left.
+        Run CaptureJobs, as many at once as concurrent_capture_capacity() allows, starting the next job
+        as soon as a capture finishes, for up to settings.CAPTURE_POOL_SECONDS; then wait for the captures
+        still running. Each capture runs in its own thread, with its own CaptureDeadline.
+        This will keep calling itself until there are no jobs left.
     """
     clean_up_failed_captures()
 
-    # get job to work on
-    capture_job = CaptureJob.get_next_job(reserve=True)
-    if not capture_job:
-        return  # no jobs waiting
+    stop_starting_at = time.time() + settings.CAPTURE_POOL_SECONDS
+    finished = queue.Queue()  # capture threads, as they finish
+    running = set()
+    jobs_left = True
+    while True:
+        try:
+            # fill any free slots
+            while jobs_left and time.time() < stop_starting_at and len(running) < concurrent_capture_capacity(len(running)):
+                capture_job = CaptureJob.get_next_job(reserve=True)
+                if not capture_job:
+                    jobs_left = False
+                    break
+                running.add(add_thread([], run_capture_job_in_thread, args=(capture_job, finished), name=f"capture-{capture_job.link_id}"))
+            if not running:
+                break
+            running.remove(finished.get())
+        except SoftTimeLimitExceeded:
+            # the captures' own deadlines should have stopped them by now; let them finish, but start no more
+            print("Capture pool timed out: waiting for running captures.")
+            stop_starting_at = 0
+
+    if jobs_left:
+        run_next_capture.delay()
+
+
+def run_capture_job(capture_job):
+    """
+        Capture the URL for a reserved CaptureJob.
+    """
+    deadline = CaptureDeadline(CAPTURE_TIME_LIMIT)
     try:
-        # Start warcprox process. Warcprox is a MITM proxy server and needs to be running
-        # before, during and after the headless browser.
+        # Get a warcprox process and a headless browser from the pool of capture environments.
+        # Warcprox is a MITM proxy server and needs to be running before, during and after the headless browser.
         #
-        # Start a headless browser to capture the supplied URL. Also take a screenshot if the URL is an HTML file.
+        # Use the headless browser to capture the supplied URL. Also take a screenshot if the URL is an HTML file.
         #
-        # This whole function runs with the local dir set to a temp dir by run_in_tempdir().
-        # So we can use local paths for temp files, and they'll just disappear when the function exits.
+        # Each capture environment has its own temp dirs for the files it writes, so several captures can run at once.
 
         # basic setup
         start_time = time.time()
         link = capture_job.link
         target_url = link.ascii_safe_url
-        browser = warcprox_controller = warcprox_thread = display = screenshot = content_type = None
+        capture_environment = capture_tracker = browser = screenshot = content_type = None
         have_content = have_html = False
         thread_list = []
         page_metadata = {}
         successful_favicon_urls = []
         requested_urls = set()  # all URLs we have requested -- used to avoid duplicate requests
-        stop = False
         proxy = False
 
         capture_user_agent = user_agent_for_domain(link.url_details.netloc)
@@ -968,264 +1700,16 @@ def run_next_capture():
         capture_job.attempt += 1
         capture_job.save()
 
-        # BEGIN WARCPROX SETUP
-
-        # Create a request handler class that tracks requests and responses
-        # via in-scope, shared mutable containers. (Patch inside capture function
-        # so the containers are initialized empty for every new capture.)
-        proxied_responses = {
-            "any": False,
-            "size": 0,
-            "limit_reached": False
-        }
-        proxied_pairs = []
-        tracker_lock = threading.Lock()
-
-        # Patch Warcprox's inner proxy function to be interruptible,
-        # to prevent thread leak and permit the partial capture of streamed content.
-        # See https://github.com/harvard-lil/perma/issues/2019
-        def stoppable_proxy_request(self, extra_response_headers={}):
-            '''
-            Sends the request to the remote server, then uses a ProxyingRecorder to
-            read the response and send it to the proxy client, while recording the
-            bytes in transit. Returns a tuple (request, response) where request is
-            the raw request bytes, and response is a ProxyingRecorder.
-            :param extra_response_headers: generated on warcprox._proxy_request.
-            It may contain extra HTTP headers such as ``Warcprox-Meta`` which
-            are written in the WARC record for this request.
-            '''
-            # Build request
-            req_str = f'{self.command} {self.path} {self.request_version}\r\n'
-
-            # Swallow headers that don't make sense to forward on, i.e. most
-            # hop-by-hop headers. http://tools.ietf.org/html/rfc2616#section-13.5.
-            # self.headers is an email.message.Message, which is case-insensitive
-            # and doesn't throw KeyError in __delitem__
-            for key in (
-                    'Connection', 'Proxy-Connection', 'Keep-Alive',
-                    'Proxy-Authenticate', 'Proxy-Authorization', 'Upgrade'):
-                del self.headers[key]
-
-            self.headers['Via'] = warcprox.mitmproxy.via_header_value(
-                    self.headers.get('Via'),
-                    self.request_version.replace('HTTP/', ''))
-
-            # Add headers to the request
-            # XXX in at least python3.3 str(self.headers) uses \n not \r\n :(
-            req_str += '\r\n'.join(f'{k}: {v}' for (k,v) in self.headers.items())
-
-            req = req_str.encode('latin1') + b'\r\n\r\n'
-
-            # Append message body if present to the request
-            if 'Content-Length' in self.headers:
-                req += self.rfile.read(int(self.headers['Content-Length']))
-
-            prox_rec_res = None
-            start = time.time()
-            try:
-                self.logger.debug(f'sending to remote server req={req}')
-
-                # Send it down the pipe!
-                self._remote_server_conn.sock.sendall(req)
-
-                prox_rec_res = ProxyingRecordingHTTPResponse(
-                        self._remote_server_conn.sock, proxy_client=self.connection,
-                        digest_algorithm=self.server.digest_algorithm,
-                        url=self.url, method=self.command,
-                        tmp_file_max_memory_size=self._tmp_file_max_memory_size)
-                prox_rec_res.begin(extra_response_headers=extra_response_headers)
-
-                buf = None
-                while buf != b'':
-                    try:
-                        buf = prox_rec_res.read(65536)
-                    except http_client.IncompleteRead as e:
-                        self.logger.warn(f'{e} from {self.url}')
-                        buf = e.partial
-
-                    if buf:
-                        proxied_responses["size"] += len(buf)
-
-                    if (self._max_resource_size and
-                            prox_rec_res.recorder.len > self._max_resource_size):
-                        prox_rec_res.truncated = b'length'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(f'truncating response because max resource size {self._max_resource_size} bytes exceeded for URL {self.url}')
-                        break
-                    elif ('content-length' not in self.headers and
-                           time.time() - start > 3 * 60 * 60):
-                        prox_rec_res.truncated = b'time'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(f'reached hard timeout of 3 hours fetching url without content-length: {self.url}')
-                        break
-
-                    # begin Perma changes #
-                    if stop:
-                        prox_rec_res.truncated = b'length'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(f'truncating response because stop signal received while recording {self.url}')
-                        break
-                    # end Perma changes #
-
-                self.log_request(prox_rec_res.status, prox_rec_res.recorder.len)
-                # Let's close off the remote end. If remote connection is fine,
-                # put it back in the pool to reuse it later.
-                if not is_connection_dropped(self._remote_server_conn):
-                    self._conn_pool._put_conn(self._remote_server_conn)
-
-            except Exception as e:
-                # A common error is to connect to the remote server successfully
-                # but raise a `RemoteDisconnected` exception when trying to begin
-                # downloading. Its caused by prox_rec_res.begin(...) which calls
-                # http_client._read_status(). The connection fails there.
-                # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L275
-                # Another case is when the connection is fine but the response
-                # status is problematic, raising `BadStatusLine`.
-                # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L296
-                # In both cases, the host is bad and we must add it to
-                # `bad_hostnames_ports` cache.
-                if isinstance(e, (http_client.RemoteDisconnected,
-                                  http_client.BadStatusLine)):
-                    host_port = self._hostname_port_cache_key()
-                    with self.server.bad_hostnames_ports_lock:
-                        self.server.bad_hostnames_ports[host_port] = 502
-                    self.logger.info(f'bad_hostnames_ports cache size: {len(self.server.bad_hostnames_ports)}')
-
-                # Close the connection only if its still open. If its already
-                # closed, an `OSError` "([Errno 107] Transport endpoint is not
-                # connected)" would be raised.
-                if not is_connection_dropped(self._remote_server_conn):
-                    self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                    self._remote_server_conn.sock.close()
-                raise
-            finally:
-                if prox_rec_res:
-                    prox_rec_res.close()
-
-            return req, prox_rec_res
-
-        warcprox.mitmproxy.MitmProxyHandler._inner_proxy_request = stoppable_proxy_request
-
-
-        def _proxy_request(self):
-
-            # make sure we don't capture anything in a banned IP range
-            if not url_in_allowed_ip_range(self.url):
-                return
-
-            # skip request if downloaded size exceeds MAX_ARCHIVE_FILE_SIZE.
-            if proxied_responses["limit_reached"]:
-                return
-
-            with tracker_lock:
-                proxied_pair = [self.url, None]
-                requested_urls.add(proxied_pair[0])
-                proxied_pairs.append(proxied_pair)
-            try:
-                response = _real_proxy_request(self)
-            except Exception as e:
-                # If warcprox can't handle a request/response for some reason,
-                # remove the proxied pair so that it doesn't keep trying and
-                # the capture process can proceed
-                proxied_pairs.remove(proxied_pair)
-                print(f"WarcProx exception: {e.__class__.__name__} proxying {proxied_pair[0]}")
-                return  # swallow exception
-            with tracker_lock:
-                if response:
-                    proxied_responses["any"] = True
-                    proxied_pair[1] = response
-                else:
-                    # in some cases (502? others?) warcprox is not returning a response
-                    proxied_pairs.remove(proxied_pair)
-
-        WarcProxyHandler._proxy_request = _proxy_request
-
-        # patch warcprox's  to go through proxy whenever onion_tor_socks_proxy_host is set
-        def _connect_to_remote_server(self):
-            self._conn_pool = self.server.remote_connection_pool.connection_from_host(
-                host=self.hostname, port=int(self.port), scheme='http',
-                pool_kwargs={'maxsize': 12, 'timeout': self._socket_timeout})
-
-            remote_ip = None
-
-            self._remote_server_conn = self._conn_pool._get_conn()
-            if is_connection_dropped(self._remote_server_conn):
-                if self.onion_tor_socks_proxy_host:  # Perma removed `and self.hostname.endswith('.onion')`
-                    self.logger.info(f"using tor socks proxy at {self.onion_tor_socks_proxy_host}:{self.onion_tor_socks_proxy_port or 1080} to connect to {self.hostname}")
-                    self._remote_server_conn.sock = socks.socksocket()
-                    self._remote_server_conn.sock.set_proxy(
-                            socks.SOCKS5, addr=self.onion_tor_socks_proxy_host,
-                            port=self.onion_tor_socks_proxy_port, rdns=True,
-                            username="user", password=link.guid)  # Perma added username and password, to force new IPs
-                    self._remote_server_conn.sock.settimeout(self._socket_timeout)
-                    self._remote_server_conn.sock.connect((self.hostname, int(self.port)))
-                else:
-                    self._remote_server_conn.connect()
-                    remote_ip = self._remote_server_conn.sock.getpeername()[0]
-
-                # Wrap socket if SSL is required
-                if self.is_connect:
-                    try:
-                        context = ssl.create_default_context()
-                        context.check_hostname = False
-                        context.verify_mode = ssl.CERT_NONE
-                        self._remote_server_conn.sock = context.wrap_socket(
-                                self._remote_server_conn.sock,
-                                server_hostname=self.hostname)
-                    except AttributeError:
-                        try:
-                            self._remote_server_conn.sock = ssl.wrap_socket(
-                                    self._remote_server_conn.sock)
-                        except ssl.SSLError:
-                            self.logger.warning(f"failed to establish ssl connection to {self.hostname}; python ssl library does not support SNI,consider upgrading to python 2.7.9+ or 3.4+")
-                        raise
-                    except ssl.SSLError as e:
-                        self.logger.error(f'error connecting to {self.hostname} ({remote_ip}) port {self.port}: {e}')
-                        raise
-            return self._remote_server_conn.sock
-        MitmProxyHandler._connect_to_remote_server = _connect_to_remote_server
-
-        # connect warcprox to an open port
-        warcprox_port = 27500
-        for i in range(500):
-            try:
-                options = warcprox.Options(
-                    address="127.0.0.1",
-                    port=warcprox_port,
-                    max_threads=settings.MAX_PROXY_THREADS,
-                    queue_size=settings.MAX_PROXY_QUEUE_SIZE,
-                    gzip=True,
-                    stats_db_file="",
-                    dedup_db_file="",
-                    directory="./warcs", # default, included so we can retrieve from options object
-                    warc_filename=link.guid,
-                    cacert=os.path.join(settings.SERVICES_DIR, 'warcprox', 'perma-warcprox-ca.pem'),
-                    onion_tor_socks_proxy=settings.PROXY_ADDRESS if proxy else None
-                )
-                warcprox_controller = WarcproxController(options)
-                break
-            except socket_error as e:
-                if e.errno != errno.EADDRINUSE:
-                    raise
-            warcprox_port += 1
-        else:
-            raise Exception("WarcProx couldn't find an open port.")
-        proxy_address = f"127.0.0.1:{warcprox_port}"
-
-        # start warcprox in the background
-        warcprox_thread = threading.Thread(target=warcprox_controller.run_until_shutdown, name="warcprox", args=())
-        warcprox_thread.start()
-        print("WarcProx opened.")
-        # END WARCPROX SETUP
+        # Track requests and responses, so the capture can follow along with what warcprox records
+        capture_tracker = CaptureTracker(link, proxy, thread_list, requested_urls)
+        proxied_responses = capture_tracker.proxied_responses
+        proxied_pairs = capture_tracker.proxied_pairs
 
-        browser, display = get_browser(capture_user_agent, proxy_address, warcprox_controller.proxy.ca.ca_file)
-        browser.set_window_size(*BROWSER_SIZE)
-
-        print("Tracking capture size...")
-        add_thread(thread_list, CaptureCurrentSizeThread(thread_list, proxied_responses))
+        capture_environment = capture_environments.acquire(capture_user_agent)
+        capture_environment.start_recording(capture_tracker)
+        browser = capture_environment.browser
+        deadline.watch(browser)
+        proxy_address = capture_environment.proxy_address
 
         # fetch page in the background
         inc_progress(capture_job, 1, "Fetching target URL")
@@ -1235,6 +1719,8 @@ def run_next_capture():
         # before proceeding further, wait until warcprox records a response that isn't a forward
         with browser_running(browser):
             while not have_content:
+                deadline.check()
+                last_update = proxied_responses["updates"]
                 if proxied_responses["any"]:
                     for request, response in proxied_pairs:
                         if response is None:
@@ -1267,7 +1753,8 @@ def run_next_capture():
                     raise HaltCaptureException
 
                 inc_progress(capture_job, wait_time/RESOURCE_LOAD_TIMEOUT, "Fetching target URL")
-                time.sleep(1)
+                # wake as soon as another response arrives, or after a second, to update progress
+                capture_tracker.wait_for_activity(last_update, 1)
 
         print("Fetching robots.txt ...")
         add_thread(thread_list, robots_txt_thread, args=(
@@ -1310,7 +1797,8 @@ def run_next_capture():
                 ))
 
             print("Waiting for onload event before proceeding.")
-            page_load_thread.join(max(0, ONLOAD_EVENT_TIMEOUT - (time.time() - start_time)))
+            page_load_thread.join(min(max(0, ONLOAD_EVENT_TIMEOUT - (time.time() - start_time)), deadline.remaining()))
+            deadline.check()
             if page_load_thread.is_alive():
                 print("Onload timed out")
             with browser_running(browser):
@@ -1327,10 +1815,12 @@ def run_next_capture():
             dom_tree = get_dom_tree(browser)
             get_metadata(page_metadata, dom_tree)
 
+            deadline.check()
             with browser_running(browser):
                 inc_progress(capture_job, 0.5, "Checking for scroll-loaded assets")
                 repeat_while_exception(scroll_browser, arglist=[browser], raise_after_timeout=False)
 
+            deadline.check()
             inc_progress(capture_job, 1, "Fetching media")
             with warn_on_exception("Error fetching media"):
                 dom_trees = get_all_dom_trees(browser)
@@ -1349,9 +1839,11 @@ def run_next_capture():
         load_time = time.time()
         with browser_running(browser):
             while unfinished_proxied_pairs and browser_still_running(browser):
+                deadline.check()
+                last_update = proxied_responses["updates"]
 
                 if proxied_responses["limit_reached"]:
-                    stop = True
+                    capture_tracker.stop = True
                     print("Size limit reached: not waiting for additional pending requests.")
                     break
 
@@ -1359,19 +1851,20 @@ def run_next_capture():
                 # give up after AFTER_LOAD_TIMEOUT seconds
                 wait_time = time.time() - load_time
                 if wait_time > AFTER_LOAD_TIMEOUT:
-                    stop = True
+                    capture_tracker.stop = True
                     print(f"Waited {AFTER_LOAD_TIMEOUT} seconds to finish post-load requests -- giving up.")
                     break
 
                 # Show progress to user
                 inc_progress(capture_job, wait_time/AFTER_LOAD_TIMEOUT, "Waiting for post-load requests")
 
-                # Sleep and update our list
-                time.sleep(.5)
+                # Wait for a response to arrive (checking in every half second, to update progress) and update our list
+                capture_tracker.wait_for_activity(last_update, .5)
                 unfinished_proxied_pairs = [pair for pair in unfinished_proxied_pairs if not pair[1]]
 
         # screenshot capture of html pages (not pdf, etc.)
         # (after all requests have loaded for best quality)
+        deadline.check()
         if have_html and browser_still_running(browser):
             inc_progress(capture_job, 1, "Taking screenshot")
             screenshot = get_screenshot(link, browser)
@@ -1381,12 +1874,18 @@ def run_next_capture():
     except HaltCaptureException:
         print("HaltCaptureException thrown")
     except SoftTimeLimitExceeded:
-        capture_job.link.tags.add('timeout-failure')
+        print("Capture timed out")
     except:  # noqa
-        logger.exception(f"Exception while capturing job {capture_job.link_id}:")
+        if not deadline.expired():  # otherwise, likely the browser being quit by the deadline
+            logger.exception(f"Exception while capturing job {capture_job.link_id}:")
     finally:
+        deadline.cancel()
+        if deadline.expired():
+            capture_job.link.tags.add('timeout-failure')
         try:
-            teardown(link, thread_list, browser, display, warcprox_controller, warcprox_thread)
+            if capture_tracker:
+                capture_tracker.stop = True  # truncate any responses still being recorded
+            teardown(link, thread_list, capture_environment, capture_tracker)
 
             # save page metadata
             if have_html:
@@ -1397,7 +1896,7 @@ def run_next_capture():
 
             if have_content:
                 inc_progress(capture_job, 1, "Saving web archive file")
-                save_warc(warcprox_controller, capture_job, link, content_type, screenshot, successful_favicon_urls)
+                save_warc(capture_environment, capture_job, link, content_type, screenshot, successful_favicon_urls)
                 print(f"{link.guid} capture succeeded.")
             else:
                 print(f"{link.guid} capture failed.")
@@ -1407,9 +1906,123 @@ def run_next_capture():
             logger.exception(f"Exception while finishing job {capture_job.link_id}:")
         finally:
             capture_job.link.captures.filter(status='pending').update(status='failed')
+            capture_job.link.clear_cached_captures()
             if capture_job.status == 'in_progress':
                 capture_job.mark_failed('Failed during capture.')
-    run_next_capture.delay()
+            if capture_environment:
+                capture_environments.release(capture_environment, link)
+
+
+@shared_task(acks_late=True)
+def create_batch_links(link_batch_id, usage_limit_message):
+    """
+        Check the URLs submitted for a LinkBatch, several at a time, then create Perma Links and capture
+        placeholders for the valid ones in bulk, and queue them for capture.
+        Called by LinkBatchesListView.post, which responds without waiting for this to finish.
+
+        Personal link quota is accounted for once for the whole batch: URLs beyond the user's remaining
+        links and bonus links are marked invalid, with usage_limit_message (formatted for CaptureJob.message).
+
+        Safe to run again if the worker dies partway through: only jobs still 'validating' are handled,
+        and they all leave that status in one transaction. Jobs left 'validating' if this task is lost
+        altogether are failed by clean_up_deleted_capture_jobs.
+    """
+    link_batch = LinkBatch.objects.select_related('target_folder__organization__registrar').get(pk=link_batch_id)
+    capture_jobs = list(link_batch.capture_jobs.filter(status='validating').order_by('pk'))
+    if not capture_jobs:
+        return
+    try:
+        create_links_for_capture_jobs(link_batch, capture_jobs, usage_limit_message)
+    except:  # noqa
+        # don't leave jobs waiting on validation that will never finish
+        for capture_job in link_batch.capture_jobs.filter(status='validating'):
+            capture_job.mark_failed("Failed during validation.")
+        raise
+
+
+def create_links_for_capture_jobs(link_batch, capture_jobs, usage_limit_message):
+    folder = link_batch.target_folder
+
+    links = [Link(submitted_url=clean_submitted_url(capture_job.submitted_url), created_by_id=link_batch.created_by_id) for capture_job in capture_jobs]
+
+    # look up each domain once, all at the same time, before loading any URLs
+    ips = resolve_hosts(link.host for link in links if link.submitted_url)
+    for link in links:
+        if link.submitted_url:
+            link.ip = ips[link.host]
+
+    def check_url(link):
+        if not link.submitted_url:
+            return link, "URL cannot be empty."
+        if len(link.submitted_url) > Link._meta.get_field('submitted_url').max_length:
+            return link, f"Ensure this field has no more than {Link._meta.get_field('submitted_url').max_length} characters."
+        return link, link.submitted_url_error()
+
+    with ThreadPoolExecutor(max_workers=settings.LINK_VALIDATION_THREADS) as executor:
+        checked_urls = list(executor.map(check_url, links))
+
+    valid_jobs = []
+    invalid_jobs = []
+    for capture_job, (link, error) in zip(capture_jobs, checked_urls):
+        if error:
+            capture_job.status = 'invalid'
+            capture_job.message = json.dumps({'url': [error]})
+            invalid_jobs.append(capture_job)
+        else:
+            capture_job.link = link
+            valid_jobs.append(capture_job)
+
+    with transaction.atomic():
+        # lock the user's row, so we don't collide with simultaneous link creation; see AuthenticatedLinkListView.post
+        user = LinkUser.objects.select_for_update().get(pk=link_batch.created_by_id)
+
+        # personal links count against the user's quota, using bonus links once their regular links run out
+        bonus_links_used = 0
+        if not folder.organization and not folder.sponsored_by:
+            links_remaining, _, bonus_links = user.get_links_remaining()
+            allowed = min(len(valid_jobs), links_remaining + bonus_links)
+            for capture_job in valid_jobs[allowed:]:
+                capture_job.status = 'invalid'
+                capture_job.message = usage_limit_message
+                capture_job.link = None
+                invalid_jobs.append(capture_job)
+            valid_jobs = valid_jobs[:allowed]
+            bonus_links_used = max(allowed - links_remaining, 0)
+            if bonus_links_used:
+                user.bonus_links = bonus_links - bonus_links_used
+                user.save(update_fields=['bonus_links'])
+
+        links = [capture_job.link for capture_job in valid_jobs]
+        for i, (link, guid) in enumerate(zip(links, Link.generate_guids(len(links)))):
+            # set everything Link.save and move_to_folder_for_user would
+            link.bonus_link = i >= len(links) - bonus_links_used
+            link.assign_to_folder(folder)
+            if folder.organization and folder.organization.default_to_private:
+                link.is_private = True
+            link.set_defaults(new_guid=guid)
+        bulk_create_with_history(links, Link, default_user=user)
+        Link.folders.through.objects.bulk_create(Link.folders.through(link_id=link.guid, folder_id=folder.pk) for link in links)
+        Capture.objects.bulk_create(capture for link in links for capture in [
+            Capture(link=link, role='primary', status='pending', record_type='response', url=link.submitted_url),
+            Capture(link=link, role='screenshot', status='pending', record_type='resource', url=f"file:///{link.guid}/cap.png", content_type='image/png'),
+        ])
+
+        # update cached link counts, as perma.signals.update_link_count would for each link
+        if links:
+            LinkUser.objects.filter(pk=user.pk).update(link_count=F('link_count') + len(links))
+            if folder.organization:
+                Organization.objects.filter(pk=folder.organization_id).update(link_count=F('link_count') + len(links))
+                Registrar.objects.filter(pk=folder.organization.registrar_id).update(link_count=F('link_count') + len(links))
+
+        CaptureJob.objects.bulk_update(invalid_jobs, ['status', 'message'])
+        # now that the jobs are ready for capture, give them fair places in the queue
+        for capture_job in valid_jobs:
+            capture_job.status = 'pending'
+        CaptureJob.assign_queue_orders(valid_jobs)
+        CaptureJob.objects.bulk_update(valid_jobs, ['status', 'link', 'order'])
+
+    if valid_jobs:
+        run_next_capture.delay()
 
 
 @shared_task()
@@ -1461,14 +2074,119 @@ def update_stats():
         current_week.save()
 
 
+FAN_OUT_CACHE_KEY = 'fan-out:{}'
+FAN_OUT_PROCESSED_CACHE_KEY = 'fan-out:{}:processed'
+FAN_OUT_PROCESSED_AT_CACHE_KEY = 'fan-out:{}:processed-at'
+FAN_OUT_LATEST_CACHE_KEY = 'fan-out-latest:{}'
+
+def get_fan_out_key(batch_task, selection=None):
+    """
+    Identify the fan-outs of `batch_task` over the links picked out by `selection`; see fan_out.
+    """
+    if selection is None:
+        return batch_task.name
+    return f"{batch_task.name}:{hashlib.sha1(json.dumps(selection, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]}"
+
+def fan_out(links, batch_task, batch_size=None, limit=None, selection=None):
+    """
+    Queue `batch_task` with each `batch_size` GUIDs of `links` (FAN_OUT_BATCH_SIZE by default),
+    up to `limit` in all, reading the GUIDs in order with one short query per batch, rather than
+    holding a cursor open for the whole run. Batch tasks are passed the run's `fan_out_key`,
+    and report back with record_fan_out_progress.
+
+    Progress is kept in the cache, under the batch task's name and the `selection` the caller
+    passes to describe how `links` differ from the task's usual links (explicit GUIDs, other
+    filters): if a run is interrupted, the next run over the same selection picks up after the
+    last GUID it queued, while runs over other selections keep their own progress. A new run
+    doesn't start while the last run's batches are still being processed, unless they've made
+    no progress for FAN_OUT_STALL_TIMEOUT seconds.
+
+    Returns the number of GUIDs queued.
+    """
+    name = get_fan_out_key(batch_task, selection)
+    batch_size = batch_size or settings.FAN_OUT_BATCH_SIZE
+    django_cache.set(FAN_OUT_LATEST_CACHE_KEY.format(batch_task.name), name, None)
+    progress = django_cache.get(FAN_OUT_CACHE_KEY.format(name))
+    if progress and progress['finished']:
+        processed = django_cache.get(FAN_OUT_PROCESSED_CACHE_KEY.format(name)) or 0
+        last_active = max(progress['finished'], django_cache.get(FAN_OUT_PROCESSED_AT_CACHE_KEY.format(name)) or 0)
+        if processed < progress['queued'] and time.time() - last_active < settings.FAN_OUT_STALL_TIMEOUT:
+            logger.info(f"{name}: {progress['queued'] - processed} GUIDs from the last run are still queued; not starting another.")
+            return 0
+        progress = None
+    if progress:
+        logger.info(f"{name}: resuming interrupted run after {progress['cursor']}.")
+    else:
+        progress = {'cursor': None, 'queued': 0, 'started': time.time(), 'finished': None}
+        django_cache.set(FAN_OUT_PROCESSED_CACHE_KEY.format(name), 0, None)
+        django_cache.delete(FAN_OUT_PROCESSED_AT_CACHE_KEY.format(name))
+
+    links = links.order_by('guid')
+    queued = 0
+    while limit is None or queued < limit:
+        batch = links.filter(guid__gt=progress['cursor']) if progress['cursor'] else links
+        link_guids = list(batch.values_list('guid', flat=True)[:batch_size if limit is None else min(batch_size, limit - queued)])
+        if not link_guids:
+            break
+        batch_task.delay(link_guids, fan_out_key=name)
+        queued += len(link_guids)
+        progress['cursor'] = link_guids[-1]
+        progress['queued'] += len(link_guids)
+        django_cache.set(FAN_OUT_CACHE_KEY.format(name), progress, None)
+
+    progress['finished'] = time.time()
+    django_cache.set(FAN_OUT_CACHE_KEY.format(name), progress, None)
+    logger.info(f"{name}: queued {queued} GUIDs, in batches of {batch_size}.")
+    return queued
+
+
+def record_fan_out_progress(name, count):
+    """
+    Count `count` more GUIDs as processed by the fan-out identified by fan_out_key `name`.
+    """
+    if not name:
+        # not queued by fan_out
+        return
+    try:
+        django_cache.incr(FAN_OUT_PROCESSED_CACHE_KEY.format(name), count)
+    except ValueError:
+        # not queued by fan_out
+        return
+    django_cache.set(FAN_OUT_PROCESSED_AT_CACHE_KEY.format(name), time.time(), None)
+
+
+def bulk_update_links(links, fields):
+    """
+    Save `fields` of `links` in one query, with their history, clearing the caches
+    that perma.signals would have cleared had they been saved one by one.
+    """
+    if not links:
+        return
+    bulk_update_with_history(links, Link, fields)
+    for link in links:
+        Link.invalidate_permalink_context(link.guid)
+    if any(field in Link.MEMENTO_VISIBILITY_FIELDS for field in fields):
+        for submitted_url_surt in {link.submitted_url_surt for link in links}:
+            Link.invalidate_mementos(submitted_url_surt)
+
+
 @shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
 def cache_playback_status_for_new_links():
-    links = Link.objects.permanent().filter(cached_can_play_back__isnull=True)
-    queued = 0
-    for link_guid in links.values_list('guid', flat=True):
-        cache_playback_status.delay(link_guid)
-        queued = queued + 1
-    logger.info(f"Queued {queued} links to have their playback status cached.")
+    fan_out(Link.objects.permanent().filter(cached_can_play_back__isnull=True), cache_playback_status_batch)
+
+
+@shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
+def cache_playback_status_batch(self, link_guids, fan_out_key=None):
+    try:
+        links = Link.objects.filter(guid__in=link_guids).select_related('capture_job').prefetch_related('captures')
+        changed_links = []
+        for link in links:
+            link.cached_can_play_back = link.can_play_back()
+            if link.tracker.has_changed('cached_can_play_back'):
+                changed_links.append(link)
+        bulk_update_links(changed_links, ['cached_can_play_back'])
+    finally:
+        record_fan_out_progress(fan_out_key, len(link_guids))
 
 
 @shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
@@ -1485,6 +2203,39 @@ def delete_from_internet_archive(link_guid):
         return
 
     link = Link.objects.get(guid=link_guid)
+    status = delete_link_from_internet_archive(link)
+    if status is None:
+        return False
+    link.internet_archive_upload_status = status
+    link.save(update_fields=['internet_archive_upload_status'])
+
+
+@shared_task(bind=True, acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
+def delete_batch_from_internet_archive(self, link_guids, fan_out_key=None):
+    if not settings.UPLOAD_TO_INTERNET_ARCHIVE:
+        return
+
+    try:
+        changed_links = []
+        for link in Link.objects.filter(guid__in=link_guids):
+            try:
+                status = delete_link_from_internet_archive(link)
+            except Exception:
+                logger.exception(f"Exception while deleting Link {link.guid} from IA:")
+                continue
+            if status is not None:
+                link.internet_archive_upload_status = status
+                changed_links.append(link)
+        bulk_update_links(changed_links, ['internet_archive_upload_status'])
+    finally:
+        record_fan_out_progress(fan_out_key, len(link_guids))
+
+
+def delete_link_from_internet_archive(link):
+    """
+    Delete a link's files from IA, and zero out its metadata there. Returns the link's
+    new internet_archive_upload_status, or None if it isn't in IA. Doesn't save the link.
+    """
     item = internetarchive.get_item(link.ia_identifier)
 
     metadata_identifiers = [
@@ -1495,9 +2246,9 @@ def delete_from_internet_archive(link_guid):
 
     if not item.exists:
         logger.info(f"Link {link.guid} not present in IA: skipping.")
-        return False
+        return None
 
-    link.internet_archive_upload_status = 'deleted'
+    status = 'deleted'
     for f in item.files:
         # from https://internetarchive.readthedocs.io/en/latest/api.html#deleting, Note: Some system files, such as <itemname>_meta.xml, cannot be deleted.
         if f['name'] in metadata_identifiers:
@@ -1513,7 +2264,7 @@ def delete_from_internet_archive(link_guid):
                     secret_key=settings.INTERNET_ARCHIVE_SECRET_KEY,
                 )
             except Exception:
-                link.internet_archive_upload_status = 'deletion_incomplete'
+                status = 'deletion_incomplete'
                 logger.exception(f"Link {link.guid}: attempt to delete file {f['name']} from Internet Archive failed:")
 
     metadata = {
@@ -1535,10 +2286,10 @@ def delete_from_internet_archive(link_guid):
             secret_key=settings.INTERNET_ARCHIVE_SECRET_KEY,
         )
     except Exception:
-        link.internet_archive_upload_status = 'deletion_incomplete'
+        status = 'deletion_incomplete'
         logger.exception(f"Link {link.guid}: attempt to zero out metadata on Internet Archive failed:")
 
-    link.save(update_fields=['internet_archive_upload_status'])
+    return status
 
 
 @shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
@@ -1548,15 +2299,11 @@ def delete_all_from_internet_archive(guids=None, limit=None):
 
     if guids:
         links = Link.objects.filter(guid__in=guids)
+        selection = {'guids': sorted(guids)}
     else:
         links = Link.objects.filter(internet_archive_upload_status__in=['deletion_required', 'deletion_incomplete'])
-    if limit:
-        links = links[:limit]
-    queued = 0
-    for link_guid in links.values_list('guid', flat=True):
-        delete_from_internet_archive.delay(link_guid)
-        queued = queued + 1
-    logger.info(f"Queued {queued} links for deletion from IA.")
+        selection = None
+    fan_out(links, delete_batch_from_internet_archive, limit=limit, selection=selection)
 
 
 @shared_task(acks_late=True)  # use acks_late for tasks that can be safely re-run if they fail
@@ -1564,6 +2311,7 @@ def upload_all_to_internet_archive(limit=None, max_size=None):
     if not settings.UPLOAD_TO_INTERNET_ARCHIVE:
         return
 
+    selection = {'max_size': max_size} if max_size else None
     max_size = max_size or settings.INTERNET_ARCHIVE_MAX_UPLOAD_SIZE
 
     links = Link.objects.visible_to_ia().filter(
@@ -1573,13 +2321,7 @@ def upload_all_to_internet_archive(limit=None, max_size=None):
     if max_size:
         links = links.filter(warc_size__lte=max_size)
 
-    if limit:
-        links = links[:limit]
-    queued = 0
-    for link_guid in links.values_list('guid', flat=True):
-        upload_to_internet_archive.delay(link_guid)
-        queued = queued + 1
-    logger.info(f"Queued {queued} links for upload to IA.")
+    fan_out(links, upload_batch_to_internet_archive, batch_size=settings.INTERNET_ARCHIVE_UPLOAD_BATCH_SIZE, limit=limit, selection=selection)
 
 
 @shared_task()
@@ -1597,61 +2339,208 @@ def upload_to_internet_archive(link_guid):
         logger.info(f"Queued Link {link_guid} no longer eligible for upload.")
         return
 
+    session = internet_archive_session()
+    existing_titles = internet_archive_item_titles(session, [link.ia_identifier])
+    link.internet_archive_upload_status, _ = upload_link_to_internet_archive(session, link, existing_titles, InternetArchiveBackoff())
+    link.save(update_fields=['internet_archive_upload_status'])
+
+
+@shared_task(bind=True, acks_late=True, soft_time_limit=settings.INTERNET_ARCHIVE_UPLOAD_BATCH_SECONDS + 60 * 10, time_limit=settings.INTERNET_ARCHIVE_UPLOAD_BATCH_SECONDS + 60 * 12)
+def upload_batch_to_internet_archive(self, link_guids, fan_out_key=None):
+    """
+    Upload a batch of links to IA: skip those a single search finds already uploaded,
+    then stream their warcs from storage, INTERNET_ARCHIVE_UPLOAD_CONCURRENCY at a time,
+    pausing all uploads while IA-S3 says it's overloaded.
+
+    Uploads stop being started after INTERNET_ARCHIVE_UPLOAD_BATCH_SECONDS, or not at all if IA-S3
+    is already overloaded; links left over keep their status, for the next upload_all_to_internet_archive.
+    Logs the time and size of each upload, and the batch's throughput, so the ia queue's drain rate
+    can be predicted and tuned.
+    """
+    if not settings.UPLOAD_TO_INTERNET_ARCHIVE:
+        return
+
+    try:
+        upload_links_to_internet_archive(link_guids)
+    finally:
+        record_fan_out_progress(fan_out_key, len(link_guids))
+
+
+def upload_links_to_internet_archive(link_guids):
+    # the body of upload_batch_to_internet_archive
+    session = internet_archive_session()
+    if session.s3_is_overloaded(access_key=settings.INTERNET_ARCHIVE_ACCESS_KEY):
+        logger.info(f"IA-S3 is overloaded: leaving batch of {len(link_guids)} links for the next run.")
+        return
+
+    links = {link.guid: link for link in Link.objects.filter(guid__in=link_guids)}
+    eligible_links = []
+    for link_guid in link_guids:
+        link = links.get(link_guid)
+        if not link or not link.can_upload_to_internet_archive():
+            logger.info(f"Queued Link {link_guid} no longer eligible for upload.")
+        elif link.internet_archive_upload_status == 'completed':
+            logger.info(f"Queued Link {link_guid} was already uploaded to IA: skipping.")
+        else:
+            eligible_links.append(link)
+    if not eligible_links:
+        return
+
+    existing_titles = internet_archive_item_titles(session, [link.ia_identifier for link in eligible_links])
+    backoff = InternetArchiveBackoff()
+    deadline = time.monotonic() + settings.INTERNET_ARCHIVE_UPLOAD_BATCH_SECONDS
+    batch_start = time.monotonic()
+
+    def upload(link):
+        if time.monotonic() > deadline:
+            return None
+        return upload_link_to_internet_archive(session, link, existing_titles, backoff)
+
+    uploaded_count = uploaded_bytes = unstarted_count = 0
+    changed_links = []
+    try:
+        with ThreadPoolExecutor(max_workers=settings.INTERNET_ARCHIVE_UPLOAD_CONCURRENCY) as executor:
+            for link, result in zip(eligible_links, executor.map(upload, eligible_links)):
+                if result is None:
+                    unstarted_count += 1
+                    continue
+                status, size = result
+                if status != link.internet_archive_upload_status:
+                    link.internet_archive_upload_status = status
+                    changed_links.append(link)
+                if size:
+                    uploaded_count += 1
+                    uploaded_bytes += size
+    finally:
+        # record what was done, even if we're out of time
+        bulk_update_links(changed_links, ['internet_archive_upload_status'])
+
+    elapsed = max(time.monotonic() - batch_start, 0.001)
+    logger.info(f"Uploaded {uploaded_count} links ({uploaded_bytes} bytes) to IA in {elapsed:.1f}s: "
+                f"{uploaded_count / elapsed:.2f} links/s, {uploaded_bytes / elapsed:.0f} bytes/s.")
+    if unstarted_count:
+        logger.info(f"Left {unstarted_count} links not started before the batch deadline for the next run.")
+
+
+def internet_archive_session():
+    return internetarchive.get_session(config={'s3': {
+        'access': settings.INTERNET_ARCHIVE_ACCESS_KEY,
+        'secret': settings.INTERNET_ARCHIVE_SECRET_KEY,
+    }})
+
+
+def internet_archive_item_titles(session, identifiers):
+    """
+    Return {identifier: title} for those of `identifiers` that IA's search finds, with one search.
+    The search index lags behind IA: an identifier missing here may still exist.
+    """
+    query = 'identifier:({})'.format(' OR '.join(f'"{identifier}"' for identifier in identifiers))
+    return {
+        result['identifier']: result.get('title', '')
+        for result in session.search_items(query, fields=['identifier', 'title'])
+    }
+
+
+class InternetArchiveBackoff:
+    """
+    Shared by concurrent uploads: when IA-S3 asks us to slow down, no upload starts until
+    the backoff has passed. The backoff doubles each time, up to INTERNET_ARCHIVE_UPLOAD_MAX_BACKOFF,
+    until an upload succeeds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.delay = 0
+        self.resume_at = 0
+
+    def wait(self):
+        with self.lock:
+            remaining = self.resume_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def slow_down(self):
+        with self.lock:
+            self.delay = min(max(self.delay * 2, settings.INTERNET_ARCHIVE_UPLOAD_BACKOFF), settings.INTERNET_ARCHIVE_UPLOAD_MAX_BACKOFF)
+            self.resume_at = max(self.resume_at, time.monotonic() + self.delay)
+            return self.delay
+
+    def reset(self):
+        with self.lock:
+            self.delay = 0
+
+
+def upload_link_to_internet_archive(session, link, existing_titles, backoff):
+    """
+    Upload a link's warc to IA, streamed from storage. `existing_titles` are the titles a search found for
+    items that already exist: links found there are skipped without asking IA about their items.
+    Returns the link's new internet_archive_upload_status, and the number of bytes uploaded.
+    Safe to call from several threads at once; doesn't save the link.
+    """
     url = remove_control_characters(link.submitted_url)
     metadata = {
         "collection": settings.INTERNET_ARCHIVE_COLLECTION,
-        "title": f"{link_guid}: {truncatechars(link.submitted_title, 50)}",
+        "title": f"{link.guid}: {truncatechars(link.submitted_title, 50)}",
         "mediatype": "web",
         "description": f"Perma.cc archive of {url} created on {link.creation_timestamp}.",
         "contributor": "Perma.cc",
         "submitted_url": url,
         "perma_url": protocol() + settings.HOST + reverse('single_permalink', args=[link.guid]),
-        "external-identifier": f"urn:X-perma:{link_guid}",
+        "external-identifier": f"urn:X-perma:{link.guid}",
     }
 
-    temp_warc_file = tempfile.TemporaryFile()
     try:
-        item = internetarchive.get_item(link.ia_identifier)
+        # IA's search index is eventually consistent: an item it lists, under a real title, was uploaded,
+        # but one it doesn't list (or lists as removed) may exist all the same, so ask IA about those directly
+        title = existing_titles.get(link.ia_identifier)
+        if title and title != 'Removed':
+            logger.info(f"Link {link.guid} was already uploaded to IA: skipping.")
+            return link.internet_archive_upload_status, 0
+
+        item = session.get_item(link.ia_identifier)
         if item.exists:
             if not item.metadata.get('title') or item.metadata['title'] == 'Removed':
                 # if item already exists (but has been removed),
                 # ia won't update its metadata when we attempt to re-upload:
                 # we have to explicitly modify the metadata, then upload.
-                logger.info(f"Link {link_guid} previously removed from IA: updating metadata")
+                logger.info(f"Link {link.guid} previously removed from IA: updating metadata")
                 item.modify_metadata(
                     metadata,
                     access_key=settings.INTERNET_ARCHIVE_ACCESS_KEY,
                     secret_key=settings.INTERNET_ARCHIVE_SECRET_KEY,
                 )
             else:
-                logger.info(f"Link {link_guid} was already uploaded to IA: skipping.")
-                return
-
-        # copy warc to local disk storage for upload
-        with default_storage.open(link.warc_storage_file()) as warc_file:
-            copy_file_data(warc_file, temp_warc_file)
-            temp_warc_file.seek(0)
-
-        logger.info(f"Uploading Link {link_guid} to IA.")
-        warc_name = os.path.basename(link.warc_storage_file())
-        response_list = internetarchive.upload(
-            link.ia_identifier,
-            {warc_name: temp_warc_file},
-            metadata=metadata,
-            access_key=settings.INTERNET_ARCHIVE_ACCESS_KEY,
-            secret_key=settings.INTERNET_ARCHIVE_SECRET_KEY,
-            retries=2,
-            retries_sleep=5,
-            verbose=True,
-        )
-        response_list[0].raise_for_status()
-        link.internet_archive_upload_status = 'completed'
+                logger.info(f"Link {link.guid} was already uploaded to IA: skipping.")
+                return link.internet_archive_upload_status, 0
+
+        warc_path = link.warc_storage_file()
+        size = link.warc_size or default_storage.size(warc_path)
+        for attempt in range(settings.INTERNET_ARCHIVE_UPLOAD_ATTEMPTS):
+            backoff.wait()
+            logger.info(f"Uploading Link {link.guid} to IA.")
+            start = time.monotonic()
+            try:
+                with StorageFileReader(warc_path, size) as warc_file:
+                    response_list = item.upload(
+                        {os.path.basename(warc_path): warc_file},
+                        metadata=metadata,
+                        access_key=settings.INTERNET_ARCHIVE_ACCESS_KEY,
+                        secret_key=settings.INTERNET_ARCHIVE_SECRET_KEY,
+                    )
+                response_list[0].raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                # internetarchive raises for error responses itself, including IA-S3's 503 "slow down"
+                if e.response is None or e.response.status_code != 503 or attempt == settings.INTERNET_ARCHIVE_UPLOAD_ATTEMPTS - 1:
+                    raise
+                delay = backoff.slow_down()
+                logger.info(f"IA-S3 asked us to slow down while uploading Link {link.guid}: pausing uploads for {delay}s.")
+                continue
+            break
+        backoff.reset()
+        logger.info(f"Uploaded Link {link.guid} to IA: {size} bytes in {time.monotonic() - start:.1f}s.")
+        return 'completed', size
     except Exception:
         logger.exception(f"Exception while uploading Link {link.guid} to IA:")
-        link.internet_archive_upload_status = 'failed'
-    finally:
-        temp_warc_file.close()
-        link.save(update_fields=['internet_archive_upload_status'])
+        return 'failed', 0
 
 
 @shared_task()
@@ -1687,6 +2576,36 @@ def verify_webrecorder_api_available():
     assert "Webrecorder API" in r.text
 
 
+@shared_task()
+def warm_wr_collection(guid):
+    """
+    Upload a newly captured public link to Webrecorder ahead of its first playback.
+    """
+    try:
+        Link.objects.get(guid=guid).warm_wr_collection()
+    except WebrecorderException:
+        logger.exception(f"Could not warm WR collection for {guid}")
+
+
+@shared_task()
+def warm_popular_wr_collections():
+    """
+    Run periodically by celerybeat: make sure the Webrecorder collections of the
+    most played-back public links are loaded, re-uploading any that WR has expired,
+    so that their next visitors don't have to wait for the upload.
+    """
+    guids = popular_wr_playbacks(settings.WR_WARM_POPULAR_COUNT)
+    warmed = 0
+    for link in Link.objects.filter(guid__in=guids, is_private=False, user_deleted=False):
+        if not link.can_play_back():
+            continue
+        try:
+            warmed += link.warm_wr_collection()
+        except WebrecorderException:
+            logger.exception(f"Could not warm WR collection for {link.guid}")
+    logger.info(f"Re-uploaded {warmed} of {len(guids)} popular WR collections.")
+
+
 @shared_task()
 def sync_subscriptions_from_perma_payments():
     """
@@ -1710,14 +2629,7 @@ def populate_warc_size_fields(limit=None):
     See https://github.com/harvard-lil/perma/issues/2617 and https://github.com/harvard-lil/perma/issues/2172;
     old links also often lack this metadata.
     """
-    links = Link.objects.filter(warc_size__isnull=True, cached_can_play_back=True)
-    if limit:
-        links = links[:limit]
-    queued = 0
-    for link_guid in links.values_list('guid', flat=True):
-        populate_warc_size.delay(link_guid)
-        queued = queued + 1
-    logger.info(f"Queued {queued} links for populating warc_size.")
+    fan_out(Link.objects.filter(warc_size__isnull=True, cached_can_play_back=True), populate_warc_size_batch, limit=limit)
 
 
 @shared_task(acks_late=True)
@@ -1730,3 +2642,99 @@ def populate_warc_size(link_guid):
     link = Link.objects.get(guid=link_guid)
     link.warc_size = default_storage.size(link.warc_storage_file())
     link.save(update_fields=['warc_size'])
+
+
+@shared_task(bind=True, acks_late=True)
+def populate_warc_size_batch(self, link_guids, fan_out_key=None):
+    """
+    Batch version of populate_warc_size, queued by populate_warc_size_fields.
+    """
+    try:
+        links = []
+        for link in Link.objects.filter(guid__in=link_guids):
+            try:
+                link.warc_size = default_storage.size(link.warc_storage_file())
+            except Exception:
+                logger.exception(f"Could not find the size of Link {link.guid}'s warc:")
+                continue
+            links.append(link)
+        bulk_update_links(links, ['warc_size'])
+    finally:
+        record_fan_out_progress(fan_out_key, len(link_guids))
+
+
+@shared_task(acks_late=True)
+def populate_warc_digest_fields(limit=None):
+    """
+    One-time task, to populate the warc_digest field for links whose warcs were saved before we recorded it.
+    """
+    fan_out(Link.objects.filter(warc_digest__isnull=True, cached_can_play_back=True), populate_warc_digest_batch, limit=limit)
+
+
+def storage_file_digest(file_path):
+    digest = hashlib.sha256()
+    for chunk in default_storage.iter_file_range(file_path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+@shared_task(acks_late=True)
+def populate_warc_digest(link_guid):
+    """
+    One-time task, to populate the warc_digest field for links whose warcs were saved before we recorded it.
+    """
+    link = Link.objects.get(guid=link_guid)
+    link.warc_digest = storage_file_digest(link.warc_storage_file())
+    link.save(update_fields=['warc_digest'])
+
+
+@shared_task(bind=True, acks_late=True)
+def populate_warc_digest_batch(self, link_guids, fan_out_key=None):
+    """
+    Batch version of populate_warc_digest, queued by populate_warc_digest_fields.
+    """
+    try:
+        links = []
+        for link in Link.objects.filter(guid__in=link_guids):
+            try:
+                link.warc_digest = storage_file_digest(link.warc_storage_file())
+            except Exception:
+                logger.exception(f"Could not find the digest of Link {link.guid}'s warc:")
+                continue
+            links.append(link)
+        bulk_update_links(links, ['warc_digest'])
+    finally:
+        record_fan_out_progress(fan_out_key, len(link_guids))
+
+
+# the batch tasks queued by fan_out, whose progress is shown on the admin stats page
+FAN_OUT_BATCH_TASKS = [
+    cache_playback_status_batch,
+    upload_batch_to_internet_archive,
+    delete_batch_from_internet_archive,
+    populate_warc_size_batch,
+    populate_warc_digest_batch,
+]
+
+def fan_out_progress():
+    """
+    Report the progress and throughput of the latest run of each fan-out.
+    """
+    out = []
+    for batch_task in FAN_OUT_BATCH_TASKS:
+        name = django_cache.get(FAN_OUT_LATEST_CACHE_KEY.format(batch_task.name))
+        progress = name and django_cache.get(FAN_OUT_CACHE_KEY.format(name))
+        if not progress:
+            continue
+        processed = django_cache.get(FAN_OUT_PROCESSED_CACHE_KEY.format(name)) or 0
+        processed_at = django_cache.get(FAN_OUT_PROCESSED_AT_CACHE_KEY.format(name))
+        elapsed = processed_at - progress['started'] if processed_at else 0
+        out.append({
+            'name': batch_task.name.rsplit('.', 1)[-1],
+            'started': datetime.fromtimestamp(progress['started'], tz=dt_timezone.utc),
+            'finished_queueing': datetime.fromtimestamp(progress['finished'], tz=dt_timezone.utc) if progress['finished'] else None,
+            'queued': progress['queued'],
+            'processed': processed,
+            'per_minute': round(processed / elapsed * 60, 1) if elapsed > 0 else None,
+        })
+    return out
@@ -1,5 +1,6 @@
 from datetime import timedelta
 import json
+from mock import patch
 from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
@@ -7,8 +8,8 @@ from django.test import TransactionTestCase
 from django.utils import timezone
 from rest_framework.settings import api_settings
 
-from perma.models import CaptureJob, Link, LinkUser
-from perma.tasks import clean_up_failed_captures
+from perma.models import CaptureJob, Link, LinkBatch, LinkUser
+from perma.tasks import clean_up_deleted_capture_jobs, clean_up_failed_captures, create_batch_links
 
 # TODO:
 # - check retry behavior
@@ -69,11 +70,97 @@ class CaptureJobTestCase(TransactionTestCase):
             expected_queue_position = expected_order.index(i)+1
             self.assertEqual(queue_position, expected_queue_position, "Job %s has queue position %s, should be %s." % (i, queue_position, expected_queue_position))
 
+        # test CaptureJob.queue_positions, which should agree in a single query
+        with self.assertNumQueries(1):
+            queue_positions = CaptureJob.queue_positions(jobs)
+        self.assertDictEqual(queue_positions, {job.pk: job.queue_position() for job in jobs})
+
         # test CaptureJob.get_next_job
         expected_next_jobs = [jobs[i] for i in expected_order]
         next_jobs = [CaptureJob.get_next_job(reserve=True) for i in range(len(jobs))]
         self.assertListEqual(next_jobs, expected_next_jobs)
 
+    def test_job_queue_order_with_three_users(self):
+        """ New jobs go before the first job that would give some other user a second turn. """
+        user_three = LinkUser.objects.get(pk=3)
+        jobs = [
+            create_capture_job(self.user_one),
+            create_capture_job(self.user_one),
+            create_capture_job(self.user_one),
+            create_capture_job(self.user_two),
+            create_capture_job(user_three),
+            create_capture_job(self.user_two),
+        ]
+
+        expected_order = [
+            0, 3, 4,  # u1, u2, u3
+            1, 5,  # u1, u2
+            2,  # remaining u1 job
+        ]
+        expected_next_jobs = [jobs[i] for i in expected_order]
+        next_jobs = [CaptureJob.get_next_job(reserve=True) for i in range(len(jobs))]
+        self.assertListEqual(next_jobs, expected_next_jobs)
+
+    def test_assign_queue_orders(self):
+        """ Jobs placed in the queue together get the places they'd get one at a time, without a query each. """
+        user_three = LinkUser.objects.get(pk=3)
+        jobs = [
+            create_capture_job(self.user_two),
+            create_capture_job(self.user_two),
+            create_capture_job(self.user_two),
+            create_capture_job(user_three),
+        ]
+        new_jobs = [CaptureJob(created_by=self.user_one, human=True, status='pending', order=0) for i in range(3)]
+        with self.assertNumQueries(2):
+            CaptureJob.assign_queue_orders(new_jobs)
+        CaptureJob.objects.bulk_create(new_jobs)
+
+        expected_next_jobs = [jobs[0], new_jobs[0], jobs[1], new_jobs[1], jobs[2], jobs[3], new_jobs[2]]
+        next_jobs = [CaptureJob.get_next_job(reserve=True) for i in range(len(expected_next_jobs))]
+        self.assertListEqual(next_jobs, expected_next_jobs)
+
+    @patch('perma.tasks.run_next_capture', autospec=True)
+    @patch('perma.tasks.resolve_hosts', autospec=True)
+    @patch('perma.models.LinkUser.get_links_remaining', autospec=True)
+    @patch('perma.models.Link.submitted_url_error', autospec=True)
+    def test_create_batch_links(self, submitted_url_error, get_links_remaining, resolve_hosts, run_next_capture):
+        """ Valid URLs in a batch should get links in one pass, up to the user's remaining quota. """
+        resolve_hosts.side_effect = lambda hosts: {host: '93.184.216.34' for host in hosts}
+        submitted_url_error.side_effect = lambda link, check_target=True: "Couldn't resolve domain." if 'bad' in link.submitted_url else None
+        get_links_remaining.return_value = (2, 'monthly', 1)
+        self.user_one.bonus_links = 1
+        self.user_one.save()
+
+        link_batch = LinkBatch.objects.create(created_by=self.user_one, target_folder=self.user_one.root_folder)
+        urls = ["example.com/1", "http://bad.example.com", "example.com/2", "example.com/3", "example.com/4"]
+        jobs = CaptureJob.objects.bulk_create(
+            CaptureJob(created_by=self.user_one, link_batch=link_batch, submitted_url=url, human=False, status='validating')
+            for url in urls
+        )
+        pending_job = create_capture_job(self.user_one)
+        link_count = LinkUser.objects.get(pk=self.user_one.pk).link_count
+
+        create_batch_links(link_batch.pk, json.dumps({api_settings.NON_FIELD_ERRORS_KEY: ["Over quota."]}))
+
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertEqual([job.status for job in jobs], ['pending', 'invalid', 'pending', 'pending', 'invalid'])
+        self.assertEqual(json.loads(jobs[1].message), {'url': ["Couldn't resolve domain."]})
+        self.assertEqual(json.loads(jobs[4].message), {api_settings.NON_FIELD_ERRORS_KEY: ["Over quota."]})
+        self.assertEqual(jobs[0].link.submitted_url, "http://example.com/1")
+        self.assertEqual([job.link.bonus_link for job in jobs if job.link], [False, False, True])
+        self.assertEqual(self.user_one.root_folder.links.count(), 3)
+        self.assertEqual(jobs[0].link.captures.count(), 2)
+
+        # new jobs should be queued behind the one already pending
+        self.assertEqual(len({job.order for job in jobs if job.link}), 3)
+        self.assertTrue(all(job.order > pending_job.order for job in jobs if job.link))
+
+        self.user_one.refresh_from_db()
+        self.assertEqual(self.user_one.bonus_links, 0)
+        self.assertEqual(self.user_one.link_count, link_count + 3)
+        run_next_capture.delay.assert_called_once()
+
     def test_race_condition_prevented(self):
         """ Fetch two jobs at the same time in threads and make sure same job isn't returned to both. """
         jobs = [
@@ -99,6 +186,38 @@ class CaptureJobTestCase(TransactionTestCase):
         self.assertRaisesRegex(AssertionError, r'^Items in the', self.test_race_condition_prevented)
         CaptureJob.TEST_ALLOW_RACE = False
 
+    def test_deleted_link_jobs_cleaned_up(self):
+        jobs = [
+            create_capture_job(self.user_one),
+            create_capture_job(self.user_one),
+        ]
+        jobs[0].link.safe_delete()
+        jobs[0].link.save()
+
+        clean_up_deleted_capture_jobs()
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertEqual(jobs[0].status, 'deleted')
+        self.assertEqual(jobs[1].status, 'pending')
+        self.assertEqual(CaptureJob.get_next_job(reserve=True), jobs[1])
+
+    def test_stalled_validation_failed(self):
+        link_batch = LinkBatch.objects.create(created_by=self.user_one, target_folder=self.user_one.root_folder)
+        stalled_batch = LinkBatch.objects.create(created_by=self.user_one, target_folder=self.user_one.root_folder)
+        LinkBatch.objects.filter(pk=stalled_batch.pk).update(started_on=timezone.now() - timedelta(seconds=settings.CAPTURE_JOB_VALIDATION_TIMEOUT + 60))
+        jobs = CaptureJob.objects.bulk_create(
+            CaptureJob(created_by=self.user_one, link_batch=batch, submitted_url="example.com", status='validating', order=0)
+            for batch in [link_batch, stalled_batch]
+        )
+
+        clean_up_deleted_capture_jobs()
+
+        for job in jobs:
+            job.refresh_from_db()
+        self.assertEqual(jobs[0].status, 'validating')
+        self.assertEqual(jobs[1].status, 'failed')
+        self.assertEqual(json.loads(jobs[1].message), {api_settings.NON_FIELD_ERRORS_KEY: ["Failed during validation."]})
+
     def test_hard_timeout(self):
         create_capture_job(self.user_one)
 
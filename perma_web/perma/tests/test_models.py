@@ -3,22 +3,24 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from django.conf import settings
-from django.test import override_settings
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
 from django.utils import timezone
 
-from mock import patch, sentinel
+from mock import Mock, patch, sentinel
+import requests
 
 from perma.exceptions import PermaPaymentsCommunicationException, InvalidTransmissionException
 import perma.models
 from perma.models import (
     ACTIVE_SUBSCRIPTION_STATUSES,
     FIELDS_REQUIRED_FROM_PERMA_PAYMENTS,
-    Link, LinkUser, Organization, Registrar, Folder, Sponsorship,
+    Capture, Link, LinkUser, Organization, Registrar, Folder, Sponsorship,
     link_count_in_time_period,
     most_active_org_in_time_period,
     subscription_is_active
 )
-from perma.utils import pp_date_from_post, tz_datetime, first_day_of_next_month, today_next_year
+from perma.utils import host_unreachable_reason, pp_date_from_post, tz_datetime, first_day_of_next_month, today_next_year
 
 from .utils import PermaTestCase
 
@@ -1822,3 +1824,126 @@ class ModelsTestCase(PermaTestCase):
         # the link should no longer be a bonus link
         bonus_link.refresh_from_db()
         self.assertFalse(bonus_link.bonus_link)
+
+    def test_permalink_context_cached_until_link_or_capture_saved(self):
+        context = Link.get_permalink_context('3SLN-JHX9')
+        self.assertEqual(context['link'].guid, '3SLN-JHX9')
+        # only the organization is looked up again
+        with self.assertNumQueries(1):
+            context = Link.get_permalink_context('3SLN-JHX9')
+            self.assertEqual(context['link'].primary_capture.status, 'success')
+
+        link = Link.objects.get(guid='3SLN-JHX9')
+        link.submitted_title = 'New title'
+        link.save()
+        self.assertEqual(Link.get_permalink_context('3SLN-JHX9')['link'].submitted_title, 'New title')
+
+        capture = link.primary_capture
+        capture.status = 'failed'
+        capture.save()
+        self.assertEqual(Link.get_permalink_context('3SLN-JHX9')['link'].primary_capture.status, 'failed')
+
+        with self.assertRaises(Link.DoesNotExist):
+            Link.get_permalink_context('ZZZZ-ZZZZ')
+
+    def test_permalink_context_has_current_organization(self):
+        link = Link.objects.filter(organization__isnull=False).first()
+        Link.get_permalink_context(link.guid)
+
+        # as when the link's folder is moved to another organization
+        organization = Organization.objects.exclude(pk=link.organization_id).first()
+        Link.objects.filter(pk=link.pk).update(organization=organization)
+        self.assertEqual(Link.get_permalink_context(link.guid)['link'].organization, organization)
+
+        organization.registrar.name = 'Renamed Registrar'
+        organization.registrar.save()
+        self.assertEqual(Link.get_permalink_context(link.guid)['link'].organization.registrar.name, 'Renamed Registrar')
+
+    def test_capture_role_accessors_use_prefetched_captures(self):
+        link = Link.objects.prefetch_related('captures').get(guid='3SLN-JHX9')
+        with self.assertNumQueries(0):
+            self.assertEqual(link.primary_capture.role, 'primary')
+            self.assertEqual(link.screenshot_capture.role, 'screenshot')
+            self.assertIsNone(link.favicon_capture)
+            self.assertTrue(link.has_successful_capture())
+
+        link = Link.objects.get(guid='3SLN-JHX9')
+        with self.assertNumQueries(1):
+            self.assertEqual(link.primary_capture.role, 'primary')
+            self.assertEqual(link.screenshot_capture.role, 'screenshot')
+            self.assertIsNone(link.favicon_capture)
+
+    def test_capture_role_accessors_see_new_captures(self):
+        link = Link.objects.prefetch_related('captures').get(guid='3SLN-JHX9')
+        screenshot = link.screenshot_capture
+        self.assertIsNone(link.favicon_capture)
+
+        Capture(link=link, role='favicon', status='success', record_type='response', url='http://example.com/favicon.ico').save()
+        screenshot.status = 'failed'
+        screenshot.save()
+        self.assertEqual(link.favicon_capture.role, 'favicon')
+        self.assertEqual(link.screenshot_capture.status, 'failed')
+
+
+class WarmWrCollectionTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @patch('perma.models.Link.upload_to_wr', autospec=True)
+    @patch('perma.models.query_wr_api', autospec=True)
+    def test_warm_wr_collection(self, query_wr_api, upload_to_wr):
+        link = Link(guid='ABCD-1234')
+        query_wr_api.return_value = (Mock(cookies={'__wr_sesh': 'warming-session'}), {'username': 'public', 'coll_empty': True})
+        self.assertTrue(link.warm_wr_collection())
+        upload_to_wr.assert_called_once_with(link, 'public', 'warming-session')
+
+        # already loaded: the session is reused, and nothing is uploaded
+        query_wr_api.return_value = (Mock(cookies={}), {'username': 'public', 'coll_empty': False})
+        self.assertFalse(link.warm_wr_collection())
+        self.assertEqual(query_wr_api.call_args[1]['cookie'], 'warming-session')
+        self.assertEqual(upload_to_wr.call_count, 1)
+
+    @patch('perma.models.query_wr_api', autospec=True)
+    def test_private_links_not_warmed(self, query_wr_api):
+        self.assertFalse(Link(guid='ABCD-1234', is_private=True).warm_wr_collection())
+        query_wr_api.assert_not_called()
+
+
+class UploadToWrTestCase(SimpleTestCase):
+
+    @override_settings(WR_UPLOAD_STATUS_WAIT=5)
+    @patch('perma.models.time.sleep', autospec=True)
+    @patch('perma.models.default_storage', autospec=True)
+    @patch('perma.models.query_wr_api', autospec=True)
+    def test_waits_for_upload_in_webrecorder(self, query_wr_api, default_storage, sleep):
+        query_wr_api.side_effect = [
+            (Mock(), {'upload_id': 'upload-1'}),
+            (Mock(), {'done': True}),
+        ]
+        Link(guid='ABCD-1234').upload_to_wr('public', 'session')
+        status_call = query_wr_api.call_args_list[1][1]
+        self.assertEqual(status_call['method'], 'get')
+        self.assertEqual(status_call['path'], '/upload/upload-1?user=public&wait=5.0')
+        sleep.assert_not_called()
+
+
+class LinkHeadersTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.link = Link(submitted_url='http://slow.example.com/page')
+
+    @patch('perma.models.requests.Session.send', autospec=True)
+    def test_unreachable_host_remembered(self, send):
+        send.side_effect = requests.ConnectTimeout
+        self.assertFalse(self.link.headers)
+        self.assertEqual(host_unreachable_reason('slow.example.com'), 'connection')
+
+    @patch('perma.models.requests.Session.send', autospec=True)
+    def test_slow_page_not_held_against_host(self, send):
+        send.side_effect = requests.ReadTimeout
+        self.assertFalse(self.link.headers)
+        self.assertIsNone(host_unreachable_reason('slow.example.com'))
@@ -1,10 +1,19 @@
-from mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from mock import Mock, patch
+import queue
 import requests
+import socket
+import threading
+import time
+
+from celery.exceptions import SoftTimeLimitExceeded
 
 from django.core import mail
+from django.core.cache import cache
 
-from django.test import TestCase, override_settings
-from perma.tasks import update_stats, upload_all_to_internet_archive, upload_to_internet_archive, delete_from_internet_archive, send_js_errors, verify_webrecorder_api_available
+from django.test import SimpleTestCase, TestCase, override_settings
+from perma.tasks import update_stats, upload_all_to_internet_archive, upload_to_internet_archive, upload_batch_to_internet_archive, delete_from_internet_archive, send_js_errors, upload_link_to_internet_archive, InternetArchiveBackoff, cache_playback_status_for_new_links, fan_out, fan_out_progress, FAN_OUT_CACHE_KEY, get_fan_out_key, verify_webrecorder_api_available, CaptureEnvironmentPool, concurrent_capture_capacity, open_recording_port, close_recording_port, RecordingProxy, run_next_capture, CaptureDeadline
 from perma.models import Link, UncaughtError
 
 @override_settings(CELERY_ALWAYS_EAGER=True, UPLOAD_TO_INTERNET_ARCHIVE=True)
@@ -25,6 +34,27 @@ class TaskTestCase(TestCase):
         with self.assertRaises(Link.DoesNotExist):
             upload_to_internet_archive.delay('ZZZZ-ZZZZ')
 
+    @patch('perma.tasks.internet_archive_session')
+    def testUploadBatchToInternetArchive(self, session):
+        session.return_value.s3_is_overloaded.return_value = False
+        session.return_value.search_items.return_value = []
+        item = session.return_value.get_item
+        item.return_value.exists = False
+        item.return_value.upload.return_value = [Mock(status_code=200)]
+        links = list(Link.objects.all()[:3])
+        Link.objects.filter(pk__in=[link.pk for link in links]).update(
+            cached_can_play_back=True, is_private=False, is_unlisted=False, warc_size=10, internet_archive_upload_status='not_started'
+        )
+
+        upload_batch_to_internet_archive.delay([link.guid for link in links])
+
+        # one existence check for the whole batch
+        self.assertEqual(session.return_value.search_items.call_count, 1)
+        self.assertEqual(item.return_value.upload.call_count, 3)
+        for link in links:
+            link.refresh_from_db()
+            self.assertEqual(link.internet_archive_upload_status, 'completed')
+
     def testDeleteFromInternetArchive(self):
         # test when GUID does not exist
         with self.assertRaises(Link.DoesNotExist):
@@ -65,3 +95,376 @@ class TaskTestCase(TestCase):
             mocked_get.return_value = response
             with self.assertRaises(requests.exceptions.RequestException):
                 self.assertFalse(verify_webrecorder_api_available.delay())
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True, FAN_OUT_BATCH_SIZE=2)
+class FanOutTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.batch_task = Mock()
+        self.batch_task.name = 'perma.tasks.fake_batch'
+
+    def queued_guids(self):
+        return [guid for (link_guids,), _ in self.batch_task.delay.call_args_list for guid in link_guids]
+
+    def test_batches(self):
+        links = Link.objects.order_by('guid')
+        self.assertEqual(fan_out(links, self.batch_task), links.count())
+        self.assertEqual(self.queued_guids(), list(links.values_list('guid', flat=True)))
+        self.assertTrue(all(len(link_guids) <= 2 for (link_guids,), _ in self.batch_task.delay.call_args_list))
+
+    def test_limit(self):
+        self.assertEqual(fan_out(Link.objects.all(), self.batch_task, limit=3), 3)
+        self.assertEqual(len(self.queued_guids()), 3)
+
+    def test_interrupted_run_resumed(self):
+        guids = list(Link.objects.order_by('guid').values_list('guid', flat=True))
+        cache.set(FAN_OUT_CACHE_KEY.format(get_fan_out_key(self.batch_task)), {'cursor': guids[1], 'queued': 2, 'started': 0, 'finished': None}, None)
+        fan_out(Link.objects.all(), self.batch_task)
+        self.assertEqual(self.queued_guids(), guids[2:])
+
+    def test_runs_over_other_links_kept_apart(self):
+        guids = list(Link.objects.order_by('guid').values_list('guid', flat=True))
+        # an interrupted run over all links...
+        cache.set(FAN_OUT_CACHE_KEY.format(get_fan_out_key(self.batch_task)), {'cursor': guids[-1], 'queued': len(guids), 'started': 0, 'finished': None}, None)
+        # ...doesn't affect a run over some of them
+        fan_out(Link.objects.filter(guid__in=guids[:2]), self.batch_task, selection={'guids': guids[:2]})
+        self.assertEqual(self.queued_guids(), guids[:2])
+        # and the interrupted run still resumes where it left off
+        self.batch_task.reset_mock()
+        fan_out(Link.objects.all(), self.batch_task)
+        self.assertEqual(self.queued_guids(), [])
+
+    def test_no_new_run_while_batches_outstanding(self):
+        # the mock batch task never reports progress
+        self.assertTrue(fan_out(Link.objects.all(), self.batch_task))
+        self.assertEqual(fan_out(Link.objects.all(), self.batch_task), 0)
+        with override_settings(FAN_OUT_STALL_TIMEOUT=0):
+            self.assertTrue(fan_out(Link.objects.all(), self.batch_task))
+
+    def test_cache_playback_status_for_new_links(self):
+        links = Link.objects.permanent()
+        links.update(cached_can_play_back=None)
+        count = links.count()
+        cache_playback_status_for_new_links.delay()
+        self.assertFalse(Link.objects.permanent().filter(cached_can_play_back__isnull=True).exists())
+        [progress] = fan_out_progress()
+        self.assertEqual(progress['name'], 'cache_playback_status_batch')
+        self.assertEqual((progress['queued'], progress['processed']), (count, count))
+        # and a new run can start right away
+        links.update(cached_can_play_back=None)
+        cache_playback_status_for_new_links.delay()
+        self.assertFalse(Link.objects.permanent().filter(cached_can_play_back__isnull=True).exists())
+
+
+@override_settings(INTERNET_ARCHIVE_UPLOAD_BACKOFF=0)
+class UploadLinkToInternetArchiveTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        self.item = self.session.get_item.return_value
+        self.item.exists = False
+        self.link = Link(guid='ABCD-1234', submitted_title='Example', submitted_url='http://example.com', creation_timestamp=datetime(2020, 1, 1), warc_size=10, internet_archive_upload_status='not_started')
+
+    def test_upload(self):
+        self.item.upload.return_value = [Mock(status_code=200)]
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, {}, InternetArchiveBackoff()), ('completed', 10))
+        self.session.get_item.assert_called_once_with(self.link.ia_identifier)
+        (files,), _ = self.item.upload.call_args
+        self.assertEqual(list(files), ['ABCD-1234.warc.gz'])
+
+    def test_searched_item_skipped(self):
+        existing_titles = {self.link.ia_identifier: 'ABCD-1234: Example'}
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, existing_titles, InternetArchiveBackoff()), ('not_started', 0))
+        self.session.get_item.assert_not_called()
+
+    def test_existing_item_missing_from_search_skipped(self):
+        # the search index hasn't caught up with an item that IA has
+        self.item.exists = True
+        self.item.metadata = {'title': 'ABCD-1234: Example'}
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, {}, InternetArchiveBackoff()), ('not_started', 0))
+        self.item.upload.assert_not_called()
+
+    def test_removed_item_reuploaded(self):
+        self.item.exists = True
+        self.item.metadata = {'title': 'Removed'}
+        self.item.upload.return_value = [Mock(status_code=200)]
+        existing_titles = {self.link.ia_identifier: 'Removed'}
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, existing_titles, InternetArchiveBackoff()), ('completed', 10))
+        self.item.modify_metadata.assert_called_once()
+
+    def test_retried_when_overloaded(self):
+        # internetarchive raises for IA-S3's 503s, rather than returning them
+        backoff = InternetArchiveBackoff()
+        overloaded = requests.Response()
+        overloaded.status_code = 503
+        self.item.upload.side_effect = [requests.exceptions.HTTPError(response=overloaded), [Mock(status_code=200)]]
+        with patch.object(backoff, 'slow_down', wraps=backoff.slow_down) as slow_down:
+            self.assertEqual(upload_link_to_internet_archive(self.session, self.link, {}, backoff), ('completed', 10))
+        self.assertEqual(self.item.upload.call_count, 2)
+        slow_down.assert_called_once()
+
+    @override_settings(INTERNET_ARCHIVE_UPLOAD_ATTEMPTS=2)
+    def test_fails_when_still_overloaded(self):
+        overloaded = requests.Response()
+        overloaded.status_code = 503
+        self.item.upload.side_effect = requests.exceptions.HTTPError(response=overloaded)
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, {}, InternetArchiveBackoff()), ('failed', 0))
+        self.assertEqual(self.item.upload.call_count, 2)
+
+    def test_failure(self):
+        response = requests.Response()
+        response.status_code = 500
+        self.item.upload.return_value = [response]
+        self.assertEqual(upload_link_to_internet_archive(self.session, self.link, {}, InternetArchiveBackoff()), ('failed', 0))
+
+
+class FakeCaptureEnvironment:
+    def __init__(self, user_agent):
+        self.user_agent = user_agent
+        self.healthy = True
+        self.uses = 0
+        self.was_shut_down = False
+
+    def matches(self, user_agent):
+        return self.user_agent == user_agent
+
+    def is_healthy(self):
+        return self.healthy
+
+    def begin_capture(self):
+        self.uses += 1
+
+    def clean_up(self, link):
+        pass
+
+    def shutdown(self):
+        self.was_shut_down = True
+
+
+@patch('perma.tasks.CaptureEnvironment', FakeCaptureEnvironment)
+@override_settings(CAPTURE_ENVIRONMENT_POOL_SIZE=1)
+class CaptureEnvironmentPoolTestCase(SimpleTestCase):
+
+    def test_environment_reused(self):
+        pool = CaptureEnvironmentPool()
+        environment = pool.acquire('agent')
+        pool.release(environment, None)
+        self.assertIs(pool.acquire('agent'), environment)
+        self.assertEqual(environment.uses, 2)
+        self.assertFalse(environment.was_shut_down)
+
+    def test_environment_not_shared_across_user_agents(self):
+        pool = CaptureEnvironmentPool()
+        environment = pool.acquire('agent')
+        pool.release(environment, None)
+        self.assertIsNot(pool.acquire('other agent'), environment)
+
+    def test_least_recently_used_environment_retired(self):
+        pool = CaptureEnvironmentPool()
+        first = pool.acquire('agent')
+        second = pool.acquire('other agent')
+        pool.release(first, None)
+        pool.release(second, None)
+        self.assertTrue(first.was_shut_down)
+        self.assertFalse(second.was_shut_down)
+
+    def test_unhealthy_environment_replaced(self):
+        pool = CaptureEnvironmentPool()
+        environment = pool.acquire('agent')
+        environment.healthy = False
+        pool.release(environment, None)
+        self.assertTrue(environment.was_shut_down)
+        self.assertIsNot(pool.acquire('agent'), environment)
+
+    @override_settings(CAPTURE_ENVIRONMENT_POOL_SIZE=0)
+    def test_pool_disabled(self):
+        pool = CaptureEnvironmentPool()
+        environment = pool.acquire('agent')
+        pool.release(environment, None)
+        self.assertTrue(environment.was_shut_down)
+
+
+
+class FakeRecordingProxy:
+    def __init__(self):
+        self.listeners = {}
+        self.running = True
+        self.next_port = 1
+
+    def is_running(self):
+        return self.running
+
+    def open_port(self):
+        port = self.next_port
+        self.next_port += 1
+        self.listeners[port] = None
+        return port
+
+    def close_port(self, port):
+        self.listeners.pop(port, None)
+
+    def shutdown(self):
+        self.running = False
+
+
+@patch('perma.tasks.RecordingProxy', FakeRecordingProxy)
+@patch('perma.tasks.recording_proxy', None)
+class RecordingProxyTestCase(SimpleTestCase):
+
+    @override_settings(CAPTURE_ENVIRONMENT_POOL_SIZE=1)
+    def test_proxy_shared(self):
+        proxy, port = open_recording_port()
+        other_proxy, other_port = open_recording_port()
+        self.assertIs(proxy, other_proxy)
+        self.assertNotEqual(port, other_port)
+        close_recording_port(proxy, port)
+        close_recording_port(proxy, other_port)
+        self.assertTrue(proxy.is_running())
+        self.assertIs(open_recording_port()[0], proxy)
+
+    @override_settings(CAPTURE_ENVIRONMENT_POOL_SIZE=0)
+    def test_proxy_shut_down_when_unused_and_pool_disabled(self):
+        proxy, port = open_recording_port()
+        other_proxy, other_port = open_recording_port()
+        close_recording_port(proxy, port)
+        self.assertTrue(proxy.is_running())
+        close_recording_port(proxy, other_port)
+        self.assertFalse(proxy.is_running())
+        self.assertIsNot(open_recording_port()[0], proxy)
+
+    @override_settings(CAPTURE_ENVIRONMENT_POOL_SIZE=1)
+    def test_crashed_proxy_replaced(self):
+        proxy, port = open_recording_port()
+        proxy.running = False
+        new_proxy, new_port = open_recording_port()
+        self.assertIsNot(new_proxy, proxy)
+        self.assertTrue(new_proxy.is_running())
+
+
+class RecordingProxyAcceptTestCase(SimpleTestCase):
+
+    def test_connections_capped_by_pool(self):
+        # a RecordingProxy without warcprox, whose pool has a single thread
+        proxy = RecordingProxy.__new__(RecordingProxy)
+        proxy.stop = threading.Event()
+        proxy.request_slots = threading.BoundedSemaphore(1)
+        pool = ThreadPoolExecutor(1)
+        self.addCleanup(pool.shutdown)
+        handled = queue.Queue()
+        finish_request = threading.Event()
+        def process_request_thread(request, client_address):
+            handled.put(request)
+            finish_request.wait(5)
+            request.close()
+        proxy.warcprox_controller = Mock(**{'proxy.pool': pool, 'proxy.process_request_thread': process_request_thread})
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        listener.settimeout(.1)
+        accepter = threading.Thread(target=proxy.accept_requests, args=(listener,))
+        accepter.start()
+        self.addCleanup(accepter.join)
+        self.addCleanup(proxy.stop.set)
+        clients = [socket.create_connection(listener.getsockname()) for _ in range(2)]
+        for client in clients:
+            self.addCleanup(client.close)
+
+        handled.get(timeout=5)
+        # the second connection waits for the first to finish
+        with self.assertRaises(queue.Empty):
+            handled.get(timeout=.5)
+        finish_request.set()
+        handled.get(timeout=5)
+
+
+@override_settings(CAPTURE_CONCURRENCY=4, CAPTURE_MEMORY_PER_CAPTURE=500, CAPTURE_MAX_LOAD_PER_CPU=1.5)
+@patch('perma.tasks.os.cpu_count', return_value=4)
+class ConcurrentCaptureCapacityTestCase(SimpleTestCase):
+
+    @patch('perma.tasks.available_memory', return_value=8000)
+    @patch('perma.tasks.os.getloadavg', return_value=(1.0, 1.0, 1.0))
+    def test_full_concurrency_when_idle(self, *mocks):
+        self.assertEqual(concurrent_capture_capacity(), 4)
+
+    @patch('perma.tasks.available_memory', return_value=1200)
+    @patch('perma.tasks.os.getloadavg', return_value=(1.0, 1.0, 1.0))
+    def test_limited_by_memory(self, *mocks):
+        self.assertEqual(concurrent_capture_capacity(), 2)
+
+    @patch('perma.tasks.available_memory', return_value=100)
+    @patch('perma.tasks.os.getloadavg', return_value=(1.0, 1.0, 1.0))
+    def test_always_runs_one_capture(self, *mocks):
+        self.assertEqual(concurrent_capture_capacity(), 1)
+
+    @patch('perma.tasks.available_memory', return_value=8000)
+    @patch('perma.tasks.os.getloadavg', return_value=(8.0, 8.0, 8.0))
+    def test_limited_by_load(self, *mocks):
+        self.assertEqual(concurrent_capture_capacity(), 1)
+
+    @patch('perma.tasks.available_memory', return_value=600)
+    @patch('perma.tasks.os.getloadavg', return_value=(1.0, 1.0, 1.0))
+    def test_running_captures_memory_not_available(self, *mocks):
+        self.assertEqual(concurrent_capture_capacity(running=2), 3)
+
+
+@patch('perma.tasks.clean_up_failed_captures')
+@patch('perma.tasks.concurrent_capture_capacity', return_value=2)
+class RunNextCaptureTestCase(SimpleTestCase):
+
+    def run_jobs(self, durations):
+        """ Run fake capture jobs taking the given times, returning the order they started and finished in. """
+        jobs = [Mock(link_id=i, duration=duration) for i, duration in enumerate(durations)]
+        events = []
+        lock = threading.Lock()
+        def run_capture_job(capture_job):
+            with lock:
+                events.append(('start', capture_job.link_id))
+            time.sleep(capture_job.duration)
+            with lock:
+                events.append(('finish', capture_job.link_id))
+        with patch('perma.tasks.CaptureJob.get_next_job', side_effect=lambda reserve: jobs.pop(0) if jobs else None), \
+             patch('perma.tasks.run_capture_job', side_effect=run_capture_job), \
+             patch('perma.tasks.run_next_capture.delay') as delay:
+            run_next_capture()
+        return events, delay
+
+    def test_next_job_started_when_a_slot_frees(self, *mocks):
+        events, delay = self.run_jobs([.5, .05, .05])
+        # the short jobs run one after another while the long one is still going
+        self.assertEqual(events[:2], [('start', 0), ('start', 1)])
+        self.assertLess(events.index(('start', 2)), events.index(('finish', 0)))
+        self.assertEqual(len(events), 6)
+        delay.assert_not_called()
+
+    @override_settings(CAPTURE_POOL_SECONDS=0)
+    def test_jobs_left_for_next_task(self, *mocks):
+        events, delay = self.run_jobs([.05])
+        self.assertEqual(events, [])
+        delay.assert_called_once()
+
+
+class CaptureDeadlineTestCase(SimpleTestCase):
+
+    @patch('perma.tasks.SHUTDOWN_GRACE_PERIOD', 0)
+    def test_deadline(self):
+        deadline = CaptureDeadline(.1)
+        browser = Mock()
+        deadline.watch(browser)
+        deadline.check()
+        time.sleep(.2)
+        with self.assertRaises(SoftTimeLimitExceeded):
+            deadline.check()
+        # a capture stuck on its browser has the browser quit
+        browser.quit.assert_called_once()
+
+    def test_cancelled(self):
+        deadline = CaptureDeadline(0)
+        browser = Mock()
+        deadline.watch(browser)
+        deadline.cancel()
+        self.assertTrue(deadline.expired())
+        browser.quit.assert_not_called()
@@ -1,29 +1,56 @@
 from datetime import datetime, timedelta
 import decimal
-from mock import patch, sentinel
+import gzip
+import hashlib
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from mock import Mock, patch, sentinel
+import os
+import socket
+import tempfile
+import threading
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase, override_settings
 from django.test.client import RequestFactory
 
 
 from hypothesis import given
 from hypothesis.extra.django import TestCase
 from hypothesis.strategies import characters, text, integers, booleans, datetimes, dates, decimals, uuids, binary, dictionaries
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
 from perma.utils import (
     AlphaNumericValidator,
     InvalidTransmissionException,
+    closest_memento,
     decrypt_from_perma_payments,
     encrypt_for_perma_payments,
-    get_client_ip, prep_for_perma_payments,
+    get_client_ip, get_warc_stream, prep_for_perma_payments,
     is_valid_timestamp,
+    memento_data_for_url,
+    popular_wr_playbacks,
+    preserve_perma_warc,
     process_perma_payments_transmission,
+    query_wr_api,
+    record_wr_playback,
+    resolve_host,
+    resolve_hosts,
     retrieve_fields,
+    StorageFileReader,
     stringify_data,
-    unstringify_data
+    unstringify_data,
+    write_resource_record_from_asset,
+    write_warc_records_recorded_from_web
 )
 
+from perma.models import Link
+from perma.storage_backends import FileSystemMediaStorage, S3MultipartWriter
+
 from .utils import SentinelException
 
 # Fixtures
@@ -221,3 +248,332 @@ class UtilsTestCase(TestCase):
         ci = encrypt_for_perma_payments(b)
         assert decrypt_from_perma_payments(ci) == b
 
+
+class PreservePermaWarcTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.storage = FileSystemMediaStorage(location=self.media_root.name)
+        patcher = patch('perma.utils.default_storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.media_root.cleanup)
+
+    def test_warc_streamed_to_storage(self):
+        warc_size = []
+        warc_digest = []
+        with preserve_perma_warc('ABCD-1234', datetime(2020, 1, 1), 'warcs/ABCD-1234.warc.gz', warc_size, warc_digest=warc_digest) as warc:
+            warc.write(gzip.compress(b'recorded content'))
+        path = self.storage.path('warcs/ABCD-1234.warc.gz')
+        self.assertEqual(warc_size, [os.path.getsize(path)])
+        with open(path, 'rb') as f:
+            self.assertEqual(warc_digest, [hashlib.sha256(f.read()).hexdigest()])
+        with gzip.open(path) as f:
+            contents = f.read()
+        self.assertIn(b'Perma-GUID: ABCD-1234', contents)
+        self.assertTrue(contents.endswith(b'recorded content'))
+
+    def test_warc_indexed(self):
+        pages = [{'url': 'http://example.com', 'title': 'Example', 'timestamp': datetime(2020, 1, 1)}]
+        with preserve_perma_warc('ABCD-1234', datetime(2020, 1, 1), 'warcs/ABCD-1234.warc.gz', [], pages) as warc:
+            write_resource_record_from_asset(b'screenshot', 'file:///ABCD-1234/cap.png', 'image/png', warc)
+        with open(self.storage.path('warcs/ABCD-1234.cdxj')) as f:
+            key, timestamp, fields = f.read().split(' ', 2)
+        fields = json.loads(fields)
+        self.assertEqual(fields['url'], 'file:///ABCD-1234/cap.png')
+        self.assertEqual(fields['mime'], 'image/png')
+        self.assertEqual(fields['filename'], 'ABCD-1234.warc.gz')
+        # the offset and length locate the record in the warc
+        with open(self.storage.path('warcs/ABCD-1234.warc.gz'), 'rb') as f:
+            f.seek(int(fields['offset']))
+            self.assertIn(b'screenshot', gzip.decompress(f.read(int(fields['length']))))
+        with open(self.storage.path('warcs/ABCD-1234.pages.jsonl')) as f:
+            self.assertEqual([json.loads(line) for line in f][1], {'url': 'http://example.com', 'title': 'Example', 'ts': '2020-01-01T00:00:00Z'})
+
+    def test_recorded_records_indexed_as_copied(self):
+        recorded = io.BytesIO()
+        writer = WARCWriter(recorded, gzip=True)
+        writer.write_record(writer.create_warcinfo_record('recorded.warc.gz', {'software': 'warcprox'}))
+        http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8')], protocol='HTTP/1.1')
+        writer.write_record(writer.create_warc_record('http://example.com/', 'response', payload=io.BytesIO(b'<html></html>'), http_headers=http_headers))
+        recorded.seek(0)
+        with preserve_perma_warc('ABCD-1234', datetime(2020, 1, 1), 'warcs/ABCD-1234.warc.gz', []) as warc:
+            write_warc_records_recorded_from_web(recorded, warc)
+        with open(self.storage.path('warcs/ABCD-1234.warc.gz'), 'rb') as f:
+            contents = f.read()
+        # the recorded records are copied verbatim
+        self.assertTrue(contents.endswith(recorded.getvalue()))
+        with open(self.storage.path('warcs/ABCD-1234.cdxj')) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        key, timestamp, fields = lines[0].split(' ', 2)
+        fields = json.loads(fields)
+        self.assertEqual(key, 'com,example)/')
+        self.assertEqual((fields['status'], fields['mime']), ('200', 'text/html'))
+        record = gzip.decompress(contents[int(fields['offset']):int(fields['offset']) + int(fields['length'])])
+        self.assertIn(b'WARC-Target-URI: http://example.com/', record)
+        self.assertTrue(record.rstrip().endswith(b'<html></html>'))
+
+    def test_warc_not_saved_on_exception(self):
+        warc_size = []
+        with self.assertRaises(SentinelException):
+            with preserve_perma_warc('ABCD-1234', datetime(2020, 1, 1), 'warcs/ABCD-1234.warc.gz', warc_size):
+                raise SentinelException
+        self.assertEqual(warc_size, [])
+        self.assertEqual(os.listdir(self.storage.path('warcs')), [])
+
+
+class ResolveHostTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @patch('perma.utils.socket.gethostbyname', autospec=True)
+    def test_unresolvable_host_remembered(self, gethostbyname):
+        gethostbyname.side_effect = socket.gaierror
+        self.assertFalse(resolve_host('unresolvable.example.com'))
+        self.assertFalse(resolve_host('unresolvable.example.com'))
+        gethostbyname.assert_called_once_with('unresolvable.example.com')
+
+    @patch('perma.utils.socket.gethostbyname', autospec=True)
+    def test_hosts_resolved_once(self, gethostbyname):
+        gethostbyname.side_effect = lambda host: '93.184.216.34' if host == 'example.com' else '93.184.216.35'
+        self.assertEqual(
+            resolve_hosts(['example.com', 'www.example.com', 'example.com']),
+            {'example.com': '93.184.216.34', 'www.example.com': '93.184.216.35'}
+        )
+        self.assertEqual(gethostbyname.call_count, 2)
+
+
+class FakeWebrecorderHandler(BaseHTTPRequestHandler):
+    """ Report back the cookie each request was sent with, and try to set a new one. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.dumps({'cookie': self.headers.get('Cookie'), 'port': self.client_address[1]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', '__wr_sesh=new-session; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QueryWrApiTestCase(SimpleTestCase):
+
+    def setUp(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeWebrecorderHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        settings_override = override_settings(WR_API=f'http://127.0.0.1:{server.server_port}/api/v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_connection_reused(self):
+        _, first = query_wr_api('post', '/auth/ensure_login', None, lambda code, data: code == 200)
+        _, second = query_wr_api('post', '/auth/ensure_login', None, lambda code, data: code == 200)
+        self.assertEqual(first['port'], second['port'])
+
+    def test_cookies_not_shared_between_calls(self):
+        response, data = query_wr_api('post', '/auth/ensure_login', 'visitor-one', lambda code, data: code == 200)
+        self.assertEqual(data['cookie'], '__wr_sesh=visitor-one')
+        self.assertEqual(response.cookies.get('__wr_sesh'), 'new-session')
+        _, data = query_wr_api('post', '/auth/ensure_login', None, lambda code, data: code == 200)
+        self.assertIsNone(data['cookie'])
+
+
+@override_settings(WARM_WR_COLLECTIONS=True, WR_WARMING_WINDOW=60)
+class WrPlaybackPopularityTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    @patch('perma.utils.time.time', autospec=True)
+    def test_popular_playbacks(self, mock_time):
+        mock_time.return_value = 600
+        for guid in ['AAAA-AAAA', 'BBBB-BBBB', 'BBBB-BBBB', 'CCCC-CCCC']:
+            record_wr_playback(guid)
+        # playbacks from the previous window still count
+        mock_time.return_value = 660
+        for guid in ['CCCC-CCCC', 'CCCC-CCCC']:
+            record_wr_playback(guid)
+        self.assertEqual(popular_wr_playbacks(2), ['CCCC-CCCC', 'BBBB-BBBB'])
+        # older ones don't
+        mock_time.return_value = 720
+        self.assertEqual(popular_wr_playbacks(2), ['CCCC-CCCC'])
+
+
+class MementoTestCase(SimpleTestCase):
+
+    mementos = [
+        (datetime(2014, 1, 1), 'AAAA-AAAA'),
+        (datetime(2015, 1, 1), 'BBBB-BBBB'),
+        (datetime(2015, 1, 1), 'CCCC-CCCC'),
+        (datetime(2016, 1, 1), 'DDDD-DDDD'),
+        (datetime(2017, 1, 1), 'EEEE-EEEE'),
+    ]
+
+    def test_closest_memento(self):
+        self.assertEqual(closest_memento(self.mementos, datetime(2010, 1, 1))[1], 'AAAA-AAAA')
+        self.assertEqual(closest_memento(self.mementos, datetime(2014, 3, 1))[1], 'AAAA-AAAA')
+        # of mementos at the same time, the later
+        self.assertEqual(closest_memento(self.mementos, datetime(2014, 12, 1))[1], 'CCCC-CCCC')
+        self.assertEqual(closest_memento(self.mementos, datetime(2015, 1, 1))[1], 'CCCC-CCCC')
+        # halfway between, the later
+        self.assertEqual(closest_memento(self.mementos, datetime(2016, 7, 2))[1], 'EEEE-EEEE')
+        self.assertEqual(closest_memento(self.mementos, datetime(2020, 1, 1))[1], 'EEEE-EEEE')
+
+    @override_settings(MEMENTO_TIMEMAP_PAGE_SIZE=2)
+    def test_memento_data_for_url_paged(self):
+        request = RequestFactory().get('/timemap/json/page/2/example.com')
+        data = memento_data_for_url(request, 'example.com', self.mementos, page=2, response_format='json')
+        self.assertEqual([memento['uri'] for memento in data['mementos']['list']], ['http://testserver/CCCC-CCCC', 'http://testserver/DDDD-DDDD'])
+        self.assertEqual(data['mementos']['first']['uri'], 'http://testserver/AAAA-AAAA')
+        self.assertEqual(data['mementos']['last']['uri'], 'http://testserver/EEEE-EEEE')
+        self.assertEqual(data['pages'], {
+            'count': 3,
+            'self': {'uri': 'http://testserver/timemap/json/page/2/example.com', 'from': datetime(2015, 1, 1), 'until': datetime(2016, 1, 1)},
+            'prev': {'uri': 'http://testserver/timemap/json/page/1/example.com', 'from': datetime(2014, 1, 1), 'until': datetime(2015, 1, 1)},
+            'next': {'uri': 'http://testserver/timemap/json/page/3/example.com', 'from': datetime(2017, 1, 1), 'until': datetime(2017, 1, 1)},
+        })
+        self.assertEqual(memento_data_for_url(request, 'example.com', self.mementos, page=4), {})
+
+        # no list, for timegates
+        data = memento_data_for_url(request, 'example.com', self.mementos, page=None)
+        self.assertNotIn('list', data['mementos'])
+        self.assertNotIn('pages', data)
+
+
+class StorageFileReaderTestCase(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = FileSystemMediaStorage(location=media_root.name)
+        patcher = patch('perma.utils.default_storage', storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.contents = os.urandom(1000)
+        with storage.open_for_streaming('warcs/ABCD-1234.warc.gz', send_signal=False) as f:
+            f.write(self.contents)
+
+    @override_settings(STREAMING_DOWNLOAD_CHUNK_SIZE=64)
+    def test_read(self):
+        with StorageFileReader('warcs/ABCD-1234.warc.gz', len(self.contents)) as f:
+            # as internetarchive finds the size
+            f.seek(0, os.SEEK_END)
+            self.assertEqual(f.tell(), len(self.contents))
+            f.seek(0)
+            # reads span storage chunks
+            self.assertEqual(f.read(100) + f.read(8192), self.contents)
+            self.assertEqual(f.read(100), b'')
+            # seeking to the start reads it again
+            f.seek(0)
+            self.assertEqual(f.read(), self.contents)
+            with self.assertRaises(io.UnsupportedOperation):
+                f.seek(10)
+
+
+@override_settings(STREAMING_UPLOAD_CHUNK_SIZE=10)
+class S3MultipartWriterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.s3_object = Mock()
+        self.multipart_upload = self.s3_object.initiate_multipart_upload.return_value
+        self.multipart_upload.Part.return_value.upload.side_effect = lambda Body: {'ETag': f'"{len(Body)}"'}
+        self.writer = S3MultipartWriter(self.s3_object, {'ContentType': 'application/gzip'})
+
+    def test_multipart_upload(self):
+        for i in range(5):
+            self.writer.write(b'12345678')
+        self.writer.commit()
+        self.s3_object.initiate_multipart_upload.assert_called_once_with(ContentType='application/gzip')
+        self.assertEqual([call.kwargs['Body'] for call in self.multipart_upload.Part.return_value.upload.call_args_list], [b'1234567812345678'] * 2 + [b'12345678'])
+        self.multipart_upload.complete.assert_called_once_with(MultipartUpload={'Parts': [
+            {'PartNumber': 1, 'ETag': '"16"'},
+            {'PartNumber': 2, 'ETag': '"16"'},
+            {'PartNumber': 3, 'ETag': '"8"'},
+        ]})
+        self.s3_object.put.assert_not_called()
+
+    def test_small_file(self):
+        self.writer.write(b'12345')
+        self.writer.commit()
+        self.s3_object.put.assert_called_once_with(Body=b'12345', ContentType='application/gzip')
+        self.s3_object.initiate_multipart_upload.assert_not_called()
+
+    def test_abort(self):
+        self.writer.write(b'1234567812345678')
+        self.writer.abort()
+        self.multipart_upload.abort.assert_called_once()
+        self.multipart_upload.complete.assert_not_called()
+
+
+class GetWarcStreamTestCase(SimpleTestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = FileSystemMediaStorage(location=media_root.name)
+        patcher = patch('perma.utils.default_storage', storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.warc = gzip.compress(b'recorded content') * 100
+        self.link = Link(guid='ABCD-1234', submitted_title='Example', submitted_url='http://example.com', creation_timestamp=datetime(2020, 1, 1), warc_size=len(self.warc))
+        with storage.open_for_streaming(self.link.warc_storage_file(), send_signal=False) as f:
+            f.write(self.warc)
+
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        return get_warc_stream(self.link, self.factory.get('/', **headers))
+
+    def test_full_download(self):
+        response = self.get()
+        content = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertTrue(content.endswith(self.warc))
+        self.assertIn(b'Perma-GUID: ABCD-1234', gzip.decompress(content[:-len(self.warc)]))
+        # the same warc is the same download, every time
+        self.assertEqual(b''.join(self.get().streaming_content), content)
+
+    def test_range(self):
+        content = b''.join(self.get().streaming_content)
+        for byte_range, first, last in [('bytes=10-20', 10, 20), ('bytes=-50', len(content) - 50, len(content) - 1), ('bytes=100-', 100, len(content) - 1)]:
+            response = self.get(HTTP_RANGE=byte_range)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], f'bytes {first}-{last}/{len(content)}')
+            self.assertEqual(b''.join(response.streaming_content), content[first:last + 1])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=100000-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_range_if_unchanged(self):
+        self.link.warc_digest = hashlib.sha256(self.warc).hexdigest()
+        etag = self.get()['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn(self.link.warc_digest, etag)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"').status_code, 200)
+
+    def test_range_if_unchanged_without_digest(self):
+        # without a digest of the warc, the etag is weak, and can't vouch for a range
+        etag = self.get()['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 200)
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9').status_code, 206)
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
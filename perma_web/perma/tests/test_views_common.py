@@ -214,7 +214,38 @@ class CommonViewsTestCase(PermaTestCase):
 <http://testserver/ABCD-0008>; rel=memento; datetime="Sun, 19 Jul 2015 20:21:31 GMT",
 <http://testserver/ABCD-0009>; rel=memento; datetime="Tue, 19 Jul 2016 20:21:31 GMT",
 """
-        self.assertEqual(response.content, expected)
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+    @override_settings(MEMENTO_TIMEMAP_PAGE_SIZE=2)
+    def test_timemap_link_paged(self):
+        response = self.client.get(reverse('timemap', args=['link', 'wikipedia.org']))
+        self.assertEqual(response._headers['x-memento-count'][1], '3')
+        expected = b"""\
+<wikipedia.org>; rel=original,
+<http://testserver/timegate/wikipedia.org>; rel=timegate,
+<http://testserver/timemap/link/wikipedia.org>; rel=self; type=application/link-format; from="Sat, 19 Jul 2014 20:21:31 GMT"; until="Sun, 19 Jul 2015 20:21:31 GMT",
+<http://testserver/timemap/link/wikipedia.org>; rel=timemap; type=application/link-format,
+<http://testserver/timemap/json/wikipedia.org>; rel=timemap; type=application/json,
+<http://testserver/timemap/html/wikipedia.org>; rel=timemap; type=text/html,
+<http://testserver/timemap/link/page/2/wikipedia.org>; rel=timemap; type=application/link-format; from="Tue, 19 Jul 2016 20:21:31 GMT"; until="Tue, 19 Jul 2016 20:21:31 GMT",
+<http://testserver/ABCD-0007>; rel=memento; datetime="Sat, 19 Jul 2014 20:21:31 GMT",
+<http://testserver/ABCD-0008>; rel=memento; datetime="Sun, 19 Jul 2015 20:21:31 GMT",
+"""
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+        response = self.client.get(reverse('timemap_page', args=['link', 2, 'wikipedia.org']))
+        self.assertIn(b'<http://testserver/timemap/link/page/1/wikipedia.org>; rel=timemap; type=application/link-format; from="Sat, 19 Jul 2014 20:21:31 GMT"; until="Sun, 19 Jul 2015 20:21:31 GMT",', b''.join(response.streaming_content))
+
+        response = self.client.get(reverse('timemap_page', args=['json', 3, 'wikipedia.org']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_timemap_follows_link_visibility(self):
+        self.client.get(reverse('timemap', args=['json', 'wikipedia.org']))
+        link = Link.objects.get(guid='ABCD-0009')
+        link.is_private = True
+        link.save()
+        response = self.client.get(reverse('timemap', args=['json', 'wikipedia.org']))
+        self.assertEqual(response._headers['x-memento-count'][1], '2')
 
     def test_timemap_not_found_standard(self):
         for response_type in ['link', 'json']:
@@ -5,6 +5,7 @@ import os
 from urllib.parse import urlencode
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
 
@@ -25,12 +26,12 @@ def reset_failed_test_files_folder():
 
 class PermaTestCase(TestCase):
 
-    # def tearDown(self):
-    #     # wipe cache -- see https://niwinz.github.io/django-redis/latest/#_testing_with_django_redis
-    #     from django_redis import get_redis_connection
-    #     get_redis_connection("default").flushall()
+    def tearDown(self):
+        # wipe cache, which is not rolled back with the database between tests:
+        # otherwise, e.g., Perma Link page contexts cached in one test would be served in the next
+        cache.clear()
 
-    #     return super(PermaTestCase, self).tearDown()
+        return super(PermaTestCase, self).tearDown()
 
     def log_in_user(self, user, password='pass'):
         self.client.logout()
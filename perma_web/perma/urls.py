@@ -157,6 +157,7 @@ urlpatterns = [
     url(r'^archive-error/?$', common.archive_error, name='archive_error'),
 
     # memento support
+    url(r'timemap/(?P<response_format>link|json|html)/page/(?P<page>[0-9]+)/(?P<url>.+)$', common.timemap, name='timemap_page'),
     url(r'timemap/(?P<response_format>link|json|html)/(?P<url>.+)$', common.timemap, name='timemap'),
     url(r'timegate/(?P<url>.+)$', common.timegate, name='timegate'),
 
@@ -1,11 +1,15 @@
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from django_redis import get_redis_connection
 from functools import wraps, reduce
 import hashlib
+import http.cookiejar
 from hanzo import warctools
-import itertools
+import io
 import json
 import logging
 from nacl import encoding
@@ -13,20 +17,26 @@ from nacl.public import Box, PrivateKey, PublicKey
 from netaddr import IPAddress, IPNetwork
 import operator
 import os
+import re
+from redis.exceptions import RedisError
 import requests
 import ssl
 import socket
 import string
 import surt
 import tempdir
-import tempfile
+import threading
+import time
 from ua_parser import user_agent_parser
 import unicodedata
+import uuid
 from urllib.parse import urlparse
 from urllib3 import poolmanager
+from warcio.archiveiterator import ArchiveIterator
+from warcio.timeutils import datetime_to_iso_date, datetime_to_timestamp, iso_date_to_timestamp
 from warcio.warcwriter import BufferWARCWriter
-from wsgiref.util import FileWrapper
 
+from django.core.cache import cache
 from django.core.paginator import Paginator, EmptyPage
 from django.db.models import Q
 from django.conf import settings
@@ -34,6 +44,7 @@ from django.core.exceptions import PermissionDenied, ValidationError
 from django.urls import reverse
 from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponseForbidden, Http404, StreamingHttpResponse, HttpResponse
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import available_attrs
 from django.contrib.auth.decorators import login_required
 from django.core.files.storage import default_storage
@@ -44,6 +55,8 @@ from .exceptions import InvalidTransmissionException, WebrecorderException
 
 logger = logging.getLogger(__name__)
 warn = logger.warn
+# latency of each Webrecorder API call; see query_wr_api
+wr_api_logger = logging.getLogger(f'{__name__}.wr_api')
 
 
 ### requests helpers ###
@@ -73,6 +86,61 @@ class Sec1TLSAdapter(requests.adapters.HTTPAdapter):
         super().cert_verify(conn, url, False, cert)
 
 
+_link_validation_adapters = None
+_link_validation_adapters_lock = threading.Lock()
+
+def link_validation_adapters():
+    """
+    Return a dict of requests adapters to mount on sessions that check link targets (see Link.headers).
+    They're shared by every check in this process, so validating many URLs from the same site,
+    e.g. in a link batch, reuses connections instead of opening new ones.
+    """
+    global _link_validation_adapters
+    with _link_validation_adapters_lock:
+        if _link_validation_adapters is None:
+            pool_args = {'pool_connections': settings.LINK_VALIDATION_POOL_HOSTS, 'pool_maxsize': settings.LINK_VALIDATION_POOL_SIZE}
+            _link_validation_adapters = {
+                'https://': Sec1TLSAdapter(**pool_args),
+                'http://': requests.adapters.HTTPAdapter(**pool_args),
+            }
+    return _link_validation_adapters
+
+
+### link target helpers ###
+
+def unreachable_host_cache_key(host):
+    return f'unreachable-host:{host.lower()}'
+
+def mark_host_unreachable(host, reason):
+    """
+    Remember for a while that host couldn't be resolved or loaded,
+    so that links to it fail fast instead of each waiting out the same timeout.
+    """
+    cache.set(unreachable_host_cache_key(host), reason, settings.UNREACHABLE_HOST_CACHE_TIMEOUT)
+
+def host_unreachable_reason(host):
+    """ If host was recently found to be unreachable, return why; see mark_host_unreachable. """
+    return cache.get(unreachable_host_cache_key(host))
+
+def resolve_host(host):
+    """ Return host's IP address, or False if it can't be resolved. """
+    if host_unreachable_reason(host):
+        return False
+    try:
+        return socket.gethostbyname(host)
+    except socket.gaierror:
+        mark_host_unreachable(host, 'dns')
+        return False
+
+def resolve_hosts(hosts):
+    """ Resolve several hosts at once, returning a dict of host -> IP address, or False if it can't be resolved. """
+    hosts = set(hosts)
+    if not hosts:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(hosts), settings.LINK_VALIDATION_THREADS)) as executor:
+        return dict(zip(hosts, executor.map(resolve_host, hosts)))
+
+
 ### login helpers ###
 
 def user_passes_test_or_403(test_func):
@@ -268,6 +336,13 @@ def url_in_allowed_ip_range(url):
         return False
     return ip_in_allowed_ip_range(ip)
 
+def clean_submitted_url(url):
+    """ Clean up a user-submitted url. """
+    url = url.strip()
+    if url and url[:4] != 'http':
+        url = 'http://' + url
+    return url
+
 def get_client_ip(request):
     return request.META[settings.CLIENT_IP_HEADER]
 
@@ -358,10 +433,14 @@ def url_split(url):
     """ Separate into base and query + hash"""
     return url.split('?', 1)
 
-def timemap_url(request, url, response_format):
+def timemap_url(request, url, response_format, page=None):
     base, *qs_and_hash = url_split(url)
+    if page:
+        path = reverse('timemap_page', args=[response_format, page, base])
+    else:
+        path = reverse('timemap', args=[response_format, base])
     return url_with_qs_and_hash(
-        request.build_absolute_uri(reverse('timemap', args=[response_format, base])),
+        request.build_absolute_uri(path),
         qs_and_hash[0] if qs_and_hash else ''
     )
 
@@ -375,21 +454,53 @@ def timegate_url(request, url):
 def memento_url(request, link):
     return request.build_absolute_uri(reverse('single_permalink', args=[link.guid]))
 
-def memento_data_for_url(request, url, qs=None, hash=None):
+def mementos_for_url(url):
+    """
+        Get (creation_timestamp, guid) for each memento of this URL, oldest first.
+    """
     from perma.models import Link  #noqa
     try:
         canonicalized = surt.surt(url)
     except ValueError:
-        return {}
-    mementos = [
-        {
-            'uri': memento_url(request, link),
-            'datetime': link.creation_timestamp,
-        } for link in Link.objects.visible_to_memento().filter(submitted_url_surt=canonicalized).order_by('creation_timestamp')
-    ]
+        return []
+    return Link.get_mementos(canonicalized)
+
+def closest_memento(mementos, target_datetime):
+    """
+        Find the memento nearest in time to target_datetime, preferring the later on a tie,
+        by binary search of mementos, which are sorted.
+    """
+    later = bisect.bisect_left(mementos, (target_datetime,))
+    earlier = later - 1
+    if later == len(mementos):
+        return mementos[earlier]
+    # of several mementos at the same time, take the last
+    while later + 1 < len(mementos) and mementos[later + 1][0] == mementos[later][0]:
+        later += 1
+    if earlier < 0 or mementos[later][0] - target_datetime <= target_datetime - mementos[earlier][0]:
+        return mementos[later]
+    return mementos[earlier]
+
+def memento_data_for_url(request, url, mementos, page=1, response_format='link'):
+    """
+        Describe the mementos of this URL, from mementos_for_url, listing those on the given
+        page of its timemap in the given format, or none if page is None.
+        Returns {} if there is no such page.
+    """
     if not mementos:
         return {}
-    return {
+    page_size = settings.MEMENTO_TIMEMAP_PAGE_SIZE
+    page_count = (len(mementos) - 1) // page_size + 1
+    if page is not None and not 1 <= page <= page_count:
+        return {}
+
+    def memento_data(creation_timestamp, guid):
+        return {
+            'uri': request.build_absolute_uri(reverse('single_permalink', args=[guid])),
+            'datetime': creation_timestamp,
+        }
+
+    data = {
         'self': request.build_absolute_uri(),
         'original_uri': url,
         'timegate_uri': timegate_url(request, url),
@@ -399,11 +510,33 @@ def memento_data_for_url(request, url, qs=None, hash=None):
             'html_format': timemap_url(request, url, 'html'),
         },
         'mementos': {
-            'first': mementos[0],
-            'last': mementos[-1],
-            'list': mementos,
+            'first': memento_data(*mementos[0]),
+            'last': memento_data(*mementos[-1]),
         }
     }
+    if page is not None:
+        page_mementos = mementos[(page - 1) * page_size:page * page_size]
+        data['mementos']['list'] = [memento_data(*memento) for memento in page_mementos]
+
+        # Large timemaps are paged, per https://tools.ietf.org/html/rfc7089#section-4.3,
+        # each page linking to its neighbors with the span of time it covers
+        if page_count > 1:
+            def page_data(page):
+                page_mementos = mementos[(page - 1) * page_size:page * page_size]
+                return {
+                    'uri': timemap_url(request, url, response_format, page),
+                    'from': page_mementos[0][0],
+                    'until': page_mementos[-1][0],
+                }
+            data['pages'] = {
+                'count': page_count,
+                'self': page_data(page),
+            }
+            if page > 1:
+                data['pages']['prev'] = page_data(page - 1)
+            if page < page_count:
+                data['pages']['next'] = page_data(page + 1)
+    return data
 
 
 def remove_control_characters(s):
@@ -525,22 +658,109 @@ def decrypt_from_perma_payments(ciphertext, encoder=encoding.Base64Encoder):
 #
 
 @contextmanager
-def preserve_perma_warc(guid, timestamp, destination, warc_size):
+def preserve_perma_warc(guid, timestamp, destination, warc_size, pages=None, warc_digest=None):
     """
     Context manager for opening a perma warc, ready to receive warc records.
-    Safely closes and saves the file to storage when context is exited.
+    Records are streamed to storage as they are written; the warc is saved
+    when the context is exited, unless an exception was raised. Its size, and
+    if a `warc_digest` container is passed, its SHA-256 hex digest, are then
+    appended to the containers passed in.
+
+    A CDXJ index of the records written with write_resource_record_from_asset and
+    write_warc_records_recorded_from_web, and a list of the warc's `pages` (dicts
+    with url, title and timestamp), are then saved beside it; see warc_index_paths.
     """
-    # mode set to 'ab+' as a workaround for https://bugs.python.org/issue25341
-    out = tempfile.TemporaryFile('ab+')
-    write_perma_warc_header(out, guid, timestamp)
-    try:
+    with default_storage.open_for_streaming(destination) as storage_file:
+        out = SizeCountingWriter(storage_file)
+        write_perma_warc_header(out, guid, timestamp)
         yield out
-    finally:
-        out.flush()
-        warc_size.append(out.tell())
-        out.seek(0)
-        default_storage.store_file(out, destination, overwrite=True)
-        out.close()
+        warc_size.append(out.size)
+        if warc_digest is not None:
+            warc_digest.append(out.sha256.hexdigest())
+
+    try:
+        save_warc_index(out.index, destination, pages or [])
+    except Exception:  # noqa
+        # the warc is what matters: consumers fall back to indexing it themselves
+        logger.exception(f"Could not index {destination}")
+
+class SizeCountingWriter:
+    """
+    Wraps a writable file object, keeping count of the bytes written to it, and their SHA-256,
+    and a CDXJ index of the warc records written to it, for save_warc_index.
+    """
+    mode = 'wb'  # so GzipFile, which warctools wraps around us, knows we're writable
+
+    def __init__(self, file_object):
+        self.file_object = file_object
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.index = []
+
+    def write(self, data):
+        self.file_object.write(data)
+        self.size += len(data)
+        self.sha256.update(data)
+        return len(data)
+
+    def flush(self):
+        self.file_object.flush()
+
+    def index_record(self, url, timestamp, offset, length, mime=None, status=None, digest=None):
+        """
+        Add a capture of url, stored in the `length` bytes written from `offset`, to the index.
+        """
+        fields = {'url': url}
+        if status:
+            fields['status'] = status
+        if mime:
+            fields['mime'] = mime.split(';')[0].strip()
+        if digest:
+            fields['digest'] = digest.split(':', 1)[-1]
+        fields.update(length=str(length), offset=str(offset))
+        self.index.append((surt.surt(url), timestamp, fields))
+
+    def write_records(self, warc_file):
+        """
+        Copy the gzipped warc records in warc_file to this file, indexing them as they pass.
+        """
+        start = self.size
+        records = ArchiveIterator(CopyingReader(warc_file, self))
+        for record in records:
+            if record.rec_type not in ('response', 'resource', 'revisit'):
+                continue
+            if record.http_headers:
+                status = record.http_headers.get_statuscode()
+                mime = record.http_headers.get_header('Content-Type')
+            else:
+                status = None
+                mime = record.rec_headers.get_header('Content-Type')
+            offset = records.get_record_offset()
+            records.read_to_end(record)
+            self.index_record(
+                record.rec_headers.get_header('WARC-Target-URI'),
+                iso_date_to_timestamp(record.rec_headers.get_header('WARC-Date')),
+                start + offset,
+                records.get_record_length(),
+                mime=mime,
+                status=status,
+                digest=record.rec_headers.get_header('WARC-Payload-Digest') or record.rec_headers.get_header('WARC-Block-Digest'),
+            )
+        # copy anything the iterator didn't need to read
+        copy_file_data(warc_file, self)
+
+class CopyingReader:
+    """
+    Wraps a readable file object, writing everything read from it to out_file.
+    """
+    def __init__(self, file_object, out_file):
+        self.file_object = file_object
+        self.out_file = out_file
+
+    def read(self, size=-1):
+        data = self.file_object.read(size)
+        self.out_file.write(data)
+        return data
 
 def write_perma_warc_header(out_file, guid, timestamp):
     # build warcinfo header
@@ -559,7 +779,36 @@ def write_perma_warc_header(out_file, guid, timestamp):
     warcinfo_record.write_to(out_file, gzip=True)
 
 
-def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pages):
+def warc_index_paths(warc_path):
+    """
+    Return the paths of the CDXJ index and pages list stored beside a warc.
+    >>> warc_index_paths('warcs/AB/CD/ABCD-1234.warc.gz')
+    ('warcs/AB/CD/ABCD-1234.cdxj', 'warcs/AB/CD/ABCD-1234.pages.jsonl')
+    """
+    base_path = re.sub(r'\.warc\.gz$', '', warc_path)
+    return f'{base_path}.cdxj', f'{base_path}.pages.jsonl'
+
+
+def save_warc_index(index, warc_path, pages):
+    """
+    Store a CDXJ index, from the (urlkey, timestamp, fields) entries collected by
+    SizeCountingWriter, and a list of pages in the WACZ pages.jsonl format, beside
+    the warc stored at warc_path.
+    """
+    cdxj_path, pages_path = warc_index_paths(warc_path)
+    filename = os.path.basename(warc_path)
+    with default_storage.open_for_streaming(cdxj_path, send_signal=False) as out:
+        for urlkey, timestamp, fields in sorted(index, key=lambda entry: entry[:2]):
+            out.write(f'{urlkey} {timestamp} {json.dumps(dict(fields, filename=filename))}\n'.encode('utf-8'))
+    pages_jsonl = [{'format': 'json-pages-1.0', 'id': 'pages', 'title': 'All Pages'}] + [
+        {'url': page['url'], 'ts': datetime_to_iso_date(page['timestamp']), 'title': page['title']}
+        for page in pages
+    ]
+    with default_storage.open_for_streaming(pages_path, send_signal=False) as out:
+        out.write(''.join(f'{json.dumps(line)}\n' for line in pages_jsonl).encode('utf-8'))
+
+
+def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pages, timestamp):
     # #
     # Thank you! Rhizome/Webrecorder.io/Ilya Kreymer
     # #
@@ -579,23 +828,34 @@ def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pag
                           ('format', 'WARC File Format 1.0'),
                           ('json-metadata', json.dumps(coll_metadata))])
 
-    record = writer.create_warcinfo_record(filename, params)
-    writer.write_record(record)
+    def write_warcinfo_record():
+        # Make the same metadata produce the same bytes every time, so that downloads
+        # of the same warc can be cached and resumed: derive the record's ID from its
+        # contents, and date it with the link's creation, rather than with now.
+        record = writer.create_warcinfo_record(filename, params)
+        record.rec_headers.replace_header('WARC-Record-ID', f"<urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, f'{filename}#{json.dumps(params)}')}>")
+        record.rec_headers.replace_header('WARC-Date', datetime_to_iso_date(timestamp))
+        writer.write_record(record)
+
+    write_warcinfo_record()
 
     # Rec Info
     params['json-metadata'] = json.dumps(rec_metadata)
 
-    record = writer.create_warcinfo_record(filename, params)
-    writer.write_record(record)
+    write_warcinfo_record()
 
     return writer.get_contents()
 
 
 def write_warc_records_recorded_from_web(source_file_handle, out_file):
     """
-    Copies a series of pre-recorded WARC Request/Response records to out_file
+    Copies a series of pre-recorded WARC Request/Response records to out_file,
+    indexing them if out_file is a perma warc.
     """
-    copy_file_data(source_file_handle, out_file)
+    if isinstance(out_file, SizeCountingWriter):
+        out_file.write_records(source_file_handle)
+    else:
+        copy_file_data(source_file_handle, out_file)
 
 
 def write_resource_record_from_asset(data, url, content_type, out_file, extra_headers=None):
@@ -603,20 +863,127 @@ def write_resource_record_from_asset(data, url, content_type, out_file, extra_he
     Constructs a single WARC resource record from an asset (screenshot, uploaded file, etc.)
     and writes to out_file.
     """
-    warc_date = warctools.warc.warc_datetime_str(timezone.now()).replace(b'+00:00Z', b'Z')
+    now = timezone.now()
+    warc_date = warctools.warc.warc_datetime_str(now).replace(b'+00:00Z', b'Z')
+    digest = f'sha1:{hashlib.sha1(data).hexdigest()}'
     headers = [
         (warctools.WarcRecord.TYPE, warctools.WarcRecord.RESOURCE),
         (warctools.WarcRecord.ID, warctools.WarcRecord.random_warc_uuid()),
         (warctools.WarcRecord.DATE, warc_date),
         (warctools.WarcRecord.URL, bytes(url, 'utf-8')),
-        (warctools.WarcRecord.BLOCK_DIGEST, bytes(f'sha1:{hashlib.sha1(data).hexdigest()}', 'utf-8'))
+        (warctools.WarcRecord.BLOCK_DIGEST, bytes(digest, 'utf-8'))
     ]
     if extra_headers:
         headers.extend(extra_headers)
     record = warctools.WarcRecord(headers=headers, content=(bytes(content_type, 'utf-8'), data))
-    record.write_to(out_file, gzip=True)
+    if isinstance(out_file, SizeCountingWriter):
+        offset = out_file.size
+        record.write_to(out_file, gzip=True)
+        out_file.index_record(url, datetime_to_timestamp(now), offset, out_file.size - offset, mime=content_type, digest=digest)
+    else:
+        record.write_to(out_file, gzip=True)
+
+def parse_byte_range(range_header, size):
+    """
+    Return the (first, last) byte positions requested by the Range header of a request
+    for a file of `size` bytes, or None if the header should be ignored (it's missing,
+    malformed, or asks for more than one range), or False if the range can't be satisfied.
+    >>> parse_byte_range('bytes=10-', 100), parse_byte_range('bytes=-10', 100), parse_byte_range('bytes=100-', 100)
+    ((10, 99), (90, 99), False)
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (range_header or '').strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last N bytes
+        if not int(last):
+            return False
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    return first, min(int(last), size - 1) if last else size - 1
 
-def get_warc_stream(link, stream=True):
+
+def iter_warc_download(warcinfo, warc_path, first, last):
+    """
+    Yield bytes first through last of a warc download: the warcinfo
+    followed by the stored warc, reading only what's needed from storage.
+    """
+    if first < len(warcinfo):
+        yield warcinfo[first:last + 1]
+    if last >= len(warcinfo):
+        warc_first = max(first - len(warcinfo), 0)
+        yield from default_storage.iter_file_range(warc_path, warc_first, last - len(warcinfo) + 1 - warc_first)
+
+
+class StorageFileReader:
+    """
+    A read-only file object for a `size`-byte file in storage, read in chunks as it's consumed,
+    for libraries that want a file to upload, like internetarchive. Those seek to the end to find
+    the size, and back to the start to (re)send it; seeking to the start begins a new read.
+    """
+    def __init__(self, file_path, size):
+        self.name = file_path
+        self.size = size
+        self.chunks = None
+        self.seek(0)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence not in (os.SEEK_SET, os.SEEK_END):
+            raise io.UnsupportedOperation("can only seek to the start or end")
+        self.close()
+        if whence == os.SEEK_SET:
+            self.position = 0
+            self.chunks = default_storage.iter_file_range(self.name)
+        else:
+            self.position = self.size
+            self.chunks = iter(())
+        self.chunk = b''
+        self.chunk_offset = 0
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        pieces = []
+        wanted = size if size is not None else -1
+        while wanted != 0:
+            if self.chunk_offset >= len(self.chunk):
+                self.chunk = next(self.chunks, b'')
+                self.chunk_offset = 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if wanted < 0 else min(len(self.chunk), self.chunk_offset + wanted)
+            pieces.append(self.chunk[self.chunk_offset:end])
+            if wanted > 0:
+                wanted -= end - self.chunk_offset
+            self.chunk_offset = end
+        data = b''.join(pieces)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_warc_stream(link, request=None):
+    """
+    Respond with a link's warc, preceded by a warcinfo record describing the link.
+    Supports conditional and single-range requests, so that downloads can be
+    cached and resumed, and client-side playback can fetch just the records it needs.
+    """
     filename = f"{link.guid}.warc.gz"
 
     timestamp = link.creation_timestamp.strftime('%Y%m%d%H%M%S')
@@ -631,31 +998,70 @@ def get_warc_stream(link, stream=True):
             'title': link.submitted_title,
             'url': link.submitted_url,
             'timestamp': timestamp
-        }]
+        }],
+        timestamp = link.creation_timestamp,
     )
-
-    warc_stream = FileWrapper(default_storage.open(link.warc_storage_file()))
-    warc_stream = itertools.chain([warcinfo], warc_stream)
-    if stream:
-        response = StreamingHttpResponse(warc_stream, content_type="application/gzip")
+    warc_path = link.warc_storage_file()
+    warc_size = link.warc_size or default_storage.size(warc_path)
+    # the download is only byte-for-byte identical if the warc's contents are: without
+    # a digest of them, the size alone can't promise that, so the etag is weak
+    warcinfo_hash = hashlib.sha1(warcinfo).hexdigest()[:16]
+    if link.warc_digest:
+        etag = f'"{warcinfo_hash}-{link.warc_digest}"'
     else:
-        response = HttpResponse(warc_stream, content_type="application/gzip")
+        etag = f'W/"{warcinfo_hash}-{warc_size}"'
+    return byte_range_response(
+        request,
+        len(warcinfo) + warc_size,
+        etag,
+        lambda first, last: iter_warc_download(warcinfo, warc_path, first, last),
+        filename,
+    )
+
+def byte_range_response(request, size, etag, iter_range, filename, content_type="application/gzip"):
+    """
+    Respond with a file of `size` bytes, whose bytes first through last are yielded by
+    iter_range(first, last). Supports conditional and single-range requests; ranges are
+    only honored for If-Range requests if `etag` is strong.
+    """
+    byte_range = None
+    if request:
+        conditional_response = get_conditional_response(request, etag=etag)
+        if conditional_response:
+            conditional_response['ETag'] = etag
+            return conditional_response
+        # If-Range: only send part of the file if it hasn't changed
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or (if_range == etag and not etag.startswith('W/')):
+            byte_range = parse_byte_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    first, last = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(iter_range(first, last), status=206 if byte_range else 200, content_type=content_type)
+    response['Content-Length'] = last - first + 1
+    if byte_range:
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
     return response
 
-def stream_warc(link, stream=True):
+def stream_warc(link, request=None):
     # `link.user_deleted` is checked here for dev convenience:
     # it's easy to forget that deleted links/warcs aren't truly deleted,
     # and easy to accidentally permit the downloading of "deleted" warcs.
     # Users of stream_warc shouldn't have to worry about / remember this.
     if link.user_deleted or not link.can_play_back():
         raise Http404
-    return get_warc_stream(link, stream)
+    return get_warc_stream(link, request)
 
-def stream_warc_if_permissible(link, user, stream=True):
+def stream_warc_if_permissible(link, user, request=None):
     if user.can_view(link):
-        return stream_warc(link, stream)
+        return stream_warc(link, request)
     return HttpResponseForbidden('Private archive.')
 
 
@@ -695,20 +1101,55 @@ def clear_wr_session(request, error_if_wr_user_not_found=False):
         logger.log(log_level, f'Attempt to delete {wr_temp_username} from WR failed: already expired?')
 
 
+_wr_api_session = None
+_wr_api_session_lock = threading.Lock()
+
+def wr_api_session():
+    """
+    Return the requests session used for all Webrecorder API calls in this process,
+    so that calls reuse keep-alive connections to settings.WR_API.
+    """
+    global _wr_api_session
+    with _wr_api_session_lock:
+        if _wr_api_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.WR_API_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            # Calls are made on behalf of many different visitors: never let the session
+            # hold on to one visitor's WR cookie and send it along with someone else's request.
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            _wr_api_session = session
+    return _wr_api_session
+
+
+def wr_api_endpoint(method, path):
+    """
+    Name a WR API call for timeouts and metrics, without ids or query strings:
+    >>> wr_api_endpoint('get', '/upload/abc123?user=temp-1234')
+    'GET /upload'
+    """
+    return f"{method.upper()} /{path.lstrip('/').split('?')[0].split('/')[0]}"
+
+
 def query_wr_api(method, path, cookie, valid_if, json=None, data=None):
     # Make the request
+    endpoint = wr_api_endpoint(method, path)
+    start_time = time.perf_counter()
     try:
-        response = requests.request(
+        response = wr_api_session().request(
             method,
             settings.WR_API + path,
             json=json,
             data=data,
             cookies={'__wr_sesh': cookie} if cookie else None,
-            timeout=10,
+            timeout=(settings.WR_API_CONNECT_TIMEOUT, settings.WR_API_TIMEOUTS.get(endpoint, settings.WR_API_TIMEOUT)),
             allow_redirects=False
         )
     except requests.exceptions.RequestException as e:
+        wr_api_logger.info(f"{endpoint} failed after {time.perf_counter() - start_time:.3f}s: {e.__class__.__name__}")
         raise WebrecorderException() from e
+    wr_api_logger.info(f"{endpoint} {response.status_code} in {time.perf_counter() - start_time:.3f}s")
 
     # Validate the response
     try:
@@ -720,6 +1161,53 @@ def query_wr_api(method, path, cookie, valid_if, json=None, data=None):
     return response, data
 
 
+def wr_playback_counts_key(window):
+    return f'wr-playbacks:{window}'
+
+
+def record_wr_playback(guid):
+    """
+    Count a Webrecorder playback of a public link, so that the most popular
+    collections can be kept loaded in WR; see perma.tasks.warm_popular_wr_collections.
+    Counts are kept in sorted sets in the Redis cache, one per WR_WARMING_WINDOW.
+    """
+    if not settings.WARM_WR_COLLECTIONS:
+        return
+    try:
+        redis = get_redis_connection()
+    except NotImplementedError:
+        # the cache backend isn't Redis: popularity isn't tracked
+        return
+    key = wr_playback_counts_key(int(time.time()) // settings.WR_WARMING_WINDOW)
+    try:
+        with redis.pipeline() as pipe:
+            pipe.zincrby(key, 1, guid)
+            pipe.expire(key, settings.WR_WARMING_WINDOW * 2)
+            pipe.execute()
+    except RedisError:
+        # Record the exception, but don't halt execution: playback shouldn't depend on this
+        logger.exception(f'Could not record playback of {guid}')
+
+
+def popular_wr_playbacks(count):
+    """
+    Return the GUIDs of up to `count` public links played back most often
+    via Webrecorder over the current and previous WR_WARMING_WINDOW.
+    """
+    try:
+        redis = get_redis_connection()
+    except NotImplementedError:
+        return []
+    window = int(time.time()) // settings.WR_WARMING_WINDOW
+    with redis.pipeline() as pipe:
+        for key in (wr_playback_counts_key(window), wr_playback_counts_key(window - 1)):
+            pipe.zrevrange(key, 0, count - 1, withscores=True)
+        counts = Counter()
+        for playbacks in pipe.execute():
+            counts.update({guid.decode(): score for guid, score in playbacks})
+    return [guid for guid, _ in counts.most_common(count)]
+
+
 def get_wr_session_cookie(request, session_key):
     cookie = request.session.get(session_key)
     timestamp = request.session.get(session_key + '_timestamp')
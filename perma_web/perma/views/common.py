@@ -1,18 +1,16 @@
 from ratelimit.decorators import ratelimit
 from datetime import timedelta
 from dateutil.tz import tzutc
-from io import StringIO
 from link_header import Link as Rel, LinkHeader
 from urllib.parse import urlencode
 import time
-from timegate.utils import closest
 from warcio.timeutils import datetime_to_http_date
 from werkzeug.http import parse_date
 
 from django.forms import widgets
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import (HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect,
-    JsonResponse, HttpResponseNotFound, HttpResponseBadRequest)
+    JsonResponse, HttpResponseNotFound, HttpResponseBadRequest, Http404, StreamingHttpResponse)
 from django.urls import reverse, NoReverseMatch
 from django.conf import settings
 from django.core.files.storage import default_storage
@@ -29,8 +27,8 @@ from ..models import Link, Registrar, Organization, LinkUser
 from ..forms import ContactForm
 from ..utils import (if_anonymous, ratelimit_ip_key, redirect_to_download,
     protocol, stream_warc_if_permissible, set_options_headers,
-    timemap_url, timegate_url, memento_url, memento_data_for_url, url_with_qs_and_hash,
-    get_client_ip, remove_control_characters)
+    timemap_url, timegate_url, memento_url, mementos_for_url, memento_data_for_url, closest_memento, url_with_qs_and_hash,
+    get_client_ip, remove_control_characters, record_wr_playback)
 from ..email import send_admin_email, send_user_email_copy_admins
 
 import logging
@@ -128,7 +126,13 @@ def single_permalink(request, guid):
 
     # We only do the redirect if the correctly-formatted GUID actually exists --
     # this prevents actual 404s from redirecting with weird formatting.
-    link = get_object_or_404(Link.objects.all_with_deleted(), guid=canonical_guid)
+    # The parts of the page that are the same for every user come from cache;
+    # permissions are checked for this user below.
+    try:
+        link_context = Link.get_permalink_context(canonical_guid)
+    except Link.DoesNotExist:
+        raise Http404
+    link = link_context['link']
 
     if canonical_guid != guid:
         return HttpResponsePermanentRedirect(reverse('single_permalink', args=[canonical_guid]))
@@ -146,7 +150,7 @@ def single_permalink(request, guid):
 
     # serve raw WARC
     if serve_type == 'warc_download':
-        return stream_warc_if_permissible(link, request.user)
+        return stream_warc_if_permissible(link, request.user, request)
 
     # handle requested capture type
     if serve_type == 'image':
@@ -193,6 +197,7 @@ def single_permalink(request, guid):
         'can_edit': request.user.can_edit(link),
         'can_delete': request.user.can_delete(link),
         'can_toggle_private': request.user.can_toggle_private(link),
+        'can_play_back': link_context['can_play_back'],
         'capture': capture,
         'serve_type': serve_type,
         'new_record': new_record,
@@ -202,7 +207,7 @@ def single_permalink(request, guid):
         'protocol': protocol(),
     }
 
-    if context['can_view'] and link.can_play_back():
+    if context['can_view'] and link_context['can_play_back']:
         if new_record:
             logger.debug(f"Ensuring warc for {link.guid} has finished uploading.")
             def assert_exists(filename):
@@ -233,6 +238,8 @@ def single_permalink(request, guid):
             logger.info(f'Using client-side playback for {link.guid}')
         else:
             # Play back using Webrecorder
+            if not link.is_private:
+                record_wr_playback(link.guid)
             try:
                 logger.info(f"Initializing play back of {link.guid}")
                 wr_username = link.init_replay_for_user(request)
@@ -265,7 +272,7 @@ def single_permalink(request, guid):
 
     # Add memento headers, when appropriate
     logger.debug(f"Deciding whether to include memento headers for {link.guid}")
-    if link.is_visible_to_memento():
+    if link_context['is_visible_to_memento']:
         logger.debug(f"Including memento headers for {link.guid}")
         response['Memento-Datetime'] = datetime_to_http_date(link.creation_timestamp)
         # impose an arbitrary length-limit on the submitted URL, so that this header doesn't become illegally large
@@ -329,12 +336,12 @@ def serve_warc(request, guid):
     This is a redundant route for downloading a warc, for use in client-side playback,
     which has specific requirements:
     - the warc must be served from a URL ending in `.warc`
-    - the response cannot be streamed
+    - the response must have a Content-Length (and may support Range requests)
     """
 
     canonical_guid = Link.get_canonical_guid(guid)
     link = get_object_or_404(Link.objects.all_with_deleted(), guid=canonical_guid)
-    return stream_warc_if_permissible(link, request.user, stream=False)
+    return stream_warc_if_permissible(link, request.user, request)
 
 
 def replay_service_worker(request):
@@ -348,36 +355,47 @@ def replay_service_worker(request):
 @ratelimit(rate=settings.MINUTE_LIMIT, block=True, key=ratelimit_ip_key)
 @ratelimit(rate=settings.HOUR_LIMIT, block=True, key=ratelimit_ip_key)
 @ratelimit(rate=settings.DAY_LIMIT, block=True, key=ratelimit_ip_key)
-def timemap(request, response_format, url):
+def timemap(request, response_format, url, page=1):
     url = url_with_qs_and_hash(url, request.META['QUERY_STRING'])
-    data = memento_data_for_url(request, url)
+    mementos = mementos_for_url(url)
+    data = memento_data_for_url(request, url, mementos, page=int(page), response_format=response_format)
     if data:
         if response_format == 'json':
             response = JsonResponse(data)
         elif response_format == 'html':
-            response = render(request, 'memento/timemap.html', data)
+            response = render(request, 'memento/timemap.html', dict(data, memento_count=len(mementos), page=int(page)))
         else:
             content_type = 'application/link-format'
-            file = StringIO()
-            file.writelines(f"{line},\n" for line in [
-                Rel(data['original_uri'], rel='original'),
-                Rel(data['timegate_uri'], rel='timegate'),
-                Rel(data['self'], rel='self', type='application/link-format'),
-                Rel(data['timemap_uri']['link_format'], rel='timemap', type='application/link-format'),
-                Rel(data['timemap_uri']['json_format'], rel='timemap', type='application/json'),
-                Rel(data['timemap_uri']['html_format'], rel='timemap', type='text/html')
-            ] + [
-                Rel(memento['uri'], rel='memento', datetime=datetime_to_http_date(memento['datetime'])) for memento in data['mementos']['list']
-            ])
-            file.seek(0)
-            response = HttpResponse(file, content_type=f'{content_type}')
+
+            def lines():
+                # a page of a larger timemap gives the span of time it covers, and links to its neighbors
+                pages = data.get('pages', {})
+                page_span = {'from': datetime_to_http_date(pages['self']['from']), 'until': datetime_to_http_date(pages['self']['until'])} if pages else {}
+                yield from [
+                    Rel(data['original_uri'], rel='original'),
+                    Rel(data['timegate_uri'], rel='timegate'),
+                    Rel(data['self'], rel='self', type='application/link-format', **page_span),
+                    Rel(data['timemap_uri']['link_format'], rel='timemap', type='application/link-format'),
+                    Rel(data['timemap_uri']['json_format'], rel='timemap', type='application/json'),
+                    Rel(data['timemap_uri']['html_format'], rel='timemap', type='text/html')
+                ]
+                for neighbor in ['prev', 'next']:
+                    if neighbor in pages:
+                        yield Rel(pages[neighbor]['uri'], rel='timemap', type='application/link-format', **{
+                            'from': datetime_to_http_date(pages[neighbor]['from']),
+                            'until': datetime_to_http_date(pages[neighbor]['until']),
+                        })
+                for memento in data['mementos']['list']:
+                    yield Rel(memento['uri'], rel='memento', datetime=datetime_to_http_date(memento['datetime']))
+
+            response = StreamingHttpResponse((f"{line},\n" for line in lines()), content_type=f'{content_type}')
     else:
         if response_format == 'html':
             response = render(request, 'memento/timemap.html', {"original_uri": url}, status=404)
         else:
             response = HttpResponseNotFound('404 page not found\n')
 
-    response['X-Memento-Count'] = str(len(data['mementos']['list'])) if data else 0
+    response['X-Memento-Count'] = str(len(mementos)) if data else 0
     return response
 
 
@@ -388,7 +406,8 @@ def timemap(request, response_format, url):
 def timegate(request, url):
     # impose an arbitrary length-limit on the submitted URL, so that the headers don't become illegally large
     url = url_with_qs_and_hash(url, request.META['QUERY_STRING'])[:500]
-    data = memento_data_for_url(request, url)
+    mementos = mementos_for_url(url)
+    data = memento_data_for_url(request, url, mementos, page=None)
     if not data:
         return HttpResponseNotFound('404 page not found\n')
 
@@ -401,7 +420,8 @@ def timegate(request, url):
         accept_datetime = timezone.now()
     accept_datetime = accept_datetime.replace(tzinfo=tzutc())
 
-    target, target_datetime = closest([m.values() for m in data['mementos']['list']], accept_datetime)
+    target_datetime, target_guid = closest_memento(mementos, accept_datetime)
+    target = request.build_absolute_uri(reverse('single_permalink', args=[target_guid]))
 
     response = redirect(target)
     response['Vary'] = 'accept-datetime'
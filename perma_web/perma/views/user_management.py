@@ -54,6 +54,7 @@ from perma.models import Registrar, LinkUser, Organization, Link, Capture, Captu
 from perma.utils import apply_search_query, apply_pagination, apply_sort_order, get_form_data, ratelimit_ip_key, get_lat_long, user_passes_test_or_403, prep_for_perma_payments, clear_wr_session, get_client_ip
 from perma.email import send_admin_email, send_user_email
 from perma.exceptions import PermaPaymentsCommunicationException
+from perma.tasks import fan_out_progress
 
 logger = logging.getLogger(__name__)
 valid_member_sorts = ['last_name', '-last_name', 'date_joined', '-date_joined', 'last_login', '-last_login', 'link_count', '-link_count']
@@ -204,6 +205,7 @@ def stats(request, stat_type=None):
             'total_main_queue': r.llen('celery'),
             'total_background_queue': r.llen('background'),
             'total_ia_queue': r.llen('ia'),
+            'fan_outs': fan_out_progress(),
         }
 
     elif stat_type == "job_queue":
@@ -35,6 +35,11 @@ function render_batch(links_in_batch, folder_path) {
         link.progress = (link.step_count / steps) * 100;
         link.local_url = link.guid ? `${window.host}/${link.guid}` : null;
         switch(link.status){
+            case "validating":
+                link.isValidating = true;
+                all_completed = false;
+                batch_progress.push(link.progress);
+                break;
             case "pending":
                 link.isPending = true;
                 // divide into batches; each batch takes average_capture_time to complete
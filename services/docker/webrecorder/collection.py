@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 import traceback
 from datetime import date
 
@@ -70,6 +71,15 @@ class Collection(PagesMixin, RedisUniqueComponent):
 
     COLL_CDXJ_TTL = 1800
 
+    # BEGIN PERMA CUSTOMIZATION
+    # index lines to send to redis at once, when loading a recording's index
+    CDXJ_LOAD_BATCH_SIZE = 1000
+
+    # temp users ('u:<user>') and external collections ('c:<coll>') for the
+    # TempChecker to look at, scored by when they are next due
+    EXPIRE_INDEX_KEY = 'q:expire_index'
+    # END PERMA CUSTOMIZATION
+
     def __init__(self, **kwargs):
         """Initialize collection Redis building block."""
         super(Collection, self).__init__(**kwargs)
@@ -706,6 +716,11 @@ class Collection(PagesMixin, RedisUniqueComponent):
         key = self.EXTERNAL_KEY.format(coll=self.my_id)
         self.redis.set(key, '1')
 
+        # BEGIN PERMA CUSTOMIZATION
+        # check back once the collection's index is due to expire
+        self.redis.zadd(self.EXPIRE_INDEX_KEY, time.time() + self.COLL_CDXJ_TTL, 'c:' + self.my_id)
+        # END PERMA CUSTOMIZATION
+
     def commit_file(self, filename, full_filename, obj_type,
                     update_key=None, update_prop=None, direct_delete=False):
 
@@ -825,10 +840,21 @@ class Collection(PagesMixin, RedisUniqueComponent):
                 fh = None
                 try:
                     fh = load(cdxj_filename)
-                    buff = fh.read()
 
-                    for cdxj_line in buff.splitlines():
-                        self.redis.zadd(output_key, 0, cdxj_line)
+                    # BEGIN PERMA CUSTOMIZATION
+                    # stream the index, adding lines in batches, rather than
+                    # reading it all into memory and making a round trip per line
+                    batch = []
+                    while True:
+                        cdxj_line = fh.readline()
+                        if cdxj_line.strip():
+                            batch.extend((0, cdxj_line.rstrip()))
+                        if len(batch) >= 2 * self.CDXJ_LOAD_BATCH_SIZE or (batch and not cdxj_line):
+                            self.redis.zadd(output_key, *batch)
+                            batch = []
+                        if not cdxj_line:
+                            break
+                    # END PERMA CUSTOMIZATION
 
                     break
                 except Exception as e:
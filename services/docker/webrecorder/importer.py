@@ -20,6 +20,7 @@ import atexit
 
 import base64
 import os
+import time
 import gevent
 import redis
 
@@ -45,6 +46,11 @@ class ImportStatusChecker(object):
     UPLOAD_KEY = 'u:{user}:upl:{upid}'
     UPLOAD_EXP = 120
 
+    # BEGIN PERMA CUSTOMIZATION
+    # longest a status request may wait for an upload to finish; see wait_for_upload
+    MAX_UPLOAD_WAIT = 30
+    # END PERMA CUSTOMIZATION
+
     def __init__(self, redis):
         """Initialize status monitor.
 
@@ -52,6 +58,40 @@ class ImportStatusChecker(object):
         """
         self.redis = redis
 
+    # BEGIN PERMA CUSTOMIZATION
+    def wait_for_upload(self, upload_key, timeout):
+        """Block until the upload is done, or timeout seconds pass.
+
+        run_upload publishes to a channel named for the upload key
+        when it's done, so waiting takes no polling.
+
+        :param str upload_key: upload Redis key
+        :param float timeout: seconds to wait
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(upload_key)
+            # the upload may have finished before we subscribed
+            if self.redis.hget(upload_key, 'done') == '1':
+                return
+            end_time = time.time() + timeout
+            while time.time() < end_time:
+                if pubsub.get_message(timeout=end_time - time.time()):
+                    return
+        finally:
+            pubsub.close()
+
+    def get_requested_wait(self):
+        """Return the seconds a GET /upload/<id>?wait=<seconds> request
+        asked to wait for the upload to finish, or 0.
+        """
+        try:
+            return max(0, min(float(request.query.get('wait', 0)), self.MAX_UPLOAD_WAIT))
+        except (ValueError, RuntimeError):
+            # not a number, or not handling a request
+            return 0
+    # END PERMA CUSTOMIZATION
+
     def get_upload_status(self, user, upload_id):
         """Return WARC upload status.
 
@@ -64,6 +104,16 @@ class ImportStatusChecker(object):
         if not props:
             return {}
 
+        # BEGIN PERMA CUSTOMIZATION
+        # Let Perma wait for the upload to finish in one request, rather than polling.
+        wait = self.get_requested_wait()
+        if wait and props.get('done') != '1':
+            self.wait_for_upload(upload_key, wait)
+            props = self.redis.hgetall(upload_key)
+            if not props:
+                return {}
+        # END PERMA CUSTOMIZATION
+
         props['user'] = user.name
         props['upload_id'] = upload_id
 
@@ -278,13 +328,22 @@ class BaseImporter(ImportStatusChecker):
                 diff = total_size - last_end
                 self._add_split_padding(diff, upload_key)
 
-            with redis_pipeline(self.redis) as pi:
-                pi.hincrby(upload_key, 'files', -1)
-                pi.hset(upload_key, 'done', 1)
-
-            if first_coll.is_external():
-                first_coll.sync_coll_index(exists=False, do_async=False)
-                first_coll.set_external_remove_on_expire()
+            # BEGIN PERMA CUSTOMIZATION
+            # Index the collection before reporting the upload done, so it can be played back
+            # as soon as Perma hears; then tell anyone waiting (see wait_for_upload).
+            try:
+                if first_coll.is_external():
+                    first_coll.sync_coll_index(exists=False, do_async=False)
+                    first_coll.set_external_remove_on_expire()
+                # let the TempChecker know to look in on this temp user
+                if user.is_anon():
+                    self.redis.zadd(first_coll.EXPIRE_INDEX_KEY, time.time(), 'u:' + user.my_id)
+            finally:
+                with redis_pipeline(self.redis) as pi:
+                    pi.hincrby(upload_key, 'files', -1)
+                    pi.hset(upload_key, 'done', 1)
+                    pi.publish(upload_key, 'done')
+            # END PERMA CUSTOMIZATION
 
     def process_pages(self, info, page_id_map, upload_key, total_size):
         pages = info.get('pages')
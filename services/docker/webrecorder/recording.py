@@ -74,6 +74,11 @@ class Recording(RedisUniqueComponent):
 
     DELETE_RETRY = 'q:delete_retry'
 
+    # BEGIN PERMA CUSTOMIZATION
+    # index lines to read from redis at once, when writing a recording's index to disk
+    CDXJ_WRITE_BATCH_SIZE = 1000
+    # END PERMA CUSTOMIZATION
+
     # overridable
     OPEN_REC_TTL = 5400
 
@@ -409,12 +414,19 @@ class Recording(RedisUniqueComponent):
 
         full_filename = os.path.join(dirname, cdxj_filename)
 
-        cdxj_list = self.redis.zrange(cdxj_key, 0, -1)
-
+        # BEGIN PERMA CUSTOMIZATION
+        # write the index a batch of lines at a time, rather than loading it all into memory
         with open(full_filename, 'wt') as out:
-            for cdxj in cdxj_list:
-                out.write(cdxj + '\n')
+            start = 0
+            while True:
+                cdxj_list = self.redis.zrange(cdxj_key, start, start + self.CDXJ_WRITE_BATCH_SIZE - 1)
+                for cdxj in cdxj_list:
+                    out.write(cdxj + '\n')
+                if len(cdxj_list) < self.CDXJ_WRITE_BATCH_SIZE:
+                    break
+                start += self.CDXJ_WRITE_BATCH_SIZE
             out.flush()
+        # END PERMA CUSTOMIZATION
 
         full_url = add_local_store_prefix(full_filename.replace(os.path.sep, '/'))
         #self.redis.hset(warc_key, self.INDEX_FILE_KEY, full_url)
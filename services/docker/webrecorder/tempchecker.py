@@ -22,20 +22,39 @@ class TempChecker(object):
     needed. It is designed to be run by uWSGI on a regular schedule.
 
     When called, it:
-    a) Compiles a list of all temporary users, both derived from the directory
-    structure of `self.record_root_dir` and retrieved from Redis;
-    b) Deletes any temporary users whose sessions have expired, marks all
-    their recording sessions closed, and signals that their collections
+    a) Occasionally (every `FULL_SCAN_SECS`), adds all temporary users and
+    external collections, both derived from the directory structure of
+    `self.record_root_dir` and retrieved from Redis, to the expiry index
+    (`Collection.EXPIRE_INDEX_KEY`), and deletes all other empty directories
+    in `self.record_root_dir`, provided they haven't been altered within the
+    configured duration, including temp dirs from permanent users'
+    already-committed recording sessions;
+    b) Takes the temporary users and external collections that are due from
+    the expiry index; temp users and external collections are also added
+    to the index as they are uploaded to;
+    c) Deletes any of those temporary users whose sessions have expired, marks
+    all their recording sessions closed, and signals that their collections
     should be deleted;
-    c) Deletes directories belonging to expired temporary users (generally
-    already emptied due to the signals emitted by b);
-    d) Deletes all other empty directories in `self.record_root_dir`, provided
-    they haven't been altered within the configured duration, including
-    temp dirs from permanent users' already-committed recording sessions; and
-    e) Cleans up any extraneous sessions.
+    d) Deletes directories belonging to expired temporary users (generally
+    already emptied due to the signals emitted by c);
+    e) Deletes any of those external collections whose indexes have expired; and
+    f) Cleans up any extraneous sessions.
+
+    Anything not yet finished with is put back in the index, to be looked at
+    again later, so each pass only touches what is actually due.
     """
     USER_DIR_IDLE_TIME = 1800
 
+    # BEGIN PERMA CUSTOMIZATION
+    # how long to wait before looking in on a temp user again
+    RECHECK_SECS = 60
+    # most entries of the expiry index to look at in one pass
+    MAX_DUE_PER_PASS = 1000
+    # how often to scan everything, to catch anything missing from the expiry index
+    FULL_SCAN_SECS = 3600
+    FULL_SCAN_KEY = 'q:expire_index:scanned'
+    # END PERMA CUSTOMIZATION
+
     def __init__(self, config):
         super(TempChecker, self).__init__()
 
@@ -142,8 +161,40 @@ class TempChecker(object):
                 logger.error(str(e))
             return False
 
+    # BEGIN PERMA CUSTOMIZATION
     def __call__(self):
-        all_temps = set()
+        if self.data_redis.set(self.FULL_SCAN_KEY, '1', ex=self.FULL_SCAN_SECS, nx=True):
+            self.full_scan()
+
+        now = time.time()
+        due = self.data_redis.zrangebyscore(Collection.EXPIRE_INDEX_KEY, '-inf', now,
+                                            start=0, num=self.MAX_DUE_PER_PASS)
+
+        logger.debug('TempChecker: Due Count: {0}'.format(len(due)))
+
+        for member in due:
+            kind, name = member.split(':', 1)
+            try:
+                if kind == 'u':
+                    recheck_secs = self.check_temp_user(name)
+                elif kind == 'c':
+                    recheck_secs = self.check_external(name)
+                else:
+                    recheck_secs = None
+            except Exception:
+                logger.exception('TempChecker: Exception Checking: ' + member)
+                recheck_secs = self.RECHECK_SECS
+
+            if recheck_secs:
+                self.data_redis.zadd(Collection.EXPIRE_INDEX_KEY, now + recheck_secs, member)
+            else:
+                self.data_redis.zrem(Collection.EXPIRE_INDEX_KEY, member)
+
+    def full_scan(self):
+        """ Add all temp users and external collections to the expiry index,
+        and remove old empty user dirs
+        """
+        members = set()
 
         # scan self.record_root_dir for temporary and unneeded dirs
         for dir_name in os.listdir(self.record_root_dir):
@@ -160,47 +211,79 @@ class TempChecker(object):
                 self.remove_empty_user_dir(warc_dir)
                 continue
 
-            temp_user = warc_dir.rsplit(os.path.sep, 1)[1]
-            all_temps.add((temp_user, warc_dir))
+            members.add('u:' + dir_name)
 
         # include any temp users in redis that were missed during the directory scan
         temp_match = User.INFO_KEY.format(user=self.temp_prefix + '*')
         for redis_key in self.data_redis.scan_iter(match=temp_match, count=100):
-            temp_user = redis_key.rsplit(':', 2)[1]
+            members.add('u:' + redis_key.rsplit(':', 2)[1])
 
-            if temp_user not in all_temps:
-                all_temps.add((temp_user, os.path.join(self.record_root_dir, temp_user)))
+        all_ext_templ = Collection.EXTERNAL_KEY.format(coll='*')
+        for ext_key in self.data_redis.scan_iter(all_ext_templ):
+            members.add('c:' + ext_key.split(':', 2)[1])
 
-        logger.debug('TempChecker: Temp User Count: {0}'.format(len(all_temps)))
+        logger.debug('TempChecker: Full Scan Count: {0}'.format(len(members)))
 
-        # remove if expired
-        for temp_user, temp_dir in all_temps:
-            self.delete_if_expired(temp_user, temp_dir)
+        # due now; looking at anything already in the index early does no harm
+        now = time.time()
+        members = list(members)
+        for i in range(0, len(members), self.MAX_DUE_PER_PASS):
+            batch = []
+            for member in members[i:i + self.MAX_DUE_PER_PASS]:
+                batch.extend((now, member))
+            self.data_redis.zadd(Collection.EXPIRE_INDEX_KEY, *batch)
 
-        self.delete_expired_external()
+    def check_temp_user(self, temp_user):
+        """ Delete the temp user, if expired
 
-    def delete_expired_external(self):
-        """ Delete any expired external collections in non-temp users
+        :returns: seconds until the temp user should be checked again,
+                  or None if there is nothing left to clean up
         """
-        all_ext_templ = Collection.EXTERNAL_KEY.format(coll='*')
+        temp_dir = os.path.join(self.record_root_dir, temp_user)
 
-        for ext_key in self.data_redis.scan_iter(all_ext_templ):
-            _, coll, _2 = ext_key.split(':', 2)
+        self.delete_if_expired(temp_user, temp_dir)
 
-            collection = Collection(my_id=coll,
-                                    redis=self.data_redis,
-                                    access=BaseAccess())
+        # the temp dir is removed on a later pass, after the user is deleted
+        if (os.path.isdir(temp_dir)
+                or self.sesh_redis.exists('t:' + temp_user)
+                or self.data_redis.exists(User.INFO_KEY.format(user=temp_user))):
+            return self.RECHECK_SECS
 
-            user = collection.get_owner()
-            if not user or user.is_anon():
-                continue
+        return None
 
-            try:
-                if not collection.has_cdxj():
-                    logger.debug('TempChecker: Delete Expired External Coll: ' + collection.my_id)
-                    user.remove_collection(collection, delete=True)
-            except Exception:
-                logger.exception('TempChecker: Exception Removing External Coll: ' + collection.my_id)
+    def check_external(self, coll):
+        """ Delete the external collection in a non-temp user, if expired
+
+        :returns: seconds until the collection should be checked again,
+                  or None if there is nothing left to clean up
+        """
+        if not self.data_redis.exists(Collection.EXTERNAL_KEY.format(coll=coll)):
+            return None
+
+        # still being played back: check back when the index is due to expire
+        ttl = self.data_redis.ttl(Collection.COLL_CDXJ_KEY.format(coll=coll))
+        if ttl and ttl > 0:
+            return ttl + 1
+
+        collection = Collection(my_id=coll,
+                                redis=self.data_redis,
+                                access=BaseAccess())
+
+        # temp users' collections are deleted along with the user
+        user = collection.get_owner()
+        if not user or user.is_anon():
+            return None
+
+        try:
+            if not collection.has_cdxj():
+                logger.debug('TempChecker: Delete Expired External Coll: ' + collection.my_id)
+                user.remove_collection(collection, delete=True)
+                return None
+        except Exception:
+            logger.exception('TempChecker: Exception Removing External Coll: ' + collection.my_id)
+
+        return self.RECHECK_SECS
+    # END PERMA CUSTOMIZATION
 
 
 # =============================================================================